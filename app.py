@@ -1,22 +1,85 @@
-import json
 import os
 
 import streamlit as st
 import openai
 from dotenv import load_dotenv
 
+from src.llms.compaction import ConversationSummarizer, RollingCompaction
+from src.llms.instrumentation import JsonlExporter, PrometheusExporter, instrumentation
+from src.llms.openai_client import OpenAiClient
 from src.llms.openai_models import OpenAiChatWithRetries
+from src.llms.rate_limiter import RateLimiter
 from src.messages.messages import Message, MessageHistory
-from src.file_parsers.output_parsers import openai_response_parser
-from src.utils.random_ids import generate_date_key_combination, load_conversation_ids, read_history_from_id
+from src.file_parsers.output_parsers import openai_stream_response_parser
+from src.utils.conversation_store import ConversationStore
+from src.utils.random_ids import generate_conversation_id
 
 
 load_dotenv()
 
 # Set your OpenAI API key here
 openai.api_key = os.environ.get("OPENAI_KEY")
+# folder where the latency and token metrics of the API calls are written; unset to disable them
+metrics_dir = os.environ.get("CHAT_METRICS_DIR")
+# prompt tokens above which the oldest turns of a conversation are summarized; unset to always send every message
+compaction_tokens = int(os.environ.get("CHAT_COMPACTION_TOKENS", 0))
+compaction_model = os.environ.get("CHAT_COMPACTION_MODEL", "gpt-3.5-turbo-0613")
 
 system_message = "You are a helpful assistant specialized in responding questions related to code."
+conversations_per_page = 50
+# context window of each model, minus the tokens reserved for the answer
+max_prompt_tokens = {"gpt-4": 8192 - 1024, "gpt-3.5-turbo-0613": 4096 - 1024, "gpt-4-32k": 32768 - 1024, "gpt-3.5-turbo-16k": 16384 - 1024}
+# (requests per minute, tokens per minute) of the account for each model; adjust them to your usage tier
+rate_limits = {"gpt-4": (500, 10_000), "gpt-3.5-turbo-0613": (3500, 90_000), "gpt-4-32k": (500, 10_000), "gpt-3.5-turbo-16k": (3500, 180_000)}
+
+
+@st.cache_resource
+def get_conversation_store():
+    """Opens the conversation store once per process and imports the conversations saved as files before it."""
+    store = ConversationStore("data/conversations.db")
+    store.import_json_files("data/conversations")
+    return store
+
+
+@st.cache_resource
+def get_prometheus_exporter() -> PrometheusExporter:
+    """Registers the metric exporters once per process: a JSONL line per API call and Prometheus aggregates."""
+    prometheus = PrometheusExporter()
+    instrumentation.add_callback(JsonlExporter(os.path.join(metrics_dir, "openai_calls.jsonl")))
+    instrumentation.add_callback(prometheus)
+    return prometheus
+
+
+@st.cache_resource
+def get_openai_client() -> OpenAiClient:
+    """One pool of API connections per process, so reruns (which run in new threads) do not open new ones."""
+    return OpenAiClient(pool_size=8, connect_timeout=10, read_timeout=120)
+
+
+@st.cache_resource
+def get_rate_limiter(model: str) -> RateLimiter:
+    """One rate limiter per model, shared by every session of the app, since the API limits are per model."""
+    requests_per_minute, tokens_per_minute = rate_limits[model]
+    return RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+
+
+def get_compaction(conversation_id: str) -> RollingCompaction:
+    """One rolling summary per conversation of the session, kept across reruns (the history is read again on each)."""
+    compactions = st.session_state.setdefault("compactions", {})
+    if conversation_id not in compactions:
+        summarizer = ConversationSummarizer(
+            compaction_model,
+            rate_limiter=get_rate_limiter(compaction_model) if compaction_model in rate_limits else None,
+            client=get_openai_client(),
+        )
+        compactions[conversation_id] = RollingCompaction(
+            summarizer, threshold_tokens=compaction_tokens, keep_recent_tokens=compaction_tokens // 3
+        )
+    return compactions[conversation_id]
+
+
+conversation_store = get_conversation_store()
+prometheus_exporter = get_prometheus_exporter() if metrics_dir else None
 
 st.header("ChatGPT")
 
@@ -25,8 +88,12 @@ col1, col2, col3 = st.columns([2, 2, 4])
 model = col1.selectbox(label="Select your model:", options=["gpt-4", "gpt-3.5-turbo-0613", "gpt-4-32k", "gpt-3.5-turbo-16k"])
 temperature = col2.slider("Temperature:", min_value=0.0, max_value=2.0, value=0.2)
 
-conversation_ids = load_conversation_ids()
-selected_id = st.sidebar.selectbox('Choose a Conversation', conversation_ids)
+page = st.sidebar.number_input("Page", min_value=1, value=1, step=1)
+conversations = conversation_store.list_conversations(
+    limit=conversations_per_page, offset=(page - 1) * conversations_per_page
+)
+conversation_titles = {conversation["id"]: conversation["title"] or conversation["id"] for conversation in conversations}
+selected_id = st.sidebar.selectbox('Choose a Conversation', list(conversation_titles), format_func=conversation_titles.get)
 
 new_conv = st.sidebar.button("Start a new conversation", key="restart_button")
 
@@ -34,7 +101,7 @@ if new_conv:
     st.session_state.restart = True
 
 if ("restart" not in st.session_state) or st.session_state.restart == True:
-    unique_id = generate_date_key_combination()
+    unique_id = generate_conversation_id()
     st.session_state.unique_id = unique_id
     st.session_state.messages = MessageHistory()
     sys_msg_obj = Message("system", system_message)
@@ -44,14 +111,16 @@ if ("restart" not in st.session_state) or st.session_state.restart == True:
 
     st.session_state.restart = False
 
-    st.session_state.messages.save_to_file(st.session_state.unique_id)
+    conversation_store.save_history(st.session_state.unique_id, st.session_state.messages)
 
     st.rerun()
 
 elif st.session_state.restart == False:
-    unique_id = "data/conversations/" + selected_id + ".json"
-    st.session_state.unique_id = unique_id
-    st.session_state.messages = read_history_from_id(unique_id)
+    st.session_state.unique_id = selected_id
+    st.session_state.messages = conversation_store.load_history(selected_id)
+    if compaction_tokens:
+        # every message is still shown and saved; only the prompts replace the oldest turns with their summary
+        st.session_state.messages.compaction = get_compaction(selected_id)
 
 
 # Show chat
@@ -65,20 +134,35 @@ if prompt is not None:
     new_message = Message(role="user", message=prompt)
     st.session_state.messages.add_message(new_message) 
 
+    with st.chat_message("user"):
+        st.markdown(prompt)
+
     chat = OpenAiChatWithRetries(
         history=st.session_state.messages, 
         model=model,
-        temperature=temperature
+        temperature=temperature,
+        max_prompt_tokens=max_prompt_tokens[model],
+        rate_limiter=get_rate_limiter(model),
+        client=get_openai_client()
     )
-    print("Made a call to OPENAI")
-    response = chat(prompt)
+    stream = chat.stream_on_messages(st.session_state.messages)
 
-    text_response, token_dict = openai_response_parser(response)
+    with st.chat_message("assistant"):
+        placeholder = st.empty()
+        for _ in stream:
+            placeholder.markdown(stream.text + "▌")
+        placeholder.markdown(stream.text)
+
+    text_response, token_dict = openai_stream_response_parser(stream)
     assistant_message = Message("assistant", message=text_response)
 
     st.session_state.messages.add_message(assistant_message)
 
-    st.session_state.messages.save_to_file(st.session_state.unique_id)
+    conversation_store.save_history(
+        st.session_state.unique_id, st.session_state.messages, tokens_used=token_dict["total_tokens"]
+    )
+    if prometheus_exporter is not None:
+        prometheus_exporter.write(os.path.join(metrics_dir, "openai.prom"))
 
     st.session_state.last_message = prompt
 
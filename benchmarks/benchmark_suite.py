@@ -0,0 +1,279 @@
+"""Measures the latency and throughput of the project's own code, across input sizes, without calling the real API:
+the chat and embedding wrappers run against the local mock server (benchmarks/mock_openai_server.py).
+
+Run from the main directory:
+
+    python benchmarks/benchmark_suite.py --output benchmark_results.json
+    python benchmarks/benchmark_suite.py --baseline benchmark_results.json --only history pdf
+
+Every case reports the median, 95th percentile and minimum seconds per operation and the operations per second.
+With --baseline, the script exits with an error if the median of a case got slower than the baseline by more than
+--tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import openai
+
+from benchmarks.mock_openai_server import MockOpenAiServer
+from src.file_parsers.pdf_parsers import PdfReader
+from src.llms.openai_client import OpenAiClient
+from src.llms.openai_models import OpenAiChatWithRetries, OpenAiEmbeddings
+from src.messages.messages import Message, MessageHistory
+from src.utils.random_ids import read_history_from_id
+
+SIZES = {
+    "history": [10, 100, 1000, 10000],
+    "chat": [2, 50, 500],
+    "embedding": [1, 32, 512],
+    "pdf": [1, 10, 100],
+}
+QUICK_SIZES = {"history": [10, 1000], "chat": [2, 50], "embedding": [1, 32], "pdf": [1, 10]}
+BATCH_REQUESTS = 50
+
+
+def summarize(seconds: list, items_per_run: int = 1) -> dict:
+    """Summary of the durations of the runs of a case. `items_per_run` is the number of items (messages, texts,
+    pages) each run processes, used for the throughput."""
+    ordered = sorted(seconds)
+    median = statistics.median(ordered)
+    return {
+        "runs": len(ordered),
+        "median_seconds": median,
+        "p95_seconds": ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)],
+        "min_seconds": ordered[0],
+        "items_per_second": items_per_run / median if median > 0 else float("inf"),
+    }
+
+
+def time_runs(function, repeats: int) -> list:
+    """Runs `function` `repeats` times and returns the duration of each run."""
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def make_history(num_messages: int, words_per_message: int = 40) -> MessageHistory:
+    history = MessageHistory()
+    history.add_message(Message("system", "You are a helpful assistant specialized in responding questions."))
+    for index in range(num_messages - 1):
+        role = "user" if index % 2 == 0 else "assistant"
+        history.add_message(Message(role, " ".join(f"word{index}_{word}" for word in range(words_per_message))))
+    return history
+
+
+def make_pdf(path: str, num_pages: int, lines_per_page: int = 40, words_per_line: int = 12):
+    """Writes a PDF of `num_pages` pages of plain text, without any PDF library."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * page} 0 R" for page in range(num_pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {num_pages} >>")
+    font_id = 3 + 2 * num_pages
+    for page in range(num_pages):
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * page} 0 R "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>"
+        )
+        lines = [
+            " ".join(f"page{page}line{line}word{word}" for word in range(words_per_line))
+            for line in range(lines_per_page)
+        ]
+        stream = "BT /F1 9 Tf 11 TL 40 760 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    content, offsets = "%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f"{number} 0 obj\n{body}\nendobj\n"
+    xref_offset = len(content)
+    content += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    content += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    content += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n"
+
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def bench_history(sizes: list, repeats: int, work_dir: str) -> dict:
+    results = {}
+    for size in sizes:
+        history = make_history(size)
+        runs = max(3, repeats // max(1, size // 100))
+
+        results[f"history/to_list/messages={size}"] = summarize(time_runs(history.to_list, runs), size)
+
+        json_path = os.path.join(work_dir, f"history_{size}.json")
+        results[f"history/save_json/messages={size}"] = summarize(
+            time_runs(lambda: history.save_to_file(json_path, fsync=False), runs), size
+        )
+        results[f"history/read_json/messages={size}"] = summarize(
+            time_runs(lambda: read_history_from_id(json_path), runs), size
+        )
+
+        # append-only log: the cost of saving one new message once the rest is on disk
+        jsonl_path = os.path.join(work_dir, f"history_{size}.jsonl")
+        log_history = make_history(size)
+        log_history.save_to_file(jsonl_path, fsync=False)
+
+        def append_one():
+            log_history.add_message(Message("user", "one more message"))
+            log_history.save_to_file(jsonl_path, fsync=False)
+
+        results[f"history/append_jsonl/messages={size}"] = summarize(time_runs(append_one, runs))
+        results[f"history/read_jsonl/messages={size}"] = summarize(
+            time_runs(lambda: read_history_from_id(jsonl_path), runs), size
+        )
+
+    return results
+
+
+def bench_chat(server: MockOpenAiServer, sizes: list, repeats: int, client: OpenAiClient or None) -> dict:
+    results = {}
+    for size in sizes:
+        history = make_history(size)
+        chat = OpenAiChatWithRetries(history, client=client)
+
+        results[f"chat/call/messages={size}"] = summarize(
+            time_runs(lambda: chat.predict_on_messages(history), repeats)
+        )
+
+        first_token, total = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            stream = chat.stream_on_messages(history, retries=1)
+            next(stream)
+            first_token.append(time.perf_counter() - start)
+            for _ in stream:
+                pass
+            total.append(time.perf_counter() - start)
+        results[f"chat/stream_first_token/messages={size}"] = summarize(first_token)
+        results[f"chat/stream_total/messages={size}"] = summarize(total)
+
+    # throughput of a concurrent batch, with and without injected failures (retried right away, or after the
+    # Retry-After of the 429s)
+    histories = [make_history(sizes[0]) for _ in range(BATCH_REQUESTS)]
+    chat = OpenAiChatWithRetries(histories[0], client=client)
+    for error_rate, rate_limit_rate in ((0.0, 0.0), (0.1, 0.1)):
+        server.configure(error_rate=error_rate, rate_limit_rate=rate_limit_rate, retry_after=0.01, seed=0)
+        server.reset_counters()
+        durations = time_runs(lambda: chat.batch(histories, max_concurrency=8, retries=10, base_wait=0), 3)
+        case = f"chat/batch/requests={len(histories)},failure_rate={error_rate + rate_limit_rate:.1f}"
+        results[case] = {**summarize(durations, len(histories)), "server": server.stats()}
+    server.configure(error_rate=0.0, rate_limit_rate=0.0)
+
+    return results
+
+
+def bench_embeddings(sizes: list, repeats: int, client: OpenAiClient or None) -> dict:
+    results = {}
+    embeddings = OpenAiEmbeddings(client=client)
+    for size in sizes:
+        texts = [f"text number {index} to embed" for index in range(size)]
+        results[f"embedding/embed_numpy/texts={size}"] = summarize(
+            time_runs(lambda: embeddings.embed_numpy(texts), repeats), size
+        )
+
+    texts = [f"bulk text number {index} to embed" for index in range(4 * max(sizes))]
+    results[f"embedding/embed_bulk/texts={len(texts)}"] = summarize(
+        time_runs(lambda: embeddings.embed_bulk(texts, max_batch_items=max(sizes) // 2 or 1), 3), len(texts)
+    )
+    return results
+
+
+def bench_pdf(sizes: list, repeats: int, work_dir: str) -> dict:
+    results = {}
+    for size in sizes:
+        path = os.path.join(work_dir, f"document_{size}.pdf")
+        make_pdf(path, size)
+        runs = max(3, repeats // size)
+        results[f"pdf/chunk_text/pages={size}"] = summarize(
+            time_runs(lambda: PdfReader(path).chunk_text(1000, 100), runs), size
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for case, result in results.items():
+        previous = baseline.get(case)
+        if previous is None:
+            continue
+        if result["median_seconds"] > tolerance * previous["median_seconds"]:
+            regressions.append(
+                f"{case}: median {1000 * previous['median_seconds']:.3f} ms -> {1000 * result['median_seconds']:.3f} ms"
+            )
+    return regressions
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=root
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "commit": commit or None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and throughput of the project's code against a mock API.")
+    parser.add_argument("--only", nargs="+", choices=list(SIZES), default=list(SIZES), help="Groups of cases to run")
+    parser.add_argument("--repeats", type=int, default=30, help="Runs per case (fewer for the largest sizes)")
+    parser.add_argument("--quick", action="store_true", help="Only the smallest sizes")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock server takes per request")
+    parser.add_argument("--no_client", action="store_true", help="Call the API without a pooled OpenAiClient")
+    parser.add_argument("--output", default=None, help="JSON file where the results are written")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed ratio over the baseline")
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    work_dir = tempfile.mkdtemp(prefix="chachibt_benchmark_")
+    results = {}
+    try:
+        with MockOpenAiServer(latency=args.latency) as server:
+            openai.api_base = server.url
+            openai.api_key = "mock"
+            client = None if args.no_client else OpenAiClient()
+
+            if "history" in args.only:
+                results.update(bench_history(sizes["history"], args.repeats, work_dir))
+            if "chat" in args.only:
+                results.update(bench_chat(server, sizes["chat"], args.repeats, client))
+            if "embedding" in args.only:
+                results.update(bench_embeddings(sizes["embedding"], args.repeats, client))
+            if "pdf" in args.only:
+                results.update(bench_pdf(sizes["pdf"], args.repeats, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for case, result in results.items():
+        print(
+            f"{case:60s} median {1000 * result['median_seconds']:9.3f} ms  p95 {1000 * result['p95_seconds']:9.3f} ms"
+            f"  {result['items_per_second']:12.1f} items/s"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,102 @@
+"""Measures the per-request overhead of the OpenAI calls with and without a shared OpenAiClient, against the local
+mock server (so the numbers are client overhead plus loopback, without TLS: over the internet every avoided
+connection also saves a TLS handshake).
+
+Run from the main directory:
+
+    python benchmarks/client_benchmark.py --requests 200 --output client_benchmark.json
+
+Scenarios:
+    sync_new_thread: each request is sent from a new thread, like each Streamlit rerun.
+    async_batch: all requests are sent concurrently from one event loop.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import openai
+
+from benchmarks.mock_openai_server import MockOpenAiServer
+from src.llms.openai_client import OpenAiClient
+
+CREATE_KWARGS = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "Hello"}], "temperature": 0.0}
+
+
+def sync_new_thread(num_requests: int, client: OpenAiClient or None) -> None:
+    for _ in range(num_requests):
+        if client is None:
+            thread = threading.Thread(target=lambda: openai.ChatCompletion.create(**CREATE_KWARGS))
+        else:
+            thread = threading.Thread(target=lambda: client.call(openai.ChatCompletion.create, **CREATE_KWARGS))
+        thread.start()
+        thread.join()
+
+
+async def async_batch(num_requests: int, client: OpenAiClient or None, max_concurrency: int = 8) -> None:
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def send():
+        async with semaphore:
+            if client is None:
+                await openai.ChatCompletion.acreate(**CREATE_KWARGS)
+            else:
+                await client.call_async(openai.ChatCompletion.acreate, **CREATE_KWARGS)
+
+    if client is None:
+        await asyncio.gather(*(send() for _ in range(num_requests)))
+    else:
+        async with client.async_session():
+            await asyncio.gather(*(send() for _ in range(num_requests)))
+
+
+def run(server: MockOpenAiServer, scenario: str, num_requests: int, client: OpenAiClient or None) -> dict:
+    server.reset_counters()
+    start = time.perf_counter()
+    if scenario == "sync_new_thread":
+        sync_new_thread(num_requests, client)
+    else:
+        asyncio.run(async_batch(num_requests, client))
+    seconds = time.perf_counter() - start
+
+    return {
+        "seconds": seconds,
+        "ms_per_request": 1000 * seconds / num_requests,
+        "connections": server.connections,
+        "requests": server.requests,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request overhead with and without a pooled OpenAiClient.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock server takes per request")
+    parser.add_argument("--pool_size", type=int, default=16)
+    parser.add_argument("--output", default=None, help="JSON file where the results are written")
+    args = parser.parse_args()
+
+    results = {}
+    with MockOpenAiServer(latency=args.latency) as server:
+        openai.api_base = server.url
+        openai.api_key = "mock"
+        client = OpenAiClient(pool_size=args.pool_size)
+
+        for scenario in ("sync_new_thread", "async_batch"):
+            for name, scenario_client in (("openai", None), ("client", client)):
+                run(server, scenario, 5, scenario_client)  # warm up
+                results[f"{scenario}/{name}"] = run(server, scenario, args.requests, scenario_client)
+
+        client.close()
+
+    for name, result in results.items():
+        print(f"{name:30s} {result['ms_per_request']:8.2f} ms/request {result['connections']:6d} connections")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,101 @@
+"""Measures the cold import time and memory of the main modules, each in a fresh interpreter.
+
+Run from the main directory:
+
+    python benchmarks/import_benchmark.py --output import_benchmark.json
+    python benchmarks/import_benchmark.py --baseline import_benchmark.json
+
+With --baseline, the script exits with an error if a module got slower or bigger than the baseline by more than
+--tolerance, or if it now loads one of the heavy backends at import time.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+MODULES = [
+    "src.messages.messages",
+    "src.utils.random_ids",
+    "src.utils.conversation_store",
+    "src.llms.openai_models",
+    "src.llms.async_openai_models",
+    "src.messages.base_messages",
+]
+
+HEAVY_MODULES = ["torch", "pandas", "tiktoken", "sentence_transformers"]
+
+_PROBE = """
+import importlib, json, resource, sys, time
+sys.path.insert(0, {root!r})
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+importlib.import_module({module!r})
+seconds = time.perf_counter() - start
+rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+loaded = [name for name in {heavy!r} if type(sys.modules.get(name)).__name__ == "module"]
+print(json.dumps({{"seconds": seconds, "rss_mb": rss_after / 1024, "rss_delta_mb": (rss_after - rss_before) / 1024,
+                  "heavy_modules_loaded": loaded}}))
+"""
+
+
+def measure(module: str, root: str, repeats: int = 3) -> dict:
+    """Imports `module` in `repeats` fresh interpreters and keeps the fastest run."""
+    runs = []
+    for _ in range(repeats):
+        code = _PROBE.format(root=root, module=module, heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=root)
+        if output.returncode != 0:
+            return {"error": output.stderr.strip().splitlines()[-1]}
+        runs.append(json.loads(output.stdout))
+
+    return min(runs, key=lambda run: run["seconds"])
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for module, result in results.items():
+        previous = baseline.get(module)
+        if previous is None or "error" in result or "error" in previous:
+            continue
+        if result["seconds"] > tolerance * previous["seconds"]:
+            regressions.append(f"{module}: import time {previous['seconds']:.3f}s -> {result['seconds']:.3f}s")
+        if result["rss_delta_mb"] > tolerance * max(previous["rss_delta_mb"], 1.0):
+            regressions.append(f"{module}: memory {previous['rss_delta_mb']:.1f}MB -> {result['rss_delta_mb']:.1f}MB")
+        new_heavy = set(result["heavy_modules_loaded"]) - set(previous["heavy_modules_loaded"])
+        if new_heavy:
+            regressions.append(f"{module}: now imports {sorted(new_heavy)} at import time")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold import time and RSS of the main modules.")
+    parser.add_argument("--output", default=None, help="JSON file where the results are written")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed ratio over the baseline")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {module: measure(module, root, args.repeats) for module in MODULES}
+
+    for module, result in results.items():
+        if "error" in result:
+            print(f"{module:35s} ERROR {result['error']}")
+        else:
+            print(
+                f"{module:35s} {1000 * result['seconds']:8.1f} ms {result['rss_delta_mb']:8.1f} MB"
+                f"  heavy: {', '.join(result['heavy_modules_loaded']) or '-'}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
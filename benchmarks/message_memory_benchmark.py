@@ -0,0 +1,114 @@
+"""Measures the memory and allocations of conversation histories: building a long MessageHistory, serializing it
+(to_list, as the app, the chat wrappers and save_to_file do on every turn), saving it and reading it back.
+
+Run from the main directory:
+
+    python benchmarks/message_memory_benchmark.py --messages 10000 --output message_memory.json
+
+Memory is measured with tracemalloc: "retained_bytes" is what the result keeps alive and "peak_bytes" the most
+allocated at once during the operation. With --baseline, the script exits with an error if a number got bigger
+than the baseline by more than --tolerance.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from src.messages.messages import Message, MessageHistory
+from src.utils.random_ids import read_history_from_id
+
+
+def measure(function) -> tuple:
+    """Runs `function` under tracemalloc and returns its result and its seconds, retained and peak bytes."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {"seconds": seconds, "retained_bytes": retained, "peak_bytes": peak}
+
+
+def build_history(texts: list) -> MessageHistory:
+    history = MessageHistory()
+    history.add_message(Message("system", "You are a helpful assistant specialized in responding questions."))
+    for index, text in enumerate(texts):
+        history.add_message(Message("user" if index % 2 == 0 else "assistant", text))
+    return history
+
+
+def run(num_messages: int, work_dir: str) -> dict:
+    # the texts are created outside the measurements: only the cost of the messages themselves is counted
+    texts = [f"message {index}: " + "lorem ipsum dolor sit amet " * 8 for index in range(num_messages - 1)]
+    results = {}
+
+    history, results["build"] = measure(lambda: build_history(texts))
+    results["build"]["bytes_per_message"] = results["build"]["retained_bytes"] / num_messages
+
+    history.to_list()  # the first call may fill caches; the app calls it on every turn
+    _, results["to_list"] = measure(history.to_list)
+    _, results["to_list_three_times"] = measure(lambda: [history.to_list() for _ in range(3)])
+
+    json_path = os.path.join(work_dir, "history.json")
+    _, results["save_json"] = measure(lambda: history.save_to_file(json_path, fsync=False))
+
+    jsonl_path = os.path.join(work_dir, "history.jsonl")
+    history.save_to_file(jsonl_path, fsync=False)
+
+    def append_and_save():
+        history.add_message(Message("user", "one more message"))
+        history.save_to_file(jsonl_path, fsync=False)
+
+    _, results["append_jsonl"] = measure(append_and_save)
+
+    read_history, results["read_json"] = measure(lambda: read_history_from_id(json_path))
+    results["read_json"]["bytes_per_message"] = results["read_json"]["retained_bytes"] / len(read_history.messages)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for case, result in results.items():
+        for metric in ("retained_bytes", "peak_bytes"):
+            previous = baseline.get(case, {}).get(metric)
+            if previous and result[metric] > tolerance * previous:
+                regressions.append(f"{case}: {metric} {previous} -> {result[metric]}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory and allocations of long conversation histories.")
+    parser.add_argument("--messages", type=int, default=10000, help="Messages of the history")
+    parser.add_argument("--output", default=None, help="JSON file where the results are written")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="Allowed ratio over the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="chachibt_memory_") as work_dir:
+        results = run(args.messages, work_dir)
+
+    for case, result in results.items():
+        print(
+            f"{case:22s} {1000 * result['seconds']:9.3f} ms  retained {result['retained_bytes'] / 1024:10.1f} KiB"
+            f"  peak {result['peak_bytes'] / 1024:10.1f} KiB"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"messages": args.messages, "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,229 @@
+"""A local HTTP server that answers like the OpenAI chat completion and embedding endpoints, to benchmark the
+client side without network noise or costs.
+
+    with MockOpenAiServer(latency=0.01, error_rate=0.05, rate_limit_rate=0.05) as server:
+        openai.api_base = server.url
+        ...
+        print(server.stats())
+
+Chat completions are streamed (server-sent events) when the request asks for it. Failures are drawn from a
+seeded random generator, so two runs with the same settings inject the same failures.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+_SETTINGS = {
+    "latency", "token_latency", "error_rate", "rate_limit_rate", "retry_after", "completion_words", "embedding_dim"
+}
+
+
+def chat_completion_response(model: str, content: str = "Hello! How can I help you today?") -> dict:
+    completion_tokens = len(content.split())
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": completion_tokens, "total_tokens": 10 + completion_tokens},
+    }
+
+
+def chat_completion_chunk(model: str, delta: dict, finish_reason: str or None = None) -> dict:
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def embedding_response(model: str, inputs: list, dim: int = 8) -> dict:
+    data = [
+        {"object": "embedding", "index": index, "embedding": [float(len(text) % 7 + i) for i in range(dim)]}
+        for index, text in enumerate(inputs)
+    ]
+    num_tokens = sum(len(text.split()) for text in inputs)
+    usage = {"prompt_tokens": num_tokens, "total_tokens": num_tokens}
+    return {"object": "list", "data": data, "model": model, "usage": usage}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections alive between requests
+    disable_nagle_algorithm = True  # otherwise a kept-alive connection waits for delayed ACKs
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.server.lock:
+            self.server.requests += 1
+            draw = self.server.random.random()
+        time.sleep(self.server.latency)
+
+        if draw < self.server.rate_limit_rate:
+            with self.server.lock:
+                self.server.rate_limited += 1
+            error = {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}
+            self._send_json(429, {"error": error}, headers={"Retry-After": str(self.server.retry_after)})
+            return
+        if draw < self.server.rate_limit_rate + self.server.error_rate:
+            with self.server.lock:
+                self.server.errors += 1
+            self._send_json(500, {"error": {"message": "The server had an error (mock)", "type": "server_error"}})
+            return
+
+        model = body.get("model", "gpt-3.5-turbo")
+        if self.path.endswith("/chat/completions"):
+            content = " ".join(["word"] * self.server.completion_words)
+            if body.get("stream"):
+                self._send_stream(model, content)
+                return
+            payload = chat_completion_response(model, content)
+        elif self.path.endswith("/embeddings"):
+            inputs = body.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            payload = embedding_response(model, inputs, dim=self.server.embedding_dim)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        self._send_json(200, payload)
+
+    def _send_json(self, status: int, payload: dict, headers: dict or None = None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model: str, content: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        events = [chat_completion_chunk(model, {"role": "assistant", "content": ""})]
+        events += [chat_completion_chunk(model, {"content": word + " "}) for word in content.split()]
+        events.append(chat_completion_chunk(model, {}, finish_reason="stop"))
+        for event in events:
+            self._send_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            time.sleep(self.server.token_latency)
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+
+class MockOpenAiServer:
+    """Serves the mock endpoints on a free local port from a background thread.
+
+    Args:
+        latency (float, optional): Seconds before every answer starts. Defaults to 0.
+        token_latency (float, optional): Seconds between the tokens of a streamed answer. Defaults to 0.
+        error_rate (float, optional): Fraction of requests answered with a 500. Defaults to 0.
+        rate_limit_rate (float, optional): Fraction of requests answered with a 429. Defaults to 0.
+        retry_after (float, optional): Retry-After header of the 429s, in seconds. Defaults to 0.
+        completion_words (int, optional): Words (roughly tokens) of every chat answer. Defaults to 20.
+        embedding_dim (int, optional): Dimension of the embeddings. Defaults to 8.
+        seed (int, optional): Seed of the failure injection. Defaults to 0.
+    """
+
+    def __init__(
+            self,
+            latency: float = 0.0,
+            token_latency: float = 0.0,
+            error_rate: float = 0.0,
+            rate_limit_rate: float = 0.0,
+            retry_after: float = 0.0,
+            completion_words: int = 20,
+            embedding_dim: int = 8,
+            seed: int = 0
+        ):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        self.httpd.random = random.Random(seed)
+        self.httpd.latency = latency
+        self.httpd.token_latency = token_latency
+        self.httpd.error_rate = error_rate
+        self.httpd.rate_limit_rate = rate_limit_rate
+        self.httpd.retry_after = retry_after
+        self.httpd.completion_words = completion_words
+        self.httpd.embedding_dim = embedding_dim
+        self.reset_counters()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    @property
+    def connections(self) -> int:
+        """TCP connections opened by clients so far."""
+        return self.httpd.connections
+
+    @property
+    def requests(self) -> int:
+        return self.httpd.requests
+
+    def stats(self) -> dict:
+        """Returns the connections, requests, injected 500s and injected 429s since the last reset."""
+        with self.httpd.lock:
+            return {
+                "connections": self.httpd.connections,
+                "requests": self.httpd.requests,
+                "errors": self.httpd.errors,
+                "rate_limited": self.httpd.rate_limited,
+            }
+
+    def reset_counters(self):
+        with self.httpd.lock:
+            self.httpd.connections = 0
+            self.httpd.requests = 0
+            self.httpd.errors = 0
+            self.httpd.rate_limited = 0
+
+    def configure(self, **settings):
+        """Changes settings of the running server, e.g. configure(error_rate=0.1, latency=0.05). Passing `seed`
+        restarts the failure injection."""
+        unknown = set(settings) - _SETTINGS - {"seed"}
+        if unknown:
+            raise ValueError(f"Unknown settings {sorted(unknown)}. Valid settings: {sorted(_SETTINGS)} and seed")
+
+        with self.httpd.lock:
+            for name, value in settings.items():
+                if name == "seed":
+                    self.httpd.random = random.Random(value)
+                else:
+                    setattr(self.httpd, name, value)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
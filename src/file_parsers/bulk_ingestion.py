@@ -0,0 +1,155 @@
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import pypdf
+
+from src.file_parsers.pdf_parsers import PdfReader
+
+
+def _chunk_shard(path: str, start: int, end: int, num_characters: int, overlap: int) -> dict:
+    """Chunks pages [start, end) of a PDF (the overlap may read page `end`). Runs in a worker process, so any
+    error is returned instead of raised."""
+    try:
+        reader = PdfReader(path)
+        chunks = []
+        for idx in range(start, end):
+            for chunk_index, chunk in enumerate(reader.chunk_split(idx, num_characters, overlap)):
+                chunks.append({"path": path, "page": idx, "chunk_index": chunk_index, "text": chunk})
+        return {"path": path, "start": start, "end": end, "chunks": chunks, "error": None}
+    except Exception as e:
+        return {"path": path, "start": start, "end": end, "chunks": [], "error": f"{type(e).__name__}: {e}"}
+
+
+def _count_pages(path: str) -> dict:
+    """Counts the pages of a PDF. Runs in a worker process, so any error is returned instead of raised."""
+    try:
+        return {"num_pages": len(pypdf.PdfReader(path).pages), "error": None}
+    except Exception as e:
+        return {"num_pages": 0, "error": f"{type(e).__name__}: {e}"}
+
+
+@dataclass
+class BulkPdfIngestion:
+    """Chunks many PDFs in parallel with a process pool.
+
+    Files are split into shards of `pages_per_shard` pages that are extracted by different processes. Iterating
+    over the instance yields the chunks (dictionaries with the keys "path", "page", "chunk_index" and "text") in
+    the order of `paths` and pages, the same chunks PdfReader.chunk_text would give file by file. Only a window of
+    shards is in flight at once, so memory does not grow with the number of files. The pages of the files are
+    counted by the workers too, a few files ahead of the shards being extracted.
+
+    A file that cannot be read does not stop the batch: its shards are skipped and recorded in `failures`. The
+    counters and `stats` describe the last iteration, even if it was stopped early.
+    """
+
+    paths: list
+    num_characters: int
+    overlap: int
+    max_workers: int = None
+    pages_per_shard: int = 50
+    failures: list = field(default_factory=list)
+    pages: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+
+    def _shards(self, executor: ProcessPoolExecutor, lookahead: int):
+        """Yields (path, start, end) for every shard, in order, while the workers count the pages of the next
+        `lookahead` files."""
+        paths = iter(self.paths)
+        counting = deque((path, executor.submit(_count_pages, path)) for path in itertools.islice(paths, lookahead))
+        try:
+            while counting:
+                path, future = counting.popleft()
+                for next_path in itertools.islice(paths, 1):
+                    counting.append((next_path, executor.submit(_count_pages, next_path)))
+
+                result = future.result()
+                if result["error"] is not None:
+                    self.failures.append({"path": path, "start": 0, "end": None, "error": result["error"]})
+                    logging.error(f"Skipping {path}: {result['error']}")
+                    continue
+
+                num_pages = result["num_pages"]
+                for start in range(0, num_pages, self.pages_per_shard):
+                    yield path, start, min(start + self.pages_per_shard, num_pages)
+        finally:
+            for _, future in counting:
+                future.cancel()
+
+    def __iter__(self):
+        # the counters describe the last run only
+        self.failures = []
+        self.pages = 0
+        self.chunks = 0
+        self.seconds = 0.0
+        start_time = time.perf_counter()
+        max_workers = self.max_workers or os.cpu_count()
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            shards = self._shards(executor, lookahead=max_workers)
+            in_flight = deque()
+            try:
+                for path, start, end in shards:
+                    in_flight.append(
+                        executor.submit(_chunk_shard, path, start, end, self.num_characters, self.overlap)
+                    )
+                    if len(in_flight) >= 2 * max_workers:
+                        yield from self._collect(in_flight.popleft().result())
+
+                while in_flight:
+                    yield from self._collect(in_flight.popleft().result())
+            finally:
+                # if the consumer stopped early, the shards and page counts not started yet are dropped
+                shards.close()
+                for future in in_flight:
+                    future.cancel()
+                self.seconds = time.perf_counter() - start_time
+
+    def _collect(self, shard: dict):
+        if shard["error"] is not None:
+            logging.error(f"Failed pages {shard['start']}-{shard['end']} of {shard['path']}: {shard['error']}")
+            self.failures.append({key: shard[key] for key in ("path", "start", "end", "error")})
+            return
+
+        self.pages += shard["end"] - shard["start"]
+        self.chunks += len(shard["chunks"])
+        yield from shard["chunks"]
+
+    def stats(self) -> dict:
+        """Returns the throughput of the last run: pages and chunks produced, failed shards and pages per second."""
+        return {
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "failures": len(self.failures),
+            "seconds": self.seconds,
+            "pages_per_second": self.pages / self.seconds if self.seconds > 0 else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Chunk every PDF of a folder in parallel.")
+    parser.add_argument("folder", help="Folder with the PDF files")
+    parser.add_argument("--output", default="chunks.jsonl", help="JSONL file where the chunks are written")
+    parser.add_argument("--num_characters", type=int, default=1000)
+    parser.add_argument("--overlap", type=int, default=100)
+    parser.add_argument("--max_workers", type=int, default=None)
+    args = parser.parse_args()
+
+    pdf_paths = sorted(
+        os.path.join(args.folder, file) for file in os.listdir(args.folder) if file.lower().endswith(".pdf")
+    )
+    ingestion = BulkPdfIngestion(pdf_paths, args.num_characters, args.overlap, max_workers=args.max_workers)
+
+    with open(args.output, "w") as f:
+        for chunk in ingestion:
+            f.write(json.dumps(chunk) + "\n")
+
+    print(ingestion.stats())
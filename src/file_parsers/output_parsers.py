@@ -36,3 +36,17 @@ def openai_function_call_response_parser(response: dict) -> tuple:
     token_dict = response["usage"]
         
     return response_dict, token_dict
+
+
+def openai_stream_response_parser(stream) -> tuple:
+    """Function that consumes what is left of a streamed openai response and parses it.
+
+    :param stream: The ChatStream returned by the `stream` methods of the chat wrappers in src.llms.openai_models.
+    :type stream: ChatStream
+    :return: Returns a tuple of single response (str) and the dictionary of token counts.
+    :rtype: tuple
+    """
+    for _ in stream:
+        pass
+
+    return stream.text, stream.usage
@@ -1,24 +1,40 @@
 import logging
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import pypdf
 
 @dataclass
 class PdfReader:
-    """Initialize a PDF reader with pypdf"""
+    """Initialize a PDF reader with pypdf. The text of the last `page_cache_size` pages read is cached, so
+    sequential reads (like chunking with overlap) extract every page once."""
 
     path: str
+    page_cache_size: int = 4
 
     def __post_init__(self, **kwargs):
         reader = pypdf.PdfReader(self.path, **kwargs)
         self.reader = reader
         self.pages = self.reader.pages
+        self._page_cache = OrderedDict()
 
     def __len__(self):
         return len(self.reader.pages)
     
     def __getitem__(self, index):
-        return self.reader.pages[index].extract_text()
+        if index < 0:
+            index += len(self)
+
+        if index in self._page_cache:
+            self._page_cache.move_to_end(index)
+            return self._page_cache[index]
+
+        text = self.reader.pages[index].extract_text()
+        self._page_cache[index] = text
+        if len(self._page_cache) > self.page_cache_size:
+            self._page_cache.popitem(last=False)
+
+        return text
     
     def _collect_text_with_overlap(self, index, overlap):
         num_pages = len(self)
@@ -39,12 +55,25 @@ class PdfReader:
         chunks = self._split_page(text, num_characters=num_characters, overlap=overlap)
         return chunks
     
-    def chunk_text(self, num_characters, overlap):
-        chunks = []
+    def iter_chunks(self, num_characters, overlap):
+        """Yields the chunks of chunk_text one at a time, so only a couple of pages are in memory at once.
+
+        Each chunk is a dictionary with the keys "text", "page" (index of the page it starts on) and 
+        "chunk_index" (position of the chunk within that page).
+        """
         for idx in range(len(self)):
-            chunks += self.chunk_split(idx, num_characters, overlap)
-        
-        return chunks
+            for chunk_index, chunk in enumerate(self.chunk_split(idx, num_characters, overlap)):
+                yield {"text": chunk, "page": idx, "chunk_index": chunk_index}
+
+    def chunk_text(self, num_characters, overlap):
+        return [chunk["text"] for chunk in self.iter_chunks(num_characters, overlap)]
+
+    def iter_token_chunks(self, chunker, batch_size=32):
+        """Streams the document through a TokenChunker (src.file_parsers.token_chunker) as one continuous text, 
+        so chunks have the same number of tokens and may span two pages. The "metadata" and "end_metadata" of 
+        each chunk are {"page": index} of the pages where it starts and ends."""
+        records = ((self[idx], {"page": idx}) for idx in range(len(self)))
+        yield from chunker.iter_chunks(records, batch_size=batch_size)
 
 
 
@@ -27,6 +27,17 @@ class PythonParser:
             else:
                 self.undented_code.append(self.get_code(node))
 
+    def iter_token_chunks(self, chunker, batch_size=32):
+        """Chunks the extracted code with a TokenChunker (src.file_parsers.token_chunker). Every function, method
+        and piece of undented code is chunked on its own; the "metadata" of each chunk says where it comes from.
+        Call extract() first."""
+        records = [(code, {"kind": "function", "name": name}) for name, code in self.functions.items()]
+        for class_name, methods in self.classes.items():
+            records += [(code, {"kind": "method", "name": f"{class_name}.{name}"}) for name, code in methods.items()]
+        records += [(code, {"kind": "undented", "name": None}) for code in self.undented_code]
+
+        yield from chunker.iter_chunks(records, across_records=False, batch_size=batch_size)
+
     def report(self):
         print("Functions:")
         for function, code in self.functions.items():
@@ -0,0 +1,137 @@
+import re
+from bisect import bisect_right
+from itertools import islice
+
+from src.llms.tokens import TokenCounter
+
+
+_BOUNDARY_PATTERNS = {
+    "sentence": re.compile(r"[.!?](?=\s|$)|\n\s*\n"),
+    "paragraph": re.compile(r"\n\s*\n"),
+}
+
+
+class TokenChunker:
+    """Splits text into chunks of exactly `chunk_tokens` tokens, consecutive chunks sharing `overlap_tokens`
+    tokens (the last chunk of a stream may be shorter).
+
+    With `snap_to` set to "sentence" or "paragraph", a chunk ends at the last boundary of that kind found in its
+    second half, so chunks are at most `chunk_tokens` long and rarely cut a sentence.
+
+    Example:
+        chunker = TokenChunker(chunk_tokens=256, overlap_tokens=32)
+        for chunk in pdf_reader.iter_token_chunks(chunker):
+            ...
+
+    Args:
+        chunk_tokens (int, optional): Tokens per chunk. Defaults to 256.
+        overlap_tokens (int, optional): Tokens shared by consecutive chunks. Defaults to 32.
+        model (str, optional): Model whose tokenizer is used. Defaults to "text-embedding-ada-002".
+        snap_to (str, optional): None, "sentence" or "paragraph". Defaults to None.
+    """
+
+    def __init__(
+            self,
+            chunk_tokens: int = 256,
+            overlap_tokens: int = 32,
+            model: str = "text-embedding-ada-002",
+            snap_to: str or None = None
+        ):
+        if not 0 <= overlap_tokens < chunk_tokens:
+            raise ValueError(f"overlap_tokens must be in [0, chunk_tokens). You passed: {overlap_tokens}")
+        if snap_to is not None and snap_to not in _BOUNDARY_PATTERNS:
+            raise ValueError(f"snap_to must be None, 'sentence' or 'paragraph'. You passed: {snap_to}")
+
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.snap_to = snap_to
+        self.counter = TokenCounter(model)
+
+    def split(self, text: str) -> list:
+        """Splits a single text and returns the chunk texts."""
+        return [chunk["text"] for chunk in self.iter_chunks([(text, None)])]
+
+    def iter_chunks(self, records, across_records: bool = True, batch_size: int = 32):
+        """Chunks a stream of texts, encoding them `batch_size` at a time with encode_batch.
+
+        :param records: Iterable of (text, metadata) pairs, e.g. the pages of a PDF with their page number.
+        :type records: iterable
+        :param across_records: If True the texts are chunked as one continuous stream (a chunk may span two pages);
+        if False each text is chunked on its own (for independent pieces, like functions), defaults to True
+        :type across_records: bool, optional
+        :param batch_size: Number of texts encoded at once, defaults to 32
+        :type batch_size: int, optional
+        :return: A generator of dictionaries with the keys "text", "num_tokens", "metadata" (metadata of the
+        text the chunk starts in) and "end_metadata" (metadata of the text it ends in).
+        :rtype: generator
+        """
+        encoded_records = self._encode_records(records, batch_size)
+
+        if across_records:
+            yield from self._chunk_stream(encoded_records)
+        else:
+            for encoded_record in encoded_records:
+                yield from self._chunk_stream([encoded_record])
+
+    def _encode_records(self, records, batch_size: int):
+        records = iter(records)
+        while True:
+            batch = list(islice(records, batch_size))
+            if len(batch) == 0:
+                return
+
+            encoded = self.counter.encode([text for text, _ in batch])
+            for (text, metadata), tokens in zip(batch, encoded):
+                yield tokens, self._boundary_flags(text, tokens), metadata
+
+    def _boundary_flags(self, text: str, tokens: list) -> list:
+        """flags[i] is True when a chunk may end right after token i."""
+        flags = [False] * len(tokens)
+        if self.snap_to is None or len(tokens) == 0:
+            return flags
+
+        _, offsets = self.counter.encoding.decode_with_offsets(tokens)
+        for match in _BOUNDARY_PATTERNS[self.snap_to].finditer(text):
+            # token holding the last character of the boundary
+            flags[max(bisect_right(offsets, match.end() - 1) - 1, 0)] = True
+
+        return flags
+
+    def _chunk_stream(self, encoded_records):
+        tokens, flags, owners = [], [], []
+        start, emitted_until = 0, 0
+
+        for new_tokens, new_flags, metadata in encoded_records:
+            tokens += new_tokens
+            flags += new_flags
+            owners += [metadata] * len(new_tokens)
+
+            while len(tokens) - start >= self.chunk_tokens:
+                end = self._chunk_end(flags, start)
+                yield self._make_chunk(tokens, owners, start, end)
+                emitted_until = end
+                start = max(end - self.overlap_tokens, start + 1)
+
+            # forget the tokens that no future chunk can contain
+            del tokens[:start], flags[:start], owners[:start]
+            emitted_until -= start
+            start = 0
+
+        if len(tokens) > emitted_until:
+            yield self._make_chunk(tokens, owners, start, len(tokens))
+
+    def _chunk_end(self, flags: list, start: int) -> int:
+        limit = start + self.chunk_tokens
+        if self.snap_to is not None:
+            for index in range(limit - 1, start + self.chunk_tokens // 2 - 1, -1):
+                if flags[index]:
+                    return index + 1
+        return limit
+
+    def _make_chunk(self, tokens: list, owners: list, start: int, end: int) -> dict:
+        return {
+            "text": self.counter.encoding.decode(tokens[start:end]),
+            "num_tokens": end - start,
+            "metadata": owners[start],
+            "end_metadata": owners[end - 1],
+        }
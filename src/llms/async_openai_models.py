@@ -0,0 +1,266 @@
+import asyncio
+from typing import List
+
+import openai
+from tenacity import retry, stop_after_attempt, wait_exponential
+
+import sys
+sys.path.append('/workspace/')
+from src.llms.function_calling import FunctionRegistry, function_call_messages, function_calling_kwargs
+from src.llms.function_calling import parse_function_calls
+from src.llms.instrumentation import current_record, tracked
+from src.llms.openai_client import OpenAiClient
+from src.llms.openai_models import log_retry
+from src.llms.rate_limiter import RateLimiter, estimate_chat_tokens, wait_retry_after
+from src.messages.messages import Message, MessageHistory
+
+
+async def gather_with_concurrency(coroutines: list, max_concurrency: int = 8, return_exceptions: bool = False) -> list:
+    """Await `coroutines` with at most `max_concurrency` of them running at once.
+
+    :param coroutines: The coroutines to run. They are started lazily, so creating them is cheap.
+    :type coroutines: list
+    :param max_concurrency: Maximum number of coroutines awaited at the same time, defaults to 8
+    :type max_concurrency: int, optional
+    :param return_exceptions: If True, a failing item returns its exception in its slot. If False, the first
+    failure is raised and the items still waiting or running are cancelled, defaults to False
+    :type return_exceptions: bool, optional
+    :return: The results, in the same order as `coroutines`.
+    :rtype: list
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1. You passed: {max_concurrency}")
+
+    coroutines = list(coroutines)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    tasks = [asyncio.ensure_future(run(coroutine)) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    finally:
+        # after a failure (or if the caller is cancelled) the other requests must not keep spending quota
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        # the coroutines of the tasks cancelled before they started were never awaited
+        for coroutine in coroutines:
+            coroutine.close()
+
+
+async def acreate_chat_completion(
+        create_kwargs: dict,
+        rate_limiter: RateLimiter or None = None,
+        client: OpenAiClient or None = None
+    ):
+    """Call openai.ChatCompletion.acreate, through `rate_limiter` and with the connections of `client` if given."""
+    record = current_record()
+    if record is not None:
+        record.start_attempt()
+
+    if client is None:
+        create_function = lambda: openai.ChatCompletion.acreate(**create_kwargs)
+    else:
+        create_function = lambda: client.call_async(openai.ChatCompletion.acreate, **create_kwargs)
+
+    if rate_limiter is None:
+        response = await create_function()
+    else:
+        response = await rate_limiter.call_async(create_function, estimate_chat_tokens(create_kwargs))
+
+    if record is not None:
+        record.add_usage(response.get("usage"))
+    return response
+
+
+class AsyncOpenAiChat:
+    def __init__(
+            self, 
+            history: MessageHistory, 
+            model: str = "gpt-3.5-turbo-0613", 
+            temperature: float = 0.0, 
+            max_prompt_tokens: int or None = None,
+            rate_limiter: RateLimiter or None = None,
+            client: OpenAiClient or None = None
+        ):
+        self.model = model
+        self.history = history
+        self.temperature = temperature
+        self.max_prompt_tokens = max_prompt_tokens
+        self.rate_limiter = rate_limiter
+        self.client = client
+
+    def _create_kwargs(self, message_history: MessageHistory, temperature: float) -> dict:
+        return {
+            "messages": message_history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
+            "model": self.model,
+            "temperature": temperature,
+        }
+
+    @tracked("chat")
+    async def __call__(self, prompt: str):
+        """Call the OpenAI chat API with the prompt and return the response."""
+        new_message = Message("user", prompt)
+        self.history.add_message(new_message)
+
+        return await acreate_chat_completion(
+            self._create_kwargs(self.history, self.temperature), self.rate_limiter, self.client
+        )
+
+    @tracked("chat")
+    async def predict_on_messages(
+            self,
+            message_history: MessageHistory,
+            temperature: float or None = None,
+            retries: int = 1,
+            base_wait: int = 5
+        ):
+        """Call the OpenAI model on a Message History instead of a message"""
+        if temperature is None:
+            temperature = self.temperature
+
+        return await self._predict(self._create_kwargs(message_history, temperature), retries, base_wait)
+
+    async def _predict(self, create_kwargs: dict, retries: int, base_wait: int):
+        @retry(
+            stop=stop_after_attempt(retries),
+            wait=wait_retry_after(wait_exponential(multiplier=base_wait, max=20)),
+            before_sleep=log_retry,
+        )
+        async def predict():
+            return await acreate_chat_completion(create_kwargs, self.rate_limiter, self.client)
+
+        return await predict()
+
+    async def batch(
+            self,
+            histories: List[MessageHistory],
+            temperature: float or None = None,
+            max_concurrency: int = 8,
+            retries: int = 5,
+            base_wait: int = 5,
+            return_exceptions: bool = False,
+        ) -> list:
+        """Run predict_on_messages on many independent histories concurrently.
+
+        :param histories: The message histories to send. None of them is modified.
+        :type histories: List[MessageHistory]
+        :param temperature: Overrides the instance temperature, defaults to None
+        :type temperature: float or None, optional
+        :param max_concurrency: Maximum number of requests in flight at the same time, defaults to 8
+        :type max_concurrency: int, optional
+        :param retries: Attempts per history before giving up on it, defaults to 5
+        :type retries: int, optional
+        :param base_wait: Multiplier of the exponential wait between attempts, defaults to 5
+        :type base_wait: int, optional
+        :param return_exceptions: If True, a history that exhausts its retries returns the exception in its slot.
+        If False, its exception is raised and the requests still waiting or in flight are cancelled, defaults to
+        False
+        :type return_exceptions: bool, optional
+        :return: The responses, in the same order as `histories`.
+        :rtype: list
+        """
+        coroutines = [
+            self.predict_on_messages(history, temperature=temperature, retries=retries, base_wait=base_wait)
+            for history in histories
+        ]
+        if self.client is None:
+            return await gather_with_concurrency(coroutines, max_concurrency, return_exceptions)
+
+        # one pool of connections for the whole batch
+        async with self.client.async_session():
+            return await gather_with_concurrency(coroutines, max_concurrency, return_exceptions)
+
+
+class AsyncOpenAiChatWithRetries(AsyncOpenAiChat):
+    @tracked("chat")
+    async def __call__(self, prompt: str, temperature: float or None = None, retries: int = 5, base_wait: int = 5):
+        """Call the OpenAI chat API with the prompt and return the response."""
+        if isinstance(prompt, str):
+            new_message = Message("user", prompt)
+        elif isinstance(prompt, Message):
+            new_message = prompt
+        else:
+            raise TypeError(f"Prompt must be of the type str or Message. You passed: {type(prompt)}")
+
+        self.history.add_message(new_message)
+
+        return await self.predict_on_messages(self.history, temperature=temperature, retries=retries, base_wait=base_wait)
+
+
+class AsyncOpenAiChatWithFunctionCallingAndRetries(AsyncOpenAiChatWithRetries):
+    def __init__(
+            self,
+            history: MessageHistory,
+            functions: list,
+            function_call: str = "auto",
+            model: str = "gpt-3.5-turbo-0613",
+            temperature: float = 0.0,
+            max_prompt_tokens: int or None = None,
+            rate_limiter: RateLimiter or None = None,
+            client: OpenAiClient or None = None
+        ):
+        super().__init__(
+            history,
+            model=model,
+            temperature=temperature,
+            max_prompt_tokens=max_prompt_tokens,
+            rate_limiter=rate_limiter,
+            client=client,
+        )
+        self.functions = functions
+        self.function_call = function_call
+
+    def _create_kwargs(self, message_history: MessageHistory, temperature: float) -> dict:
+        create_kwargs = super()._create_kwargs(message_history, temperature)
+        create_kwargs["functions"] = self.functions
+        create_kwargs["function_call"] = self.function_call
+        return create_kwargs
+
+    async def call_with_functions(
+            self,
+            prompt: str or Message or None,
+            registry: FunctionRegistry,
+            max_rounds: int = 5,
+            use_tools: bool = False,
+            temperature: float or None = None,
+            retries: int = 5,
+            base_wait: int = 5
+        ):
+        """Same as OpenAiChatWithFunctionCallingAndRetries.call_with_functions, running the calls with
+        registry.acall_many."""
+        if isinstance(prompt, str):
+            self.history.add_message(Message("user", prompt))
+        elif isinstance(prompt, Message):
+            self.history.add_message(prompt)
+        elif prompt is not None:
+            raise TypeError(f"Prompt must be of the type str, Message or None. You passed: {type(prompt)}")
+
+        if temperature is None:
+            temperature = self.temperature
+
+        functions = self.functions or registry.definitions
+        function_call = self.function_call
+        for round_number in range(max_rounds + 1):
+            if round_number == max_rounds:
+                function_call = "none"
+
+            create_kwargs = AsyncOpenAiChat._create_kwargs(self, self.history, temperature)
+            create_kwargs.update(function_calling_kwargs(functions, function_call, use_tools))
+            response = await self._predict(create_kwargs, retries, base_wait)
+
+            message = response["choices"][0]["message"]
+            calls = parse_function_calls(message)
+            if not calls or round_number == max_rounds:
+                return response
+
+            results = await registry.acall_many(calls)
+            for new_message in function_call_messages(message, calls, results):
+                self.history.add_message(new_message)
+            # a function forced by name is only forced in the first round
+            function_call = "auto"
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+import sys
+sys.path.append('/workspace/')
+from src.messages.messages import Message, MessageHistory
+
+
+def read_jsonl(path: str):
+    """Yields (line number, item) for every non-empty line of a JSONL file."""
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            if line.strip():
+                yield line_number, json.loads(line)
+
+
+def load_checkpoint(output_path: str) -> dict:
+    """Reads the results already written to `output_path` and returns the last one of each id.
+
+    A line cut short by a crash is removed from the file, so the next results are appended after a complete line.
+    """
+    results = {}
+    if not os.path.exists(output_path):
+        return results
+
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            logging.error(f"Dropping an incomplete last line of {output_path}")
+            f.truncate(complete)
+
+    for line in data[:complete].decode("utf-8").splitlines():
+        if line.strip():
+            result = json.loads(line)
+            results[result["id"]] = result
+    return results
+
+
+@dataclass
+class BatchJob:
+    """Runs every prompt of a JSONL file through a chat (e.g. OpenAiChatWithRetries) with bounded concurrency and
+    appends one JSON result per line to `output_path` as soon as each request finishes.
+
+    Each input line is an object with an optional "id" (defaults to the line number) and one of:
+        "prompt": the user message.
+        "variables": the values of the placeholders of `template`, e.g. of prepend_message.
+        "messages": a full list of {"role", "content"} messages.
+    An optional "system" replaces `system_message` for that item, and "metadata" is copied to the result.
+
+    The output file is the checkpoint: running the job again skips the ids that already have a successful result,
+    and retries the failed ones (their last line is the one that counts). A failure does not stop the job; it is
+    written with its "error".
+
+    Args:
+        chat: The chat used for the requests (its model, temperature, rate limiter and client).
+        input_path (str): JSONL file with the prompts.
+        output_path (str): JSONL file where the results are appended.
+        system_message (str, optional): System message of every item. Defaults to None (no system message).
+        template (str, optional): Format string for the items with "variables". Defaults to None.
+        max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 8.
+        retries (int, optional): Attempts per item before recording it as failed. Defaults to 5.
+        base_wait (int, optional): Multiplier of the exponential wait between attempts. Defaults to 5.
+        fsync_every (int, optional): fsync the output after this many results. Defaults to 100.
+        progress_every (int, optional): Log the progress after this many results. Defaults to 1000.
+    """
+
+    chat: object
+    input_path: str
+    output_path: str
+    system_message: str = None
+    template: str = None
+    max_concurrency: int = 8
+    retries: int = 5
+    base_wait: int = 5
+    fsync_every: int = 100
+    progress_every: int = 1000
+    failures: list = field(default_factory=list)
+    skipped: int = 0
+    succeeded: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    seconds: float = 0.0
+
+    def __post_init__(self):
+        if self.max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1. You passed: {self.max_concurrency}")
+
+    def build_history(self, item: dict) -> MessageHistory:
+        """Builds the messages sent for an input item."""
+        history = MessageHistory(has_sys_msg=False)
+        system_message = item.get("system", self.system_message)
+        if system_message:
+            history.add_message(Message("system", system_message))
+
+        if "messages" in item:
+            for message in item["messages"]:
+                history.add_message(Message(message["role"], message["content"]))
+        elif "prompt" in item:
+            history.add_message(Message("user", item["prompt"]))
+        elif "variables" in item:
+            if self.template is None:
+                raise ValueError("The item has 'variables' but the job has no template")
+            history.add_message(Message("user", self.template.format(**item["variables"])))
+        else:
+            raise ValueError(f"Items need a 'prompt', 'variables' or 'messages'. Keys of the item: {sorted(item)}")
+
+        return history
+
+    async def _run_item(self, async_chat, item_id: str, item: dict) -> dict:
+        start = time.perf_counter()
+        result = {"id": item_id}
+        if "metadata" in item:
+            result["metadata"] = item["metadata"]
+
+        try:
+            history = self.build_history(item)
+            response = await async_chat.predict_on_messages(history, retries=self.retries, base_wait=self.base_wait)
+            choice = response["choices"][0]
+            result["content"] = choice["message"].get("content")
+            if choice["message"].get("function_call") is not None:
+                result["function_call"] = dict(choice["message"]["function_call"])
+            result["finish_reason"] = choice.get("finish_reason")
+            result["usage"] = dict(response.get("usage") or {})
+        except Exception as e:
+            # tenacity wraps the last error of an item that exhausted its retries
+            error = e.last_attempt.exception() if hasattr(e, "last_attempt") else e
+            result["error"] = f"{type(error).__name__}: {error}"
+
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    def _pending_items(self, done: set):
+        for line_number, item in read_jsonl(self.input_path):
+            item_id = str(item.get("id", line_number))
+            if item_id in done:
+                self.skipped += 1
+                continue
+            yield item_id, item
+
+    def _record(self, result: dict):
+        if "error" in result:
+            logging.error(f"Item {result['id']} failed: {result['error']}")
+            self.failures.append({"id": result["id"], "error": result["error"]})
+            return
+
+        self.succeeded += 1
+        self.prompt_tokens += result["usage"].get("prompt_tokens", 0)
+        self.completion_tokens += result["usage"].get("completion_tokens", 0)
+
+    async def arun(self) -> dict:
+        """Runs the job and returns its stats (see `stats`)."""
+        # the counters describe the last run only, so a job can be run again to resume it
+        self.failures = []
+        self.skipped = 0
+        self.succeeded = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+        start_time = time.perf_counter()
+        done = {item_id for item_id, result in load_checkpoint(self.output_path).items() if "error" not in result}
+        async_chat = self.chat.to_async()
+        client = getattr(self.chat, "client", None)
+
+        with open(self.output_path, "a") as f:
+            written = 0
+
+            def write(result: dict):
+                nonlocal written
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+                self._record(result)
+                written += 1
+                if written % self.fsync_every == 0:
+                    os.fsync(f.fileno())
+                if written % self.progress_every == 0:
+                    self.seconds = time.perf_counter() - start_time
+                    logging.info(f"{written} items done: {self.stats()}")
+
+            async def run_all():
+                # items are read lazily, so only `max_concurrency` of them are in memory at once
+                in_flight = set()
+                try:
+                    for item_id, item in self._pending_items(done):
+                        if len(in_flight) >= self.max_concurrency:
+                            finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                            for task in finished:
+                                write(task.result())
+                        in_flight.add(asyncio.ensure_future(self._run_item(async_chat, item_id, item)))
+
+                    for task in asyncio.as_completed(in_flight):
+                        write(await task)
+                finally:
+                    for task in in_flight:
+                        task.cancel()
+
+            try:
+                if client is None:
+                    await run_all()
+                else:
+                    async with client.async_session():
+                        await run_all()
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+                self.seconds = time.perf_counter() - start_time
+
+        return self.stats()
+
+    def run(self) -> dict:
+        """Blocking version of `arun`."""
+        return asyncio.run(self.arun())
+
+    def stats(self) -> dict:
+        """Returns the results of the last run: items skipped (already done), succeeded and failed, tokens used, and
+        items and tokens per second."""
+        total_tokens = self.prompt_tokens + self.completion_tokens
+        items = self.succeeded + len(self.failures)
+        return {
+            "skipped": self.skipped,
+            "succeeded": self.succeeded,
+            "failed": len(self.failures),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "seconds": self.seconds,
+            "items_per_second": items / self.seconds if self.seconds > 0 else 0.0,
+            "tokens_per_second": total_tokens / self.seconds if self.seconds > 0 else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.llms.openai_client import OpenAiClient
+    from src.llms.openai_models import OpenAiChatWithRetries
+    from src.llms.rate_limiter import RateLimiter
+    from src.messages import base_messages
+
+    parser = argparse.ArgumentParser(description="Run the prompts of a JSONL file, resuming after a previous run.")
+    parser.add_argument("input", help="JSONL file with the prompts")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file where the results are appended")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--system_message", default=None, help="Text, or name of a message of base_messages")
+    parser.add_argument("--template", default=None, help="Text, or name of a message of base_messages")
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--requests_per_minute", type=float, default=None)
+    parser.add_argument("--tokens_per_minute", type=float, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    def message_argument(value: str or None) -> str or None:
+        # e.g. "sys_msg_email" or "prepend_message"
+        if value is not None and value.isidentifier() and hasattr(base_messages, value):
+            return getattr(base_messages, value)
+        return value
+
+    rate_limiter = None
+    if args.requests_per_minute is not None or args.tokens_per_minute is not None:
+        rate_limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+
+    with OpenAiClient() as client:
+        chat = OpenAiChatWithRetries(
+            MessageHistory(), model=args.model, temperature=args.temperature, rate_limiter=rate_limiter, client=client
+        )
+        job = BatchJob(
+            chat,
+            args.input,
+            args.output,
+            system_message=message_argument(args.system_message),
+            template=message_argument(args.template),
+            max_concurrency=args.max_concurrency,
+            retries=args.retries,
+        )
+        print(json.dumps(job.run(), indent=2))
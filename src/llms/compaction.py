@@ -0,0 +1,239 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+import sys
+sys.path.append('/workspace/')
+from src.llms.openai_client import OpenAiClient
+from src.llms.openai_models import OpenAiChatWithRetries
+from src.llms.rate_limiter import RateLimiter
+from src.llms.tokens import TOKENS_PER_REPLY, TokenCounter
+from src.messages.base_messages import summary_context_message, summary_prompt, sys_msg_summary
+from src.messages.messages import Message, MessageHistory, _message_to_dict, _newest_within_budget, _text_lines
+
+
+class ConversationSummarizer:
+    """Summarizes turns of a conversation with a chat model, updating the summary of the turns before them.
+
+    Args:
+        model (str, optional): Model used for the summaries, usually a cheaper one than the chat's. Defaults to
+            "gpt-3.5-turbo".
+        rate_limiter (RateLimiter, optional): Rate limiter of the summary model. Defaults to None.
+        client (OpenAiClient, optional): Pool of API connections. Defaults to None.
+        retries (int, optional): Attempts per summary. Defaults to 3.
+    """
+
+    def __init__(
+            self,
+            model: str = "gpt-3.5-turbo",
+            rate_limiter: RateLimiter or None = None,
+            client: OpenAiClient or None = None,
+            retries: int = 3
+        ):
+        self.model = model
+        self.rate_limiter = rate_limiter
+        self.client = client
+        self.retries = retries
+
+    def __call__(self, previous_summary: str or None, messages: list) -> str:
+        history = MessageHistory()
+        history.add_message(Message("system", sys_msg_summary))
+        chat = OpenAiChatWithRetries(history, model=self.model, rate_limiter=self.rate_limiter, client=self.client)
+
+        prompt = summary_prompt.format(
+            summary=previous_summary or "(none)", conversation="".join(_text_lines(messages))
+        )
+        response = chat(prompt, temperature=0.0, retries=self.retries)
+        return response["choices"][0]["message"]["content"].strip()
+
+
+class RollingCompaction:
+    """Keeps the prompts of a long conversation at a roughly constant size by replacing its oldest turns with a
+    summary, updated as the conversation grows.
+
+    Set it as the `compaction` of a MessageHistory: its to_prompt_list (which the chat classes send) then returns the
+    system message, one system message with the summary and the turns that came after it. Whenever that prompt goes
+    over `threshold_tokens`, the turns before the newest `keep_recent_tokens` are summarized together with the
+    previous summary, by default in a background thread: until the new summary is ready, the prompts use the previous
+    one (and the `max_tokens` budget of to_prompt_list, if any, still applies). The history itself is not changed,
+    so every message is still shown and saved.
+
+    The summary refers to the messages by position, so a compaction belongs to one conversation and must be dropped
+    if messages are removed from it.
+
+    Example:
+        history.compaction = RollingCompaction(ConversationSummarizer("gpt-3.5-turbo"), threshold_tokens=3000)
+        stream = OpenAiChatWithRetries(history, model="gpt-4").stream_on_messages(history)
+
+    Args:
+        summarizer (callable, optional): Called with the previous summary (or None) and the list of Messages to
+            add to it, returns the new summary. Defaults to a ConversationSummarizer with gpt-3.5-turbo.
+        threshold_tokens (int, optional): Prompt tokens above which more turns are summarized. Defaults to 3000.
+        keep_recent_tokens (int, optional): Tokens of the newest turns that are always sent as they are. Defaults
+            to 1000.
+        model (str, optional): Model whose tokenizer is used to count tokens. Defaults to "gpt-3.5-turbo".
+        background (bool, optional): Summarize in a background thread instead of before returning the prompt.
+            Defaults to True.
+    """
+
+    def __init__(
+            self,
+            summarizer=None,
+            threshold_tokens: int = 3000,
+            keep_recent_tokens: int = 1000,
+            model: str = "gpt-3.5-turbo",
+            background: bool = True
+        ):
+        if keep_recent_tokens >= threshold_tokens:
+            raise ValueError(
+                f"keep_recent_tokens ({keep_recent_tokens}) must be lower than threshold_tokens ({threshold_tokens})"
+            )
+        self.summarizer = summarizer if summarizer is not None else ConversationSummarizer()
+        self.threshold_tokens = threshold_tokens
+        self.keep_recent_tokens = keep_recent_tokens
+        self.model = model
+        self.background = background
+        self.summary = None
+        # number of leading messages of the history covered by the summary (system message included)
+        self.summarized_count = 0
+        self._summary_message = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._future = None
+        self.compactions = 0
+        self.failures = 0
+        self.summary_seconds = 0.0
+
+    def _state(self, history: MessageHistory) -> tuple:
+        """The summary, its message and the number of messages it covers, or (None, None, 0) if there is no summary
+        of this history."""
+        with self._lock:
+            if self._summary_message is None or self.summarized_count > len(history.messages):
+                return None, None, 0
+            return self.summary, self._summary_message, self.summarized_count
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+            return self._executor
+
+    def maybe_compact(self, history: MessageHistory) -> bool:
+        """Starts summarizing more turns of `history` if its prompt is over the threshold. Returns whether it did;
+        nothing is started while a previous summary is still running."""
+        with self._lock:
+            if self._future is not None and not self._future.done():
+                return False
+        previous_summary, summary_message, summarized_count = self._state(history)
+
+        counter = TokenCounter(self.model)
+        messages = history.messages
+        num_head = 1 if len(messages) > 0 and messages[0].role == "system" else 0
+        start = max(summarized_count, num_head)
+
+        # the counts are cached on the messages, so only the new ones are encoded
+        head = messages[:num_head] + ([summary_message] if summary_message is not None else [])
+        recent_tokens = [counter.count_message(message) for message in messages[start:]]
+        head_tokens = sum(counter.count_message(message) for message in head)
+        if TOKENS_PER_REPLY + head_tokens + sum(recent_tokens) <= self.threshold_tokens or len(recent_tokens) < 2:
+            return False
+
+        # the newest turns are kept as they are; the last message always is
+        cut, kept = len(messages) - 1, recent_tokens[-1]
+        while cut > start and kept + recent_tokens[cut - 1 - start] <= self.keep_recent_tokens:
+            cut -= 1
+            kept += recent_tokens[cut - start]
+        # keep whole turns: the kept messages start with a question
+        while cut > start and messages[cut].role != "user":
+            cut -= 1
+        if cut <= start:
+            return False
+
+        turns = messages[start:cut]
+        if not self.background:
+            self._compact(previous_summary, turns, cut)
+            return True
+
+        future = self._get_executor().submit(self._compact, previous_summary, turns, cut)
+        with self._lock:
+            self._future = future
+        return True
+
+    def _compact(self, previous_summary: str or None, turns: list, summarized_count: int):
+        start_time = time.perf_counter()
+        try:
+            summary = self.summarizer(previous_summary, turns)
+        except Exception as e:
+            # tenacity wraps the last error of a summary that exhausted its retries
+            error = e.last_attempt.exception() if hasattr(e, "last_attempt") else e
+            logging.error(f"Could not summarize {len(turns)} messages: {type(error).__name__}: {error}")
+            with self._lock:
+                self.failures += 1
+            return
+
+        with self._lock:
+            self.summary = summary
+            self._summary_message = Message("system", summary_context_message.format(summary=summary))
+            self.summarized_count = summarized_count
+            self.compactions += 1
+            self.summary_seconds += time.perf_counter() - start_time
+
+    def prompt_list(self, history: MessageHistory, max_tokens: int = None, model: str = "gpt-3.5-turbo") -> list:
+        """Returns the messages to send for `history` (see MessageHistory.to_prompt_list) and starts a new summary
+        if they are over the threshold."""
+        self.maybe_compact(history)
+
+        _, summary_message, summarized_count = self._state(history)
+        if summary_message is None:
+            return history.to_list(max_tokens, model)
+
+        messages = history.messages
+        num_head = 1 if len(messages) > 0 and messages[0].role == "system" else 0
+        start = max(summarized_count, num_head)
+        serialized = history._serialized_messages()
+        head = serialized[:num_head] + [_message_to_dict(summary_message)]
+        if max_tokens is None:
+            return head + serialized[start:]
+
+        # only the turns after the summary are copied, which stay around the threshold
+        prompt = messages[:num_head] + [summary_message] + messages[start:]
+        prompt_start = _newest_within_budget(prompt, len(head), max_tokens, model)
+        return head + serialized[start + prompt_start - len(head):]
+
+    def wait(self, timeout: float or None = None) -> bool:
+        """Waits for the running summary, if any. Returns False if it was still running after `timeout` seconds."""
+        with self._lock:
+            future = self._future
+        if future is None:
+            return True
+        try:
+            future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            return False
+        return True
+
+    def stats(self) -> dict:
+        """Returns the summaries made and failed, the messages they cover, the seconds spent making them and
+        whether one is running."""
+        with self._lock:
+            return {
+                "compactions": self.compactions,
+                "failures": self.failures,
+                "summarized_messages": self.summarized_count,
+                "summary_seconds": self.summary_seconds,
+                "running": self._future is not None and not self._future.done(),
+            }
+
+    def close(self):
+        """Stops the background thread, without waiting for a running summary."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import List
+
+from src.utils.lazy_imports import lazy_import
+
+np = lazy_import("numpy")
+
+
+def normalize_text(text: str) -> str:
+    """The text that is actually sent to the embeddings endpoint (OpenAiEmbeddings replaces newlines)."""
+    return text.replace("\n", " ")
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class _ModelStore:
+    """Embeddings of a single model: a raw float32 matrix on disk (vectors.f32), the text hash of each row in
+    keys.txt and the dimension in meta.json. Both files are append-only; rows are written before their keys,
+    so a crash can only leave rows without a key, which are ignored."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.meta_path = os.path.join(directory, "meta.json")
+        os.makedirs(directory, exist_ok=True)
+
+        self.dim = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+
+        self.rows = {}
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path) as f:
+                for line in f:
+                    key = line.strip()
+                    if len(key) == 64:  # skip a partial last line
+                        self.rows.setdefault(key, len(self.rows))
+
+        self._vectors = None
+
+    def _matrix(self) -> np.ndarray:
+        if self._vectors is None:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+        return self._vectors
+
+    def read(self, keys: List[str]) -> np.ndarray:
+        rows = [self.rows[key] for key in keys]
+        return np.array(self._matrix()[rows], dtype=np.float32)
+
+    def append(self, keys: List[str], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self.meta_path, "w") as f:
+                json.dump({"dim": self.dim}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of dimension {self.dim}, got {vectors.shape[1]}")
+
+        # drop rows left by an interrupted append, so that row i of the file is the i-th key
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(len(self.rows) * self.dim * 4)
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(self.keys_path, "a") as f:
+            f.write("".join(key + "\n" for key in keys))
+
+        for key in keys:
+            self.rows[key] = len(self.rows)
+        self._vectors = None
+
+
+class EmbeddingCache:
+    """Content-addressed cache of embeddings, keyed on (model, hash of the normalized text).
+
+    Vectors are stored as raw float32 rows, one append-only matrix per model, so a cached corpus takes 4 bytes
+    per dimension and is read back without parsing.
+
+    Args:
+        cache_dir (str, optional): Directory of the cache. Defaults to "data/embedding_cache".
+    """
+
+    def __init__(self, cache_dir: str = "data/embedding_cache"):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def _store(self, model: str) -> _ModelStore:
+        if model not in self._stores:
+            self._stores[model] = _ModelStore(os.path.join(self.cache_dir, re.sub(r"[^\w.-]", "_", model)))
+        return self._stores[model]
+
+    def get_many(self, model: str, texts: List[str]) -> dict:
+        """Looks up the embeddings of `texts`.
+
+        :param model: Embedding model.
+        :type model: str
+        :param texts: Texts to look up. Duplicates are looked up once.
+        :type texts: List[str]
+        :return: A dictionary from text hash to float32 vector, with only the texts that are cached.
+        :rtype: dict
+        """
+        keys = list(dict.fromkeys(text_hash(text) for text in texts))
+        with self._lock:
+            store = self._store(model)
+            found = [key for key in keys if key in store.rows]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            if len(found) == 0:
+                return {}
+            vectors = store.read(found)
+
+        return dict(zip(found, vectors))
+
+    def put_many(self, model: str, texts: List[str], vectors: np.ndarray):
+        """Stores the embeddings of `texts` (row i of `vectors` is the embedding of texts[i])."""
+        with self._lock:
+            store = self._store(model)
+            new_keys, new_rows = {}, []
+            for row, text in enumerate(texts):
+                key = text_hash(text)
+                if key not in store.rows and key not in new_keys:
+                    new_keys[key] = row
+                    new_rows.append(row)
+
+            if len(new_keys) > 0:
+                store.append(list(new_keys), np.asarray(vectors, dtype=np.float32)[new_rows])
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(store.rows) for store in self._stores.values())
@@ -0,0 +1,339 @@
+import asyncio
+import concurrent.futures
+import inspect
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from src.messages.messages import Message
+
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", list: "array", dict: "object"}
+
+
+def function_definition(function, name: str or None = None, description: str or None = None) -> dict:
+    """Builds the OpenAI definition of `function` from its signature and docstring.
+
+    Parameters annotated with str, int, float, bool, list or dict get that JSON type (anything else is a string),
+    and they are required unless they have a default. The description defaults to the first paragraph of the
+    docstring.
+    """
+    properties, required = {}, []
+    for parameter in inspect.signature(function).parameters.values():
+        if parameter.kind in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD):
+            continue
+        properties[parameter.name] = {"type": _JSON_TYPES.get(parameter.annotation, "string")}
+        if parameter.default is inspect.Parameter.empty:
+            required.append(parameter.name)
+
+    if description is None:
+        description = (inspect.getdoc(function) or "").split("\n\n")[0]
+
+    return {
+        "name": name or function.__name__,
+        "description": description,
+        "parameters": {"type": "object", "properties": properties, "required": required},
+    }
+
+
+def function_calling_kwargs(functions: list, function_call: str or dict, use_tools: bool = False) -> dict:
+    """The create arguments that offer `functions` to the model: "functions" and "function_call", or with
+    `use_tools` their "tools" and "tool_choice" equivalents, which let the model ask for several calls at once."""
+    if not use_tools:
+        return {"functions": functions, "function_call": function_call}
+
+    if isinstance(function_call, dict):
+        function_call = {"type": "function", "function": {"name": function_call["name"]}}
+    tools = [{"type": "function", "function": function} for function in functions]
+    return {"tools": tools, "tool_choice": function_call}
+
+
+def parse_function_calls(message: dict) -> list:
+    """Returns the calls an assistant message asks for, as dictionaries with the keys "id" (None for a
+    function_call), "name" and "arguments" (a JSON string). The list is empty if the message is a plain answer."""
+    if message.get("tool_calls"):
+        return [
+            {"id": call["id"], "name": call["function"]["name"], "arguments": call["function"]["arguments"]}
+            for call in message["tool_calls"]
+        ]
+
+    function_call = message.get("function_call")
+    if function_call:
+        return [{"id": None, "name": function_call["name"], "arguments": function_call["arguments"]}]
+
+    return []
+
+
+def function_call_messages(message: dict, calls: list, results: list) -> list:
+    """The messages a round of calls adds to the history: the assistant message that asked for `calls`, and the
+    result of each call in a "tool" message (answering its id) or a "function" message."""
+    # plain dictionaries, so the history can be saved as JSON
+    if message.get("tool_calls"):
+        tool_calls = json.loads(json.dumps(message["tool_calls"]))
+        messages = [Message("assistant", message.get("content"), tool_calls=tool_calls)]
+        messages += [Message("tool", result, tool_call_id=call["id"]) for call, result in zip(calls, results)]
+    else:
+        function_call = json.loads(json.dumps(message["function_call"]))
+        messages = [Message("assistant", message.get("content"), function_call=function_call)]
+        messages += [Message("function", result, name=call["name"]) for call, result in zip(calls, results)]
+    return messages
+
+
+def _error_result(message: str) -> str:
+    return json.dumps({"error": message})
+
+
+def _format_result(value) -> str:
+    return value if isinstance(value, str) else json.dumps(value, default=str)
+
+
+@dataclass
+class RegisteredFunction:
+    function: object
+    definition: dict
+    timeout: float or None = None
+    idempotent: bool = False
+
+
+class FunctionRegistry:
+    """Functions the model can call, and how to run the calls it asks for.
+
+    The calls of a round run concurrently on a thread pool (coroutine functions run on an event loop), each one
+    with its own timeout. The results of idempotent functions are cached by name and arguments. A call that
+    fails, times out or names an unknown function does not raise: its result is {"error": "..."}, which is sent
+    back to the model like any other result.
+
+    A call that times out keeps running in its thread (Python threads cannot be stopped), so functions that may
+    hang should have their own timeouts too.
+
+    Example:
+        registry = FunctionRegistry()
+
+        @registry.register(description="Returns the current weather of a city.", idempotent=True, timeout=5)
+        def get_weather(city: str, unit: str = "celsius"):
+            ...
+
+        chat = OpenAiChatWithFunctionCallingAndRetries(history, registry.definitions)
+        response = chat.call_with_functions("What's the weather in Paris?", registry)
+
+    Args:
+        default_timeout (float, optional): Seconds a call may take when its function has no timeout. Defaults to
+            30. None means no limit.
+        max_workers (int, optional): Threads that run calls at the same time. Defaults to 8.
+        cache_size (int, optional): Results of idempotent functions kept. Defaults to 256.
+    """
+
+    def __init__(self, default_timeout: float or None = 30.0, max_workers: int = 8, cache_size: int = 256):
+        self.functions = {}
+        self.default_timeout = default_timeout
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def register(
+            self,
+            function=None,
+            name: str or None = None,
+            description: str or None = None,
+            parameters: dict or None = None,
+            timeout: float or None = None,
+            idempotent: bool = False
+        ):
+        """Registers a function, directly or as a decorator (with or without arguments).
+
+        :param function: The function. It is called with the arguments the model gives as keyword arguments, and
+        its result is sent to the model as is if it is a string, or as JSON otherwise.
+        :type function: callable
+        :param name: Name the model uses, defaults to the name of the function
+        :type name: str, optional
+        :param description: Description for the model, defaults to the first paragraph of the docstring
+        :type description: str, optional
+        :param parameters: JSON schema of the arguments, defaults to one built from the signature
+        :type parameters: dict, optional
+        :param timeout: Seconds a call may take, defaults to the registry's default_timeout
+        :type timeout: float, optional
+        :param idempotent: Whether calls with the same arguments always give the same result, so it can be
+        cached, defaults to False
+        :type idempotent: bool, optional
+        """
+        if function is None:
+            return lambda function: self.register(function, name, description, parameters, timeout, idempotent)
+
+        definition = function_definition(function, name, description)
+        if parameters is not None:
+            definition["parameters"] = parameters
+        if definition["name"] in self.functions:
+            raise ValueError(f"A function named {definition['name']} is already registered")
+
+        self.functions[definition["name"]] = RegisteredFunction(function, definition, timeout, idempotent)
+        return function
+
+    @property
+    def definitions(self) -> list:
+        """The definitions of the registered functions, for the `functions` argument of the chat classes."""
+        return [registered.definition for registered in self.functions.values()]
+
+    def _timeout(self, registered: RegisteredFunction) -> float or None:
+        return registered.timeout if registered.timeout is not None else self.default_timeout
+
+    def _prepare(self, call: dict) -> tuple:
+        """Returns the registered function, the arguments and the cache key (None if not cached) of a call, or
+        raises ValueError if the model asked for something that cannot be called."""
+        registered = self.functions.get(call["name"])
+        if registered is None:
+            raise ValueError(f"Unknown function {call['name']}. Available functions: {sorted(self.functions)}")
+
+        try:
+            arguments = json.loads(call["arguments"] or "{}")
+        except json.JSONDecodeError as e:
+            raise ValueError(f"The arguments of {call['name']} are not valid JSON: {e}")
+        if not isinstance(arguments, dict):
+            raise ValueError(f"The arguments of {call['name']} must be a JSON object")
+
+        key = call["name"] + json.dumps(arguments, sort_keys=True) if registered.idempotent else None
+        return registered, arguments, key
+
+    def _cached(self, key: str or None) -> str or None:
+        if key is None:
+            return None
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            return result
+
+    def _remember(self, key: str or None, result: str):
+        if key is None:
+            return
+        with self._lock:
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _failed(self, name: str, error: Exception) -> str:
+        with self._lock:
+            self.errors += 1
+        logging.error(f"Function {name} failed: {error}")
+        return _error_result(f"{type(error).__name__}: {error}")
+
+    def _timed_out(self, name: str, timeout: float) -> str:
+        with self._lock:
+            self.timeouts += 1
+        logging.error(f"Function {name} timed out after {timeout} seconds")
+        return _error_result(f"{name} timed out after {timeout} seconds")
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="function_call"
+                )
+            return self._executor
+
+    def call_many(self, calls: list) -> list:
+        """Runs `calls` (as returned by parse_function_calls) concurrently and returns their results, in order."""
+        results = [None] * len(calls)
+        pending = []
+        for index, call in enumerate(calls):
+            with self._lock:
+                self.calls += 1
+            try:
+                registered, arguments, key = self._prepare(call)
+            except ValueError as e:
+                results[index] = self._failed(call["name"], e)
+                continue
+
+            results[index] = self._cached(key)
+            if results[index] is None:
+                function = registered.function
+                if inspect.iscoroutinefunction(function):
+                    future = self._get_executor().submit(lambda f=function, a=arguments: asyncio.run(f(**a)))
+                else:
+                    future = self._get_executor().submit(function, **arguments)
+                pending.append((index, call["name"], registered, key, time.perf_counter(), future))
+
+        # every call has its own deadline, counted from when it was submitted
+        for index, name, registered, key, submitted, future in pending:
+            timeout = self._timeout(registered)
+            remaining = None if timeout is None else max(0.0, submitted + timeout - time.perf_counter())
+            try:
+                results[index] = _format_result(future.result(timeout=remaining))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                results[index] = self._timed_out(name, timeout)
+                continue
+            except Exception as e:
+                results[index] = self._failed(name, e)
+                continue
+            self._remember(key, results[index])
+
+        return results
+
+    async def acall_many(self, calls: list) -> list:
+        """Same as call_many, from an event loop: coroutine functions run on it, the others on the thread pool."""
+        loop = asyncio.get_running_loop()
+
+        async def run(call: dict) -> str:
+            with self._lock:
+                self.calls += 1
+            try:
+                registered, arguments, key = self._prepare(call)
+            except ValueError as e:
+                return self._failed(call["name"], e)
+
+            cached = self._cached(key)
+            if cached is not None:
+                return cached
+
+            function = registered.function
+            if inspect.iscoroutinefunction(function):
+                awaitable = function(**arguments)
+            else:
+                awaitable = loop.run_in_executor(self._get_executor(), lambda: function(**arguments))
+
+            timeout = self._timeout(registered)
+            try:
+                result = _format_result(await asyncio.wait_for(awaitable, timeout))
+            except asyncio.TimeoutError:
+                return self._timed_out(call["name"], timeout)
+            except Exception as e:
+                return self._failed(call["name"], e)
+            self._remember(key, result)
+            return result
+
+        return await asyncio.gather(*(run(call) for call in calls))
+
+    def stats(self) -> dict:
+        """Returns the calls run, the ones answered by the cache, failed or timed out, and the cached results."""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "cache_hits": self.cache_hits,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "cached_results": len(self._cache),
+            }
+
+    def close(self):
+        """Stops the thread pool, without waiting for calls that timed out."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,314 @@
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+
+@dataclass
+class CallRecord:
+    """Measurements of one call to a wrapper of openai_models (retries included).
+
+    `attempts` counts the requests actually sent to the API, so a call answered by a cache has 0 attempts and
+    `cache_hit` True. `cache_hit` is None when the wrapper has no cache. Token counts are the ones billed: the
+    "usage" of every successful attempt.
+    """
+
+    operation: str
+    model: str
+    started_at: float = field(default_factory=time.time)
+    seconds: float = 0.0
+    time_to_first_token: float or None = None
+    retry_wait_seconds: float = 0.0
+    rate_limit_wait_seconds: float = 0.0
+    attempts: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hit: bool or None = None
+    error: str or None = None
+    _start: float = field(default_factory=time.perf_counter, repr=False)
+    # set on the records of the blocks tracked with finish=False until they are reported
+    _deferred: bool = field(default=False, repr=False)
+
+    def start_attempt(self):
+        self.attempts += 1
+        self.cache_hit = False
+
+    def add_usage(self, usage: dict or None):
+        if usage is not None:
+            self.prompt_tokens += usage.get("prompt_tokens", 0)
+            self.completion_tokens += usage.get("completion_tokens", 0)
+
+    def mark_first_token(self):
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        record = asdict(self)
+        del record["_start"]
+        del record["_deferred"]
+        return record
+
+
+_current_record = contextvars.ContextVar("current_openai_call_record", default=None)
+
+
+def current_record() -> CallRecord or None:
+    """The record of the wrapper call running in this thread or task, or None if instrumentation is disabled."""
+    return _current_record.get()
+
+
+class Instrumentation:
+    """Collects a CallRecord per wrapper call and hands it to the registered callbacks.
+
+    Instrumentation is disabled while there are no callbacks: wrappers then create no records and the only cost
+    is one check per call.
+
+    Example:
+        from src.llms.instrumentation import JsonlExporter, PrometheusExporter, instrumentation
+
+        prometheus = PrometheusExporter()
+        instrumentation.add_callback(prometheus)
+        instrumentation.add_callback(JsonlExporter("data/openai_calls.jsonl"))
+        instrumentation.add_callback(lambda record: print(record.seconds))
+        ...
+        prometheus.write("metrics/openai.prom")
+    """
+
+    def __init__(self):
+        self._callbacks = ()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return len(self._callbacks) > 0
+
+    def add_callback(self, callback):
+        """Registers `callback`, a function that takes a CallRecord, called once per finished call."""
+        with self._lock:
+            self._callbacks = self._callbacks + (callback,)
+
+    def remove_callback(self, callback):
+        with self._lock:
+            self._callbacks = tuple(registered for registered in self._callbacks if registered is not callback)
+
+    @contextlib.contextmanager
+    def track(self, operation: str, model: str, finish: bool = True):
+        """Records the call run inside the block. Yields the CallRecord, or None if instrumentation is disabled.
+
+        :param operation: Name of the call, e.g. "chat" or "embedding".
+        :type operation: str
+        :param model: Model of the call.
+        :type model: str
+        :param finish: If False the record is not reported when the block ends (unless it raises): the caller
+        reports it with `finish_deferred` later, e.g. when a stream is exhausted. Defaults to True
+        :type finish: bool, optional
+
+        Inside another tracked block, the outer record is yielded and nothing new is reported: the outer block
+        reports it, and `finish_deferred` leaves it alone.
+        """
+        if not self._callbacks:
+            yield None
+            return
+
+        outer_record = _current_record.get()
+        if outer_record is not None:
+            # a wrapper called by another one: its work is part of the outer call
+            yield outer_record
+            return
+
+        record = CallRecord(operation, model, _deferred=not finish)
+        token = _current_record.set(record)
+        try:
+            yield record
+        except BaseException as e:
+            record.error = f"{type(e).__name__}: {e}"
+            finish = True
+            raise
+        finally:
+            _current_record.reset(token)
+            if finish:
+                record._deferred = False
+                self.finish(record)
+
+    def finish_deferred(self, record: CallRecord):
+        """Reports a record created by a block tracked with finish=False, once. Records of outer calls (yielded by
+        a nested block) and records already reported are left alone."""
+        if record._deferred:
+            record._deferred = False
+            self.finish(record)
+
+    def finish(self, record: CallRecord):
+        """Stops the clock of `record` and reports it to the callbacks. A failing callback is logged and skipped."""
+        record.seconds = time.perf_counter() - record._start
+        for callback in self._callbacks:
+            try:
+                callback(record)
+            except Exception as e:
+                logging.error(f"Instrumentation callback {callback} failed: {e}")
+
+
+instrumentation = Instrumentation()
+
+
+def tracked(operation: str):
+    """Decorator that tracks each call of a wrapper method (sync or async) as `operation`, with the `model` of the
+    instance. If the instance has a cache, the call counts as a cache hit unless it reaches the API."""
+    def decorator(method):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                if not instrumentation.enabled:
+                    return await method(self, *args, **kwargs)
+                with instrumentation.track(operation, self.model) as record:
+                    if getattr(self, "cache", None) is not None and record.attempts == 0:
+                        record.cache_hit = True
+                    return await method(self, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not instrumentation.enabled:
+                return method(self, *args, **kwargs)
+            with instrumentation.track(operation, self.model) as record:
+                if getattr(self, "cache", None) is not None and record.attempts == 0:
+                    record.cache_hit = True
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class JsonlExporter:
+    """Callback that appends every record to a JSONL file, one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __call__(self, record: CallRecord):
+        line = json.dumps(record.to_dict()) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # buckets are cumulative, as the exposition format expects
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class PrometheusExporter:
+    """Callback that aggregates the records into counters and histograms per operation and model, and renders
+    them in the Prometheus text exposition format (e.g. for the textfile collector of node_exporter).
+
+    Args:
+        namespace (str, optional): Prefix of the metric names. Defaults to "chachibt_openai".
+        buckets (tuple, optional): Upper bounds, in seconds, of the latency histograms. Defaults to DEFAULT_BUCKETS.
+    """
+
+    _COUNTERS = [
+        ("calls_total", "Calls to the OpenAI wrappers."),
+        ("errors_total", "Calls that raised an error."),
+        ("cache_hits_total", "Calls answered by a cache."),
+        ("attempts_total", "Requests sent to the API, retries included."),
+        ("prompt_tokens_total", "Prompt tokens billed."),
+        ("completion_tokens_total", "Completion tokens billed."),
+        ("retry_wait_seconds_total", "Seconds spent waiting between retries."),
+        ("rate_limit_wait_seconds_total", "Seconds spent waiting for the client-side rate limiter."),
+    ]
+
+    _HISTOGRAMS = [
+        ("call_duration_seconds", "Duration of the calls, retries and waits included."),
+        ("time_to_first_token_seconds", "Time until the first token of streamed calls."),
+    ]
+
+    def __init__(self, namespace: str = "chachibt_openai", buckets: tuple = DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+        self._counters = {name: {} for name, _ in self._COUNTERS}
+        self._histograms = {name: {} for name, _ in self._HISTOGRAMS}
+        self._lock = threading.Lock()
+
+    def __call__(self, record: CallRecord):
+        labels = (record.operation, record.model)
+        values = {
+            "calls_total": 1,
+            "errors_total": int(record.error is not None),
+            "cache_hits_total": int(bool(record.cache_hit)),
+            "attempts_total": record.attempts,
+            "prompt_tokens_total": record.prompt_tokens,
+            "completion_tokens_total": record.completion_tokens,
+            "retry_wait_seconds_total": record.retry_wait_seconds,
+            "rate_limit_wait_seconds_total": record.rate_limit_wait_seconds,
+        }
+        with self._lock:
+            for name, value in values.items():
+                self._counters[name][labels] = self._counters[name].get(labels, 0) + value
+            self._observe("call_duration_seconds", labels, record.seconds)
+            if record.time_to_first_token is not None:
+                self._observe("time_to_first_token_seconds", labels, record.time_to_first_token)
+
+    def _observe(self, name: str, labels: tuple, value: float):
+        if labels not in self._histograms[name]:
+            self._histograms[name][labels] = _Histogram(self.buckets)
+        self._histograms[name][labels].observe(value)
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: str = "") -> str:
+        operation, model = (value.replace("\\", "\\\\").replace('"', '\\"') for value in labels)
+        return f'{{operation="{operation}",model="{model}"{extra}}}'
+
+    def render(self) -> str:
+        """Returns the current value of every metric in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, help_text in self._COUNTERS:
+                metric = f"{self.namespace}_{name}"
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+                for labels, value in sorted(self._counters[name].items()):
+                    lines.append(f"{metric}{self._format_labels(labels)} {value}")
+
+            for name, help_text in self._HISTOGRAMS:
+                metric = f"{self.namespace}_{name}"
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+                for labels, histogram in sorted(self._histograms[name].items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        bucket_labels = self._format_labels(labels, f',le="{bound}"')
+                        lines.append(f"{metric}_bucket{bucket_labels} {count}")
+                    inf_labels = self._format_labels(labels, ',le="+Inf"')
+                    lines.append(f"{metric}_bucket{inf_labels} {histogram.count}")
+                    lines.append(f"{metric}_sum{self._format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{metric}_count{self._format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Writes the metrics to `path` atomically, so a scraper never reads a half-written file."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
@@ -0,0 +1,143 @@
+import contextlib
+import threading
+import time
+
+import aiohttp
+import openai
+import requests
+from openai import api_requestor
+
+# what openai keeps per thread for its requests
+_THREAD_SESSION_ATTRIBUTES = ("session", "session_create_time")
+
+
+class OpenAiClient:
+    """Long-lived connection settings for the OpenAI API: a pool of keep-alive HTTP connections shared by every
+    thread, request timeouts and, optionally, the credentials to use instead of the module-level ones.
+
+    The openai package keeps one HTTP session per thread, so every new thread (e.g. each Streamlit rerun) opens
+    new connections and pays the TCP and TLS handshakes again. Calls made through a client reuse its pool
+    instead. Async calls share one aiohttp session per `async_session` block instead of opening one per request.
+
+    Create one client per process and pass it to the chat and embedding wrappers.
+
+    Args:
+        api_key (str, optional): API key. Defaults to None, meaning openai.api_key.
+        api_base (str, optional): Base URL of the API. Defaults to None, meaning openai.api_base.
+        organization (str, optional): Organization id. Defaults to None, meaning openai.organization.
+        pool_size (int, optional): Connections kept alive per host. Defaults to 16.
+        connect_timeout (float, optional): Seconds to wait for a connection. Defaults to 10.
+        read_timeout (float, optional): Seconds to wait for the answer. Defaults to 600.
+        max_retries (int, optional): Retries of failed connections (not of failed requests). Defaults to 2.
+    """
+
+    def __init__(
+            self,
+            api_key: str or None = None,
+            api_base: str or None = None,
+            organization: str or None = None,
+            pool_size: int = 16,
+            connect_timeout: float = 10.0,
+            read_timeout: float = 600.0,
+            max_retries: int = 2
+        ):
+        if pool_size < 1:
+            raise ValueError(f"pool_size must be at least 1. You passed: {pool_size}")
+
+        self.api_key = api_key
+        self.api_base = api_base
+        self.organization = organization
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=self.max_retries
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def request_kwargs(self) -> dict:
+        """Keyword arguments that openai's create functions take on top of the request itself."""
+        request_kwargs = {"request_timeout": (self.connect_timeout, self.read_timeout)}
+        for name in ("api_key", "api_base", "organization"):
+            if getattr(self, name) is not None:
+                request_kwargs[name] = getattr(self, name)
+        return request_kwargs
+
+    @contextlib.contextmanager
+    def _thread_session(self):
+        """Makes the pool the session openai uses in this thread for the duration of the block, then puts back the
+        thread's own session, so the calls made without the client do not go through it."""
+        # openai 0.28 has no per-call session argument: it sends each request with the session of the thread
+        context = api_requestor._thread_context
+        previous = {name: getattr(context, name) for name in _THREAD_SESSION_ATTRIBUTES if hasattr(context, name)}
+        context.session = self.session
+        # a fresh creation time keeps openai from recycling (closing) the shared session during the call
+        context.session_create_time = time.time()
+        try:
+            yield
+        finally:
+            for name in _THREAD_SESSION_ATTRIBUTES:
+                if name in previous:
+                    setattr(context, name, previous[name])
+                elif hasattr(context, name):
+                    delattr(context, name)
+
+    def call(self, create_function, **create_kwargs):
+        """Calls an openai create function (e.g. openai.ChatCompletion.create) with the pool and settings of the
+        client."""
+        with self._thread_session():
+            return create_function(**create_kwargs, **self.request_kwargs())
+
+    @contextlib.asynccontextmanager
+    async def async_session(self):
+        """Shares one aiohttp session, with a pool of `pool_size` connections, between the async calls made inside
+        the block (including the tasks it starts). Nested blocks reuse the outer session.
+
+        Example:
+            async with client.async_session():
+                responses = await asyncio.gather(*(client.call_async(openai.ChatCompletion.acreate, **kwargs)
+                                                   for kwargs in requests))
+        """
+        current = openai.aiosession.get()
+        if current is not None and not current.closed:
+            yield current
+            return
+
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self.pool_size))
+        token = openai.aiosession.set(session)
+        try:
+            yield session
+        finally:
+            openai.aiosession.reset(token)
+            await session.close()
+
+    async def call_async(self, create_function, **create_kwargs):
+        """Same as call, for the async create functions (e.g. openai.ChatCompletion.acreate)."""
+        async with self.async_session():
+            return await create_function(**create_kwargs, **self.request_kwargs())
+
+    def close(self):
+        """Closes the connections of the pool. The client opens new ones if it is used again."""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,15 +1,29 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
 import logging
 from typing import List
 
-import numpy as np
 import openai
-import pandas as pd
-import tiktoken
-import torch
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 import sys
 sys.path.append('/workspace/')
+from src.utils.lazy_imports import lazy_import
+
+# only the embedding helpers need these, so they are imported on first use
+np = lazy_import("numpy")
+torch = lazy_import("torch")
+
+from src.llms.embedding_cache import EmbeddingCache, normalize_text, text_hash
+from src.llms.function_calling import FunctionRegistry, function_call_messages, function_calling_kwargs
+from src.llms.function_calling import parse_function_calls
+from src.llms.instrumentation import CallRecord, current_record, instrumentation, tracked
+from src.llms.openai_client import OpenAiClient
+from src.llms.rate_limiter import RateLimiter, estimate_chat_tokens, estimate_embedding_tokens, wait_retry_after
+from src.llms.response_cache import ResponseCache
+from src.llms.tokens import TokenCounter
 from src.messages.messages import Message, MessageHistory
 
 
@@ -17,50 +31,258 @@ def log_retry(retry_state):
     logging.error(f"Retrying: {retry_state.attempt_number}...")
     logging.error(f"Exception: {retry_state.outcome.exception()}")
 
+    record = current_record()
+    if record is not None and retry_state.next_action is not None:
+        record.retry_wait_seconds += retry_state.next_action.sleep
 
-class TokenCounter:
-    def __init__(self, model: str = "gpt-3.5-turbo"):
-        self.encoding = tiktoken.encoding_for_model(model)
 
-    def encode(self, messages: List[str] or str) -> List[List[int]]:
-        if isinstance(messages, str):
-            messages = [messages]
+def _chunk_has_output(chunk) -> bool:
+    """True when a streamed chunk carries content or closes the stream."""
+    if not chunk["choices"]:
+        return False
+    choice = chunk["choices"][0]
+    return bool(choice["delta"].get("content")) or choice.get("finish_reason") is not None
+
+
+def create_chat_completion(
+        create_kwargs: dict,
+        rate_limiter: RateLimiter or None = None,
+        client: OpenAiClient or None = None
+    ):
+    """Call openai.ChatCompletion.create, through `rate_limiter` and with the connections of `client` if given."""
+    record = current_record()
+    if record is not None:
+        record.start_attempt()
+
+    if client is None:
+        create_function = lambda: openai.ChatCompletion.create(**create_kwargs)
+    else:
+        create_function = lambda: client.call(openai.ChatCompletion.create, **create_kwargs)
+
+    if rate_limiter is None:
+        response = create_function()
+    else:
+        response = rate_limiter.call(create_function, estimate_chat_tokens(create_kwargs))
+
+    if record is not None:
+        record.add_usage(response.get("usage"))
+    return response
+
+
+class ChatStream:
+    """Iterator over the text deltas of a streamed chat completion.
+
+    Once the stream is exhausted, `text` holds the full answer and `usage` a token dictionary with the same
+    keys as the "usage" field of a regular response. The streaming endpoint does not report usage, so it is
+    counted locally with a TokenCounter, and reported to the rate limiter the request went through, if any. The
+    instrumentation record of the call, if any, is finished when the stream ends.
+    """
+
+    def __init__(
+            self,
+            chunks,
+            buffered_chunks: list,
+            messages: List[dict],
+            model: str,
+            functions: list = None,
+            rate_limiter: RateLimiter or None = None,
+            estimated_tokens: int = 0,
+            record: CallRecord or None = None
+        ):
+        self.model = model
+        self.messages = messages
+        self.functions = functions
+        self.rate_limiter = rate_limiter
+        self.estimated_tokens = estimated_tokens
+        self.record = record
+        self.parts = []
+        self.finish_reason = None
+        self.usage = None
+        self._deltas = self._iter_deltas(itertools.chain(buffered_chunks, chunks))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        return next(self._deltas)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def _iter_deltas(self, chunks):
+        try:
+            for chunk in chunks:
+                if not chunk["choices"]:
+                    continue
+                choice = chunk["choices"][0]
+                if choice.get("finish_reason") is not None:
+                    self.finish_reason = choice["finish_reason"]
+                delta = choice["delta"].get("content")
+                if delta:
+                    self.parts.append(delta)
+                    yield delta
+
+            self.usage = self._count_usage()
+            if self.rate_limiter is not None:
+                self.rate_limiter.reconcile(self.estimated_tokens, self.usage["total_tokens"])
+            if self.record is not None:
+                self.record.add_usage(self.usage)
+        except Exception as e:
+            if self.record is not None:
+                self.record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if self.record is not None:
+                instrumentation.finish_deferred(self.record)
+
+    def _count_usage(self) -> dict:
+        counter = TokenCounter(self.model)
+        prompt_tokens = counter.count_messages(self.messages, functions=self.functions)
+        completion_tokens = len(counter.encode(self.text)[0])
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
 
-        return self.encoding.encode_batch(messages)
 
-    def decode(self, tokens: List[List[int]] or List[int]):
-        if isinstance(tokens[0], int):
-            tokens = [tokens]
+def open_chat_stream(
+        retries: int = 5,
+        base_wait: int = 5,
+        rate_limiter: RateLimiter or None = None,
+        client: OpenAiClient or None = None,
+        **create_kwargs
+    ) -> ChatStream:
+    """Open a streamed chat completion and return it as a ChatStream.
 
-        return self.encoding.decode_batch(tokens)
+    Failures are retried until the first token (or the end of the stream) arrives. Once text has started
+    flowing, errors are raised to the caller, since retrying would repeat what has already been shown.
+    """
+    estimated_tokens = estimate_chat_tokens(create_kwargs) if rate_limiter is not None else 0
+
+    @retry(
+        stop=stop_after_attempt(retries),
+        wait=wait_retry_after(wait_exponential(multiplier=base_wait, max=20)),
+        before_sleep=log_retry,
+    )
+    def open_stream():
+        if record is not None:
+            record.start_attempt()
+        if client is None:
+            create_function = lambda: openai.ChatCompletion.create(stream=True, **create_kwargs)
+        else:
+            create_function = lambda: client.call(openai.ChatCompletion.create, stream=True, **create_kwargs)
+        if rate_limiter is None:
+            chunks = iter(create_function())
+        else:
+            chunks = iter(rate_limiter.call(create_function, estimated_tokens))
+        buffered_chunks = []
+        for chunk in chunks:
+            buffered_chunks.append(chunk)
+            if _chunk_has_output(chunk):
+                break
+        return chunks, buffered_chunks
+
+    # the record is finished by the ChatStream, once the last token has arrived
+    with instrumentation.track("chat_stream", create_kwargs["model"], finish=False) as record:
+        chunks, buffered_chunks = open_stream()
+        if record is not None:
+            record.mark_first_token()
+
+    return ChatStream(
+        chunks,
+        buffered_chunks,
+        create_kwargs["messages"],
+        create_kwargs["model"],
+        create_kwargs.get("functions"),
+        rate_limiter=rate_limiter,
+        estimated_tokens=estimated_tokens,
+        record=record,
+    )
 
 
 class OpenAiChat:
-    def __init__(self, history: MessageHistory, model: str = "gpt-3.5-turbo-0613", temperature: float = 0.0):
+    def __init__(
+            self, 
+            history: MessageHistory, 
+            model: str = "gpt-3.5-turbo-0613", 
+            temperature: float = 0.0, 
+            max_prompt_tokens: int or None = None,
+            rate_limiter: RateLimiter or None = None,
+            client: OpenAiClient or None = None
+        ):
         self.model = model
         self.history = history
         self.temperature = temperature
+        self.max_prompt_tokens = max_prompt_tokens
+        self.rate_limiter = rate_limiter
+        self.client = client
 
+    @tracked("chat")
     def __call__(self, prompt: str):
         """Call the OpenAI chat API with the prompt and return the response."""
         new_message = Message("user", prompt)
         self.history.add_message(new_message)
 
-        response = openai.ChatCompletion.create(
-            messages=self.history.to_list(),
+        create_kwargs = dict(
+            messages=self.history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
             model=self.model,
             temperature=self.temperature,
         )
+        response = create_chat_completion(create_kwargs, self.rate_limiter, self.client)
         return response
 
+    def stream(self, prompt: str) -> ChatStream:
+        """Call the OpenAI chat API with the prompt and return a ChatStream over the answer."""
+        new_message = Message("user", prompt)
+        self.history.add_message(new_message)
+
+        return open_chat_stream(
+            retries=1,
+            rate_limiter=self.rate_limiter,
+            client=self.client,
+            messages=self.history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
+            model=self.model,
+            temperature=self.temperature,
+        )
+
 
 class OpenAiChatWithRetries:
-    def __init__(self, history: MessageHistory, model: str = "gpt-3.5-turbo-0613", temperature: float = 0.0):
+    def __init__(
+            self, 
+            history: MessageHistory, 
+            model: str = "gpt-3.5-turbo-0613", 
+            temperature: float = 0.0, 
+            max_prompt_tokens: int or None = None,
+            cache: ResponseCache or None = None,
+            rate_limiter: RateLimiter or None = None,
+            client: OpenAiClient or None = None
+        ):
         self.model = model
         self.history = history
         self.temperature = temperature
+        self.max_prompt_tokens = max_prompt_tokens
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.client = client
+
+    @tracked("chat")
+    def _create(self, create_kwargs: dict, create_function, force_cache: bool = False):
+        """Run `create_function` through the response cache, if the instance has one."""
+        if self.cache is None:
+            return create_function()
+
+        return self.cache.get_or_create(create_kwargs, create_function, force=force_cache)
 
-    def __call__(self, prompt: str, temperature: float or None = None, retries: int = 5, base_wait: int = 5):
+    def __call__(
+            self, 
+            prompt: str, 
+            temperature: float or None = None, 
+            retries: int = 5, 
+            base_wait: int = 5, 
+            force_cache: bool = False
+        ):
         """Call the OpenAI chat API with the prompt and return the response."""
         if isinstance(prompt, str):
             new_message = Message("user", prompt)
@@ -74,37 +296,116 @@ class OpenAiChatWithRetries:
         if temperature is None:
             temperature = self.temperature
 
+        create_kwargs = dict(
+            messages=self.history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
+            model=self.model,
+            temperature=temperature,
+        )
+
         # apply the retry decorator with the desired arguments (waits are in miliseconds)
         @retry(
             stop=stop_after_attempt(retries),
-            wait=wait_exponential(multiplier=base_wait, max=20),
+            wait=wait_retry_after(wait_exponential(multiplier=base_wait, max=20)),
             before_sleep=log_retry,
         )
         def predict():
-            response = openai.ChatCompletion.create(
-                messages=self.history.to_list(),
-                model=self.model,
-                temperature=temperature,
-            )
+            response = create_chat_completion(create_kwargs, self.rate_limiter, self.client)
             return response
 
-        response = predict()
+        response = self._create(create_kwargs, predict, force_cache)
 
         return response
 
-    def predict_on_messages(self, message_history: MessageHistory, temperature: float or None = None):
+    def predict_on_messages(
+            self, 
+            message_history: MessageHistory, 
+            temperature: float or None = None, 
+            force_cache: bool = False
+        ):
         """Call the OpenAI model on a Message History instead of a message"""
         if temperature is None:
             temperature = self.temperature
 
-        response = openai.ChatCompletion.create(
-            messages=message_history.to_list(),
+        create_kwargs = dict(
+            messages=message_history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
             model=self.model,
             temperature=temperature,
         )
+        response = self._create(
+            create_kwargs, lambda: create_chat_completion(create_kwargs, self.rate_limiter, self.client), force_cache
+        )
 
         return response
 
+    def stream(self, prompt: str, temperature: float or None = None, retries: int = 5, base_wait: int = 5):
+        """Call the OpenAI chat API with the prompt and return a ChatStream over the answer."""
+        if isinstance(prompt, str):
+            new_message = Message("user", prompt)
+        elif isinstance(prompt, Message):
+            new_message = prompt
+        else:
+            raise TypeError(f"Prompt must be of the type str or Message. You passed: {type(prompt)}")
+
+        self.history.add_message(new_message)
+
+        return self.stream_on_messages(self.history, temperature=temperature, retries=retries, base_wait=base_wait)
+
+    def stream_on_messages(
+            self, 
+            message_history: MessageHistory, 
+            temperature: float or None = None, 
+            retries: int = 5, 
+            base_wait: int = 5
+        ) -> ChatStream:
+        """Stream the answer of the OpenAI model on a Message History instead of a message"""
+        if temperature is None:
+            temperature = self.temperature
+
+        return open_chat_stream(
+            retries=retries,
+            base_wait=base_wait,
+            rate_limiter=self.rate_limiter,
+            client=self.client,
+            messages=message_history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
+            model=self.model,
+            temperature=temperature,
+        )
+
+    def to_async(self):
+        """Returns an AsyncOpenAiChatWithRetries with the same settings, rate limiter and client."""
+        from src.llms.async_openai_models import AsyncOpenAiChatWithRetries
+
+        return AsyncOpenAiChatWithRetries(
+            self.history,
+            model=self.model,
+            temperature=self.temperature,
+            max_prompt_tokens=self.max_prompt_tokens,
+            rate_limiter=self.rate_limiter,
+            client=self.client,
+        )
+
+    def batch(
+            self,
+            histories: List[MessageHistory],
+            temperature: float or None = None,
+            max_concurrency: int = 8,
+            retries: int = 5,
+            base_wait: int = 5,
+            return_exceptions: bool = False,
+        ) -> list:
+        """Call the OpenAI model on many independent Message Histories concurrently and return the responses in
+        input order. Blocks until the whole batch is done; see AsyncOpenAiChat.batch for the arguments."""
+        return asyncio.run(
+            self.to_async().batch(
+                histories,
+                temperature=temperature,
+                max_concurrency=max_concurrency,
+                retries=retries,
+                base_wait=base_wait,
+                return_exceptions=return_exceptions,
+            )
+        )
+
 
 class OpenAiChatWithFunctionCallingAndRetries:
     def __init__(
@@ -113,16 +414,39 @@ class OpenAiChatWithFunctionCallingAndRetries:
             functions: list,
             function_call: str = "auto",
             model: str = "gpt-3.5-turbo-0613", 
-            temperature: float = 0.0
+            temperature: float = 0.0,
+            max_prompt_tokens: int or None = None,
+            cache: ResponseCache or None = None,
+            rate_limiter: RateLimiter or None = None,
+            client: OpenAiClient or None = None
         ):
 
         self.model = model
         self.history = history
         self.temperature = temperature
+        self.max_prompt_tokens = max_prompt_tokens
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.client = client
         self.functions = functions
         self.function_call = function_call
 
-    def __call__(self, prompt: str, temperature: float or None = None, retries: int = 5, base_wait: int = 5):
+    @tracked("chat")
+    def _create(self, create_kwargs: dict, create_function, force_cache: bool = False):
+        """Run `create_function` through the response cache, if the instance has one."""
+        if self.cache is None:
+            return create_function()
+
+        return self.cache.get_or_create(create_kwargs, create_function, force=force_cache)
+
+    def __call__(
+            self, 
+            prompt: str, 
+            temperature: float or None = None, 
+            retries: int = 5, 
+            base_wait: int = 5, 
+            force_cache: bool = False
+        ):
         """Call the OpenAI chat API with the prompt and return the response."""
         if isinstance(prompt, str):
             new_message = Message("user", prompt)
@@ -136,60 +460,368 @@ class OpenAiChatWithFunctionCallingAndRetries:
         if temperature is None:
             temperature = self.temperature
 
+        create_kwargs = dict(
+            messages=self.history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
+            model=self.model,
+            temperature=temperature,
+            functions=self.functions, 
+            function_call=self.function_call
+        )
+
+        return self._predict(create_kwargs, retries, base_wait, force_cache)
+
+    def _predict(self, create_kwargs: dict, retries: int, base_wait: int, force_cache: bool = False):
         # apply the retry decorator with the desired arguments (waits are in miliseconds)
         @retry(
             stop=stop_after_attempt(retries),
-            wait=wait_exponential(multiplier=base_wait, max=20),
+            wait=wait_retry_after(wait_exponential(multiplier=base_wait, max=20)),
             before_sleep=log_retry,
         )
         def predict():
-            response = openai.ChatCompletion.create(
-                messages=self.history.to_list(),
+            response = create_chat_completion(create_kwargs, self.rate_limiter, self.client)
+            return response
+
+        return self._create(create_kwargs, predict, force_cache)
+
+    def call_with_functions(
+            self,
+            prompt: str or Message or None,
+            registry: FunctionRegistry,
+            max_rounds: int = 5,
+            use_tools: bool = False,
+            temperature: float or None = None,
+            retries: int = 5,
+            base_wait: int = 5
+        ):
+        """Call the OpenAI chat API with the prompt and run the functions the model asks for until it answers.
+
+        Every round, the calls the model asks for run concurrently through `registry` and the request and the
+        results are added to the history, which is sent again. After `max_rounds` rounds of calls the model is
+        asked to answer without calling anything else. Like __call__, the final answer is returned and not added
+        to the history.
+
+        :param prompt: New user message, or None to continue from the history as it is.
+        :type prompt: str or Message or None
+        :param registry: Runs the calls. Its definitions are offered when the instance has no `functions`.
+        :type registry: FunctionRegistry
+        :param max_rounds: Maximum rounds of calls, defaults to 5
+        :type max_rounds: int, optional
+        :param use_tools: Offer the functions as "tools", so the model can ask for several calls per round (only
+        the models that support it), defaults to False
+        :type use_tools: bool, optional
+        :return: The response with the final answer.
+        """
+        if isinstance(prompt, str):
+            self.history.add_message(Message("user", prompt))
+        elif isinstance(prompt, Message):
+            self.history.add_message(prompt)
+        elif prompt is not None:
+            raise TypeError(f"Prompt must be of the type str, Message or None. You passed: {type(prompt)}")
+
+        if temperature is None:
+            temperature = self.temperature
+
+        functions = self.functions or registry.definitions
+        function_call = self.function_call
+        for round_number in range(max_rounds + 1):
+            if round_number == max_rounds:
+                function_call = "none"
+
+            create_kwargs = dict(
+                messages=self.history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
                 model=self.model,
                 temperature=temperature,
-                functions=self.functions, 
-                function_call=self.function_call
+                **function_calling_kwargs(functions, function_call, use_tools),
             )
-            return response
+            response = self._predict(create_kwargs, retries, base_wait)
 
-        response = predict()
+            message = response["choices"][0]["message"]
+            calls = parse_function_calls(message)
+            if not calls or round_number == max_rounds:
+                return response
 
-        return response
+            results = registry.call_many(calls)
+            for new_message in function_call_messages(message, calls, results):
+                self.history.add_message(new_message)
+            # a function forced by name is only forced in the first round
+            function_call = "auto"
 
-    def predict_on_messages(self, message_history: MessageHistory, temperature: float or None = None):
+    def predict_on_messages(
+            self, 
+            message_history: MessageHistory, 
+            temperature: float or None = None, 
+            force_cache: bool = False
+        ):
         """Call the OpenAI model on a Message History instead of a message"""
         if temperature is None:
             temperature = self.temperature
 
-        response = openai.ChatCompletion.create(
-            messages=message_history.to_list(),
+        create_kwargs = dict(
+            messages=message_history.to_prompt_list(max_tokens=self.max_prompt_tokens, model=self.model),
             model=self.model,
             temperature=temperature,
             functions=self.functions, 
             function_call=self.function_call
         )
+        response = self._create(
+            create_kwargs, lambda: create_chat_completion(create_kwargs, self.rate_limiter, self.client), force_cache
+        )
 
         return response
 
+    def to_async(self):
+        """Returns an AsyncOpenAiChatWithFunctionCallingAndRetries with the same settings, rate limiter and client."""
+        from src.llms.async_openai_models import AsyncOpenAiChatWithFunctionCallingAndRetries
+
+        return AsyncOpenAiChatWithFunctionCallingAndRetries(
+            self.history, 
+            self.functions, 
+            self.function_call, 
+            model=self.model, 
+            temperature=self.temperature, 
+            max_prompt_tokens=self.max_prompt_tokens,
+            rate_limiter=self.rate_limiter,
+            client=self.client
+        )
+
+    def batch(
+            self,
+            histories: List[MessageHistory],
+            temperature: float or None = None,
+            max_concurrency: int = 8,
+            retries: int = 5,
+            base_wait: int = 5,
+            return_exceptions: bool = False,
+        ) -> list:
+        """Call the OpenAI model on many independent Message Histories concurrently and return the responses in
+        input order. Blocks until the whole batch is done; see AsyncOpenAiChat.batch for the arguments."""
+        return asyncio.run(
+            self.to_async().batch(
+                histories,
+                temperature=temperature,
+                max_concurrency=max_concurrency,
+                retries=retries,
+                base_wait=base_wait,
+                return_exceptions=return_exceptions,
+            )
+        )
+
 
 class OpenAiCompletion:
     pass
 
 
+def make_token_batches(token_counts: List[int], max_batch_items: int, max_batch_tokens: int) -> List[tuple]:
+    """Split a sequence of inputs into contiguous (start, end) batches of at most `max_batch_items` inputs and
+    `max_batch_tokens` tokens. An input larger than `max_batch_tokens` gets a batch of its own."""
+    batches = []
+    start, batch_tokens = 0, 0
+    for index, num_tokens in enumerate(token_counts):
+        if index > start and (index - start >= max_batch_items or batch_tokens + num_tokens > max_batch_tokens):
+            batches.append((start, index))
+            start, batch_tokens = index, 0
+        batch_tokens += num_tokens
+
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+
+    return batches
+
+
 class OpenAiEmbeddings:
-    def __init__(self, model: str = "text-embedding-ada-002"):
+    def __init__(
+            self,
+            model: str = "text-embedding-ada-002",
+            cache: EmbeddingCache or None = None,
+            rate_limiter: RateLimiter or None = None,
+            client: OpenAiClient or None = None
+        ):
         self.model = model
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.client = client
         # self.embedding = openai.Embeddings(model)
 
+    @tracked("embedding")
     def embed_text(self, messages: List[str] or str):
+        """Embed the messages and return a response shaped like the one of openai.Embedding.create. With a cache,
+        only the texts that are not cached are sent (each of them once), and "usage" counts only those."""
         model = self.model
 
         if isinstance(messages, str):
-            messages = [messages.replace("\n", " ")]
+            messages = [normalize_text(messages)]
+        else:
+            messages = [normalize_text(message) for message in messages]
+
+        if self.cache is None:
+            return self._create_embedding(messages)
+
+        embeddings, usage = self._embed_with_cache(messages)
+        data = [
+            {"object": "embedding", "index": index, "embedding": embedding.tolist()}
+            for index, embedding in enumerate(embeddings)
+        ]
+        return {"object": "list", "data": data, "model": model, "usage": usage}
+
+    def _create_embedding(self, inputs: List[str]):
+        """Call openai.Embedding.create, through the rate limiter and client of the instance if it has them."""
+        record = current_record()
+        if record is not None:
+            record.start_attempt()
+
+        if self.client is None:
+            create_function = lambda: openai.Embedding.create(input=inputs, model=self.model)
+        else:
+            create_function = lambda: self.client.call(openai.Embedding.create, input=inputs, model=self.model)
+
+        if self.rate_limiter is None:
+            response = create_function()
+        else:
+            response = self.rate_limiter.call(create_function, estimate_embedding_tokens(self.model, inputs))
+
+        if record is not None:
+            record.add_usage(response.get("usage"))
+        return response
+
+    @tracked("embedding")
+    def embed_numpy(self, messages: List[str] or str) -> np.ndarray:
+        """Embed the messages and return a float32 matrix with one row per message, in input order."""
+        if isinstance(messages, str):
+            messages = [messages]
+        messages = [normalize_text(message) for message in messages]
+
+        if self.cache is None:
+            response = self._create_embedding(messages)
+            return self.get_numpy_embeddings(response).astype(np.float32)
+
+        embeddings, _ = self._embed_with_cache(messages)
+        return embeddings
+
+    def _embed_with_cache(self, messages: List[str]) -> tuple:
+        """Look the messages up in the cache, send the distinct misses in a single request, store them and
+        reassemble the embeddings in input order."""
+        cached = self.cache.get_many(self.model, messages)
+        keys = [text_hash(message) for message in messages]
+
+        misses = list(dict.fromkeys(message for message, key in zip(messages, keys) if key not in cached))
+        usage = {"prompt_tokens": 0, "total_tokens": 0}
+        if len(misses) > 0:
+            response = self._create_embedding(misses)
+            vectors = self.get_numpy_embeddings(response).astype(np.float32)
+            self.cache.put_many(self.model, misses, vectors)
+            cached.update(zip((text_hash(message) for message in misses), vectors))
+            usage = dict(response["usage"])
+
+        return np.stack([cached[key] for key in keys]), usage
+
+    @tracked("embedding")
+    def embed_bulk(
+            self,
+            messages: List[str],
+            max_batch_items: int = 2048,
+            max_batch_tokens: int = 250_000,
+            max_input_tokens: int = 8191,
+            max_concurrency: int = 4,
+            retries: int = 5,
+            base_wait: int = 5,
+        ) -> np.ndarray:
+        """Embed any number of messages and return a float32 matrix with one row per message, in input order.
+
+        Distinct texts that are not cached are split into contiguous requests of at most `max_batch_items` inputs
+        and `max_batch_tokens` tokens (counted with TokenCounter), which are sent concurrently. Each request is
+        retried on its own, so a failure only repeats that request.
+
+        :param messages: Texts to embed.
+        :type messages: List[str]
+        :param max_batch_items: Maximum number of inputs per request, defaults to 2048
+        :type max_batch_items: int, optional
+        :param max_batch_tokens: Maximum number of tokens per request, defaults to 250_000
+        :type max_batch_tokens: int, optional
+        :param max_input_tokens: Maximum number of tokens of a single input, defaults to 8191
+        :type max_input_tokens: int, optional
+        :param max_concurrency: Maximum number of requests in flight at the same time, defaults to 4
+        :type max_concurrency: int, optional
+        :param retries: Attempts per request, defaults to 5
+        :type retries: int, optional
+        :param base_wait: Multiplier of the exponential wait between attempts, defaults to 5
+        :type base_wait: int, optional
+        :raises ValueError: If a single message is longer than `max_input_tokens`.
+        :return: A matrix of shape (len(messages), embedding dimension).
+        :rtype: np.ndarray
+        """
+        messages = [normalize_text(message) for message in messages]
+        if len(messages) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        vectors_by_text = {}
+        unique_messages = list(dict.fromkeys(messages))
+        if self.cache is not None:
+            cached = self.cache.get_many(self.model, unique_messages)
+            for message in unique_messages:
+                if text_hash(message) in cached:
+                    vectors_by_text[message] = cached[text_hash(message)]
+
+        misses = [message for message in unique_messages if message not in vectors_by_text]
+        if len(misses) > 0:
+            token_counts = [len(tokens) for tokens in TokenCounter(self.model).encode(misses)]
+            too_long = [index for index, count in enumerate(token_counts) if count > max_input_tokens]
+            if len(too_long) > 0:
+                raise ValueError(
+                    f"{len(too_long)} messages are longer than {max_input_tokens} tokens. First one: {misses[too_long[0]][:50]}..."
+                )
+
+            batches = make_token_batches(token_counts, max_batch_items, max_batch_tokens)
+            vectors = asyncio.run(
+                self._embed_batches(misses, batches, token_counts, max_concurrency, retries, base_wait)
+            )
+            if self.cache is not None:
+                self.cache.put_many(self.model, misses, vectors)
+            vectors_by_text.update(zip(misses, vectors))
+
+        return np.stack([vectors_by_text[message] for message in messages])
+
+    async def _embed_batches(
+            self,
+            messages: List[str],
+            batches: list,
+            token_counts: List[int],
+            max_concurrency: int,
+            retries: int,
+            base_wait: int
+        ):
+        from src.llms.async_openai_models import gather_with_concurrency
+
+        @retry(
+            stop=stop_after_attempt(retries),
+            wait=wait_retry_after(wait_exponential(multiplier=base_wait, max=20)),
+            before_sleep=log_retry,
+        )
+        async def embed_batch(start: int, end: int) -> np.ndarray:
+            record = current_record()
+            if record is not None:
+                record.start_attempt()
+            if self.client is None:
+                create_function = lambda: openai.Embedding.acreate(input=messages[start:end], model=self.model)
+            else:
+                create_function = lambda: self.client.call_async(
+                    openai.Embedding.acreate, input=messages[start:end], model=self.model
+                )
+            if self.rate_limiter is None:
+                response = await create_function()
+            else:
+                response = await self.rate_limiter.call_async(create_function, sum(token_counts[start:end]))
+            if record is not None:
+                record.add_usage(response.get("usage"))
+            return self.get_numpy_embeddings(response).astype(np.float32)
+
+        coroutines = [embed_batch(start, end) for start, end in batches]
+        if self.client is None:
+            results = await gather_with_concurrency(coroutines, max_concurrency)
         else:
-            messages = [message.replace("\n", " ") for message in messages]
+            async with self.client.async_session():
+                results = await gather_with_concurrency(coroutines, max_concurrency)
 
-        return openai.Embedding.create(input=messages, model=model)
+        return np.concatenate(results)
 
     @staticmethod
     def get_embeddings_list(openai_response: dict):
@@ -203,7 +835,7 @@ class OpenAiEmbeddings:
 
     @staticmethod
     def get_numpy_embeddings(openai_response: dict):
-        data = openai_response["data"]
+        data = sorted(openai_response["data"], key=lambda item: item["index"])
         list_arrays = [np.array(item["embedding"]) for item in data]
         return np.array(list_arrays)
 
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import List
+
+import openai
+from tenacity.wait import wait_base
+
+from src.llms.instrumentation import current_record
+from src.llms.tokens import TokenCounter
+
+
+def retry_after_seconds(error: BaseException) -> float or None:
+    """Returns the wait the API asked for in the Retry-After headers of `error`, or None if it did not ask."""
+    headers = getattr(error, "headers", None) or {}
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class wait_retry_after(wait_base):
+    """Tenacity wait strategy that waits what the Retry-After header of the last error asks for, and falls back
+    to `fallback` (e.g. wait_exponential) when there is no such header."""
+
+    def __init__(self, fallback: wait_base):
+        self.fallback = fallback
+
+    def __call__(self, retry_state) -> float:
+        exception = retry_state.outcome.exception() if retry_state.outcome is not None else None
+        retry_after = retry_after_seconds(exception) if exception is not None else None
+        if retry_after is not None:
+            return retry_after
+        return self.fallback(retry_state)
+
+
+def estimate_chat_tokens(create_kwargs: dict) -> int:
+    """Prompt tokens of a chat completion request, counted before sending it. Tools count like the functions
+    they wrap."""
+    functions, function_call = create_kwargs.get("functions"), create_kwargs.get("function_call")
+    if create_kwargs.get("tools"):
+        functions = (functions or []) + [tool["function"] for tool in create_kwargs["tools"] if "function" in tool]
+        tool_choice = create_kwargs.get("tool_choice")
+        function_call = tool_choice["function"] if isinstance(tool_choice, dict) else tool_choice
+
+    return TokenCounter(create_kwargs["model"]).count_messages(create_kwargs["messages"], functions, function_call)
+
+
+def estimate_embedding_tokens(model: str, inputs: List[str]) -> int:
+    return sum(len(tokens) for tokens in TokenCounter(model).encode(inputs))
+
+
+class RateLimiter:
+    """Client-side requests-per-minute and tokens-per-minute limits, shared by every wrapper that is given the
+    same instance (chat and embeddings, sync and async, from any thread).
+
+    Each limit is a token bucket that refills continuously and holds at most one minute of budget. A request
+    reserves one request and its estimated tokens before it is sent and sleeps until the buckets can pay for
+    them; reservations are taken in arrival order, so concurrent callers are spread out instead of all firing at
+    once. After the response, the estimate is corrected with the "usage" it reports. A 429 pauses every caller
+    for the Retry-After the API asked for.
+
+    The lock is never held while sleeping, so the same instance works for threads and event loops at once.
+
+    Example:
+        limiter = RateLimiter(requests_per_minute=3500, tokens_per_minute=90_000)
+        chat = OpenAiChatWithRetries(history, rate_limiter=limiter)
+        embeddings = OpenAiEmbeddings(rate_limiter=limiter)
+
+    Args:
+        requests_per_minute (float, optional): Request limit. Defaults to None, meaning no limit.
+        tokens_per_minute (float, optional): Token limit. Defaults to None, meaning no limit.
+    """
+
+    def __init__(self, requests_per_minute: float or None = None, tokens_per_minute: float or None = None):
+        for name, value in (("requests_per_minute", requests_per_minute), ("tokens_per_minute", tokens_per_minute)):
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive. You passed: {value}")
+
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.waits = 0
+        self.seconds_waited = 0.0
+        self.rate_limit_errors = 0
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.requests_per_minute is not None:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _reserve(self, num_tokens: int) -> float:
+        """Takes one request and `num_tokens` tokens from the buckets and returns how long the caller has to wait
+        before sending it. The buckets may go negative: the debt is what later callers wait for."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(self._blocked_until - now, 0.0)
+
+            if self.requests_per_minute is not None:
+                self._requests -= 1
+                wait = max(wait, -self._requests * 60 / self.requests_per_minute)
+            if self.tokens_per_minute is not None:
+                # a request larger than the bucket could never be paid for; it waits for a full bucket instead
+                self._tokens -= min(num_tokens, self.tokens_per_minute)
+                wait = max(wait, -self._tokens * 60 / self.tokens_per_minute)
+
+            self.requests += 1
+            if wait > 0:
+                self.waits += 1
+                self.seconds_waited += wait
+
+        record = current_record()
+        if record is not None:
+            record.rate_limit_wait_seconds += wait
+
+        return wait
+
+    def _refund(self, num_tokens: int, requests: int = 0):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.requests_per_minute is not None:
+                self._requests = min(self.requests_per_minute, self._requests + requests)
+            if self.tokens_per_minute is not None:
+                self._tokens = min(self.tokens_per_minute, self._tokens + num_tokens)
+
+    def acquire(self, num_tokens: int = 0):
+        """Blocks until a request of `num_tokens` tokens can be sent."""
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, num_tokens: int = 0):
+        """Waits, without blocking the event loop, until a request of `num_tokens` tokens can be sent."""
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self._refund(num_tokens, requests=1)
+                raise
+
+    def reconcile(self, estimated_tokens: int, used_tokens: int):
+        """Corrects the tokens reserved for a request with the tokens it actually used."""
+        if used_tokens > estimated_tokens:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self.tokens_per_minute is not None:
+                    self._tokens -= used_tokens - estimated_tokens
+        elif used_tokens < estimated_tokens:
+            self._refund(estimated_tokens - used_tokens)
+
+    def record_rate_limit(self, error: BaseException):
+        """Pauses every caller after a 429, for the Retry-After of `error` or one second if it has none."""
+        retry_after = retry_after_seconds(error)
+        pause = retry_after if retry_after is not None else 1.0
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._blocked_until = max(self._blocked_until, now + pause)
+            # the API disagrees with our budget: start again from empty buckets once the pause is over
+            self._requests = min(self._requests, 0.0)
+            self._tokens = min(self._tokens, 0.0)
+            self.rate_limit_errors += 1
+
+        logging.error(f"Rate limited by the API, pausing requests for {pause:.1f}s")
+
+    def _after_response(self, response, num_tokens: int):
+        usage = response.get("usage") if isinstance(response, dict) else None
+        if usage is not None:
+            self.reconcile(num_tokens, usage.get("total_tokens", num_tokens))
+
+    def call(self, create_function, num_tokens: int = 0):
+        """Sends a request through the limiter: waits for budget, calls `create_function` and reconciles the
+        tokens with the "usage" of the response, if it has one (streams are reconciled by ChatStream).
+
+        :param create_function: Function without arguments that sends the request, e.g. a lambda around
+        openai.ChatCompletion.create.
+        :type create_function: callable
+        :param num_tokens: Estimated tokens of the request, defaults to 0
+        :type num_tokens: int, optional
+        :return: The response of `create_function`.
+        """
+        self.acquire(num_tokens)
+        try:
+            response = create_function()
+        except openai.error.RateLimitError as e:
+            self.record_rate_limit(e)
+            raise
+        self._after_response(response, num_tokens)
+        return response
+
+    async def call_async(self, create_function, num_tokens: int = 0):
+        """Same as call, for a function that returns a coroutine, e.g. a lambda around openai.ChatCompletion.acreate."""
+        await self.acquire_async(num_tokens)
+        try:
+            response = await create_function()
+        except openai.error.RateLimitError as e:
+            self.record_rate_limit(e)
+            raise
+        self._after_response(response, num_tokens)
+        return response
+
+    def stats(self) -> dict:
+        """Returns the requests sent through the limiter, how many of them had to wait and for how long in total,
+        and the 429s received."""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "waits": self.waits,
+                "seconds_waited": self.seconds_waited,
+                "rate_limit_errors": self.rate_limit_errors,
+            }
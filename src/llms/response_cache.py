@@ -0,0 +1,248 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import openai
+
+
+# arguments that change how a request is sent, not what the model answers
+_TRANSPORT_KWARGS = frozenset(
+    {"stream", "user", "request_id", "request_timeout", "timeout", "api_key", "api_base", "api_type", "api_version",
+     "organization", "headers"}
+)
+
+
+def make_cache_key(create_kwargs: dict) -> str:
+    """Canonical hash of the arguments of a chat completion that determine its answer.
+
+    :param create_kwargs: Keyword arguments passed to openai.ChatCompletion.create.
+    :type create_kwargs: dict
+    :return: A sha256 hex digest of every argument except the ones that only change how the request is sent
+    (stream, user, timeouts, credentials...). Two calls with the same arguments get the same key, whatever the order
+    of the dictionary keys; the temperature defaults to 1 like in the API.
+    :rtype: str
+    """
+    canonical = {key: value for key, value in create_kwargs.items() if key not in _TRANSPORT_KWARGS}
+    canonical["temperature"] = float(create_kwargs.get("temperature", 1.0))
+    serialized = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache of chat completion responses: an in-memory LRU in front of a directory of JSON files.
+
+    Only deterministic calls (temperature 0) are cached unless the caller forces it. The disk tier evicts the
+    least recently used entries once it grows past `max_disk_bytes`, and entries older than `ttl_seconds` are
+    treated as misses in both tiers.
+
+    Args:
+        cache_dir (str, optional): Directory of the disk tier. Defaults to None, meaning memory only.
+        max_memory_items (int, optional): Entries kept in memory. Defaults to 256.
+        max_disk_bytes (int, optional): Size of the disk tier before eviction. Defaults to 512 MB.
+        ttl_seconds (float, optional): Time to live of an entry. Defaults to None, meaning entries never expire.
+    """
+
+    def __init__(
+            self,
+            cache_dir: str or None = None,
+            max_memory_items: int = 256,
+            max_disk_bytes: int = 512 * 1024 * 1024,
+            ttl_seconds: float or None = None
+        ):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+        self._memory = OrderedDict()  # key -> (created_at, serialized response)
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk_bytes = sum(os.path.getsize(path) for path in self._disk_entries())
+            if self._disk_bytes > self.max_disk_bytes:
+                with self._lock:
+                    self._evict_disk()
+
+    @staticmethod
+    def is_deterministic(create_kwargs: dict) -> bool:
+        return float(create_kwargs.get("temperature", 1.0)) == 0.0
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters of the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "memory_items": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def get_or_create(self, create_kwargs: dict, create_function, force: bool = False):
+        """Returns the cached response for `create_kwargs`, or calls `create_function()` and caches its result.
+
+        :param create_kwargs: Keyword arguments of the chat completion, used to build the key.
+        :type create_kwargs: dict
+        :param create_function: Function without arguments that performs the call on a miss.
+        :type create_function: callable
+        :param force: Cache the call even if its temperature is above 0, defaults to False
+        :type force: bool, optional
+        :return: The response of the chat completion. Cached responses are converted back to an OpenAIObject,
+        like the ones the API returns.
+        :rtype: openai.openai_object.OpenAIObject
+        """
+        if not (force or self.is_deterministic(create_kwargs)):
+            return create_function()
+
+        key = make_cache_key(create_kwargs)
+        response = self.get(key)
+        if response is None:
+            response = create_function()
+            self.set(key, response)
+            return response
+
+        return openai.util.convert_to_openai_object(response)
+
+    def get(self, key: str) -> dict or None:
+        """Returns a copy of the cached response for `key`, or None on a miss."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._is_expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return json.loads(entry[1])
+            elif entry is not None:
+                del self._memory[key]
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, entry)
+
+        return json.loads(entry[1])
+
+    def set(self, key: str, response: dict):
+        """Stores a response in both tiers."""
+        entry = (time.time(), json.dumps(response))
+        with self._lock:
+            self._remember(key, entry)
+
+        if self.cache_dir is not None:
+            self._write_disk(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.cache_dir is not None:
+                for path in self._disk_entries():
+                    os.remove(path)
+                self._disk_bytes = 0
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _disk_entries(self) -> list:
+        return [
+            os.path.join(root, file)
+            for root, _, files in os.walk(self.cache_dir)
+            for file in files
+            if file.endswith(".json")
+        ]
+
+    def _read_disk(self, key: str) -> tuple or None:
+        if self.cache_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Discarding unreadable cache entry {path}: {e}")
+            self._remove_disk(path)
+            return None
+
+        if self._is_expired(payload["created_at"]):
+            self._remove_disk(path)
+            return None
+
+        os.utime(path)  # the modification time tracks the last use, for eviction
+        return payload["created_at"], json.dumps(payload["response"])
+
+    def _write_disk(self, key: str, entry: tuple):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        created_at, serialized_response = entry
+        serialized = f'{{"created_at": {created_at}, "response": {serialized_response}}}'
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(serialized)
+
+        # the file replaced and its size are read under the lock, so that concurrent writes of the same key
+        # (or its removal) are counted once
+        with self._lock:
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._disk_bytes += os.path.getsize(path) - previous_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _remove_disk(self, path: str):
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                return
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        """Removes the least recently used files until the disk tier is back to 90% of its size limit. Must be
+        called with the lock held."""
+        entries = []
+        for path in self._disk_entries():
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except FileNotFoundError:
+                continue
+
+        for _, size, path in sorted(entries):
+            if self._disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._disk_bytes -= size
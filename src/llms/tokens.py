@@ -0,0 +1,207 @@
+import json
+from functools import lru_cache
+from typing import List
+
+from src.messages.messages import _message_to_dict
+from src.utils.lazy_imports import lazy_import
+
+tiktoken = lazy_import("tiktoken")
+
+
+TOKENS_PER_MESSAGE = 3  # every message is wrapped in <|start|>{role}\n{content}<|end|>
+TOKENS_PER_REPLY = 3  # every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_FUNCTIONS = 9  # the function definitions are wrapped in their own system section
+TOKENS_PER_NAMED_FUNCTION_CALL = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Returns the tiktoken encoding of `model`, loaded once per process and shared by every TokenCounter."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # unknown or fine-tuned model names: every chat model so far uses cl100k_base
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _format_type(schema: dict, indent: int) -> str:
+    schema_type = schema.get("type")
+    if schema_type == "string":
+        if "enum" in schema:
+            return " | ".join(f'"{value}"' for value in schema["enum"])
+        return "string"
+    if schema_type in ("number", "integer"):
+        if "enum" in schema:
+            return " | ".join(str(value) for value in schema["enum"])
+        return "number"
+    if schema_type == "boolean":
+        return "boolean"
+    if schema_type == "null":
+        return "null"
+    if schema_type == "object":
+        return "{\n" + _format_properties(schema, indent + 2) + "\n}"
+    if schema_type == "array":
+        if "items" in schema:
+            return f"{_format_type(schema['items'], indent)}[]"
+        return "any[]"
+    return "any"
+
+
+def _format_properties(schema: dict, indent: int) -> str:
+    required = set(schema.get("required", []))
+    lines = []
+    for name, property_schema in schema.get("properties", {}).items():
+        if property_schema.get("description") and indent < 2:
+            lines.append(f"// {property_schema['description']}")
+        optional = "" if name in required else "?"
+        lines.append(f"{name}{optional}: {_format_type(property_schema, indent)},")
+    return "\n".join(" " * indent + line for line in lines)
+
+
+def format_functions(functions: List[dict]) -> str:
+    """Renders function definitions the way the API shows them to the model (a TypeScript namespace), which is
+    what they are billed as."""
+    lines = ["namespace functions {", ""]
+    for function in functions:
+        if function.get("description"):
+            lines.append(f"// {function['description']}")
+        if function.get("parameters", {}).get("properties"):
+            lines += [f"type {function['name']} = (_: {{", _format_properties(function["parameters"], 0), "}) => any;"]
+        else:
+            lines.append(f"type {function['name']} = () => any;")
+        lines.append("")
+    lines.append("} // namespace functions")
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=128)
+def _count_functions(model: str, functions_json: str) -> int:
+    functions = json.loads(functions_json)
+    return len(get_encoding(model).encode(format_functions(functions))) + TOKENS_PER_FUNCTIONS
+
+
+def _message_text(message: dict) -> str:
+    """The text of a message dict that is encoded in the prompt: its content and its function calling fields."""
+    text = message["content"] or ""
+    for key in ("name", "function_call", "tool_calls"):
+        value = message.get(key)
+        if value is not None:
+            text += value if isinstance(value, str) else json.dumps(value)
+    return text
+
+
+class TokenCounter:
+    def __init__(self, model: str = "gpt-3.5-turbo"):
+        self.model = model
+        self.encoding = get_encoding(model)
+
+    def encode(self, messages: List[str] or str) -> List[List[int]]:
+        if isinstance(messages, str):
+            messages = [messages]
+
+        return self.encoding.encode_batch(messages)
+
+    def decode(self, tokens: List[List[int]] or List[int]):
+        if isinstance(tokens[0], int):
+            tokens = [tokens]
+
+        return self.encoding.decode_batch(tokens)
+
+    def count_functions(self, functions: List[dict] or None, function_call: str or dict or None = None) -> int:
+        """Count the prompt tokens added by the `functions` and `function_call` arguments of a request.
+
+        The count of a given list of definitions is cached, since the same ones are sent with every request.
+        """
+        num_tokens = 0
+        if functions:
+            num_tokens += _count_functions(self.model, json.dumps(functions, sort_keys=True))
+
+        if isinstance(function_call, dict):
+            num_tokens += len(self.encode(function_call["name"])[0]) + TOKENS_PER_NAMED_FUNCTION_CALL
+        elif function_call == "none":
+            num_tokens += 1
+
+        return num_tokens
+
+    def _functions_overhead(self, has_system_message: bool, functions, function_call) -> int:
+        num_tokens = self.count_functions(functions, function_call)
+        if functions and has_system_message:
+            # the system message and the definitions share a section, so its wrapping is not counted twice
+            num_tokens -= 4
+        return num_tokens
+
+    def count_messages(
+            self,
+            messages: List[dict],
+            functions: List[dict] or None = None,
+            function_call: str or dict or None = None
+        ) -> int:
+        """Count the prompt tokens of a list of chat messages (as returned by MessageHistory.to_list)."""
+        num_tokens = TOKENS_PER_REPLY
+        contents = [_message_text(message) for message in messages]
+        roles = [message["role"] for message in messages]
+        for encoded in self.encode(contents) + self.encode(roles):
+            num_tokens += len(encoded)
+        num_tokens += TOKENS_PER_MESSAGE * len(messages)
+
+        has_system_message = any(message["role"] == "system" for message in messages)
+        return num_tokens + self._functions_overhead(has_system_message, functions, function_call)
+
+    def count_message(self, message) -> int:
+        """Count the tokens a Message adds to a prompt, role and wrapping included.
+
+        The count is cached on the message together with the encoding and the text it was computed for, so a
+        message is only encoded again if its text changes or it is counted for a model with another encoding.
+        """
+        cache = getattr(message, "_token_cache", None)
+        if cache is not None and cache[0] == self.encoding.name and cache[1] is message.message:
+            return cache[2]
+
+        text = message.message or ""
+        if message.role != "user" and message.role != "system":
+            text = _message_text(_message_to_dict(message))
+        content_tokens, role_tokens = self.encode([text, message.role])
+        num_tokens = TOKENS_PER_MESSAGE + len(content_tokens) + len(role_tokens)
+        message._token_cache = (self.encoding.name, message.message, num_tokens)
+
+        return num_tokens
+
+    def count_history(
+            self,
+            history,
+            functions: List[dict] or None = None,
+            function_call: str or dict or None = None
+        ) -> int:
+        """Count the prompt tokens of sending a whole MessageHistory, i.e. the `prompt_tokens` the API reports.
+
+        The running total of the messages is cached on the history, so after appending messages only the new
+        ones are counted: re-counting a long conversation after each turn costs O(1) amortized.
+
+        :param history: The conversation, as it would be sent (to_list without a token budget).
+        :type history: MessageHistory
+        :param functions: Function definitions sent with the request, defaults to None
+        :type functions: List[dict] or None, optional
+        :param function_call: The `function_call` argument of the request, defaults to None
+        :type function_call: str or dict or None, optional
+        :return: The number of prompt tokens.
+        :rtype: int
+        """
+        messages = history.messages
+        start, total = 0, 0
+
+        cache = getattr(history, "_token_count_cache", None)
+        if cache is not None:
+            encoding_name, counted, last_counted, counted_total = cache
+            # the cached total is only valid if the counted messages are still a prefix of the history
+            is_prefix = counted <= len(messages) and messages[counted - 1] is last_counted
+            if encoding_name == self.encoding.name and is_prefix:
+                start, total = counted, counted_total
+
+        for message in messages[start:]:
+            total += self.count_message(message)
+
+        if len(messages) > 0:
+            history._token_count_cache = (self.encoding.name, len(messages), messages[-1], total)
+
+        has_system_message = len(messages) > 0 and messages[0].role == "system"
+        return total + TOKENS_PER_REPLY + self._functions_overhead(has_system_message, functions, function_call)
@@ -1,4 +1,7 @@
-import pandas as pd
+from functools import lru_cache
+
+
+FAQ_PATH = "/workspace/data/files/listado_preguntas_respuestas_v3.tsv"
 
 
 system_message_en = f"""You are a helpful assistant. You will be asked to help a user with a task 
@@ -59,14 +62,34 @@ el documento que se le adjunta.
 )
 
 
-## MENSAJE GENERAL PARA EL FLUJO PRINCIPAL QUE ORQUESTRA TODO (EL ORCHESTRATOR):
+## MENSAJES PARA RESUMIR LOS TURNOS ANTIGUOS DE UNA CONVERSACION LARGA (src/llms/compaction.py):
 
-df = pd.read_csv("/workspace/data/files/listado_preguntas_respuestas_v3.tsv", sep="\t")
-lista_preguntas = df["PREGUNTA"].tolist()
-# lista_preguntas = [f"{idx}) {pregunta.strip()}" for idx, pregunta in enumerate(lista_preguntas)]
-concat_preguntas = "<<!ENTER!>>".join(lista_preguntas)
+sys_msg_summary = """You summarize conversations between a user and an assistant so that the assistant can keep 
+helping the user without reading the whole conversation. Keep every fact, decision, requirement, name, number, code 
+identifier and open question that may matter later, and drop greetings and repetitions. Write in the language of 
+the conversation, in plain sentences or a short list, and never add anything that was not said.
+""".replace(
+    "\n", ""
+)
 
-sys_msg_orchestrator = f"""Eres un amable asistente que tiene dos tareas. La primera es ser amable y respetuoso con 
+summary_prompt = """Summary of the earlier part of the conversation:<<!ENTER!>>{summary}<<!ENTER!>><<!ENTER!>>
+Turns that came after it:<<!ENTER!>>{conversation}<<!ENTER!>>
+Write the updated summary of the whole conversation, turns above included.
+""".replace(
+    "\n", ""
+).replace(
+    "<<!ENTER!>>", "\n"
+)
+
+summary_context_message = (
+    "Summary of the earlier part of this conversation (the older messages are not shown):\n{summary}"
+)
+
+
+## MENSAJE GENERAL PARA EL FLUJO PRINCIPAL QUE ORQUESTRA TODO (EL ORCHESTRATOR):
+# The FAQ is only read the first time one of these messages is used (see __getattr__ at the end of the module).
+
+_sys_msg_orchestrator_template = """Eres un amable asistente que tiene dos tareas. La primera es ser amable y respetuoso con 
 el usuario. Tu nombre es MIKKA y tu función es únicamente determinar si la pregunta del usuario está relacionada 
 con alguna de las siguientes preguntas o no:<<!ENTER!>>
 <<!ENTER!>>{concat_preguntas}
@@ -74,23 +97,55 @@ con alguna de las siguientes preguntas o no:<<!ENTER!>>
 En caso de identificar una pregunta similar, simplemente debes llamar a la función con la pregunta exacta que hayas 
 encontrado entre las que se indican arriba. En caso de no encontrarla, debes responder cordialmente que no puedes 
 responder a esa pregunta.
-""".replace(
-    "\n", ""
-).replace(
-    "<<!ENTER!>>", "\n"
-)
+"""
 
-sys_msg_orchestrator_en = f"""You are a friendly assistant named MIKKA. You must always be very respectful and kind 
+_sys_msg_orchestrator_en_template = """You are a friendly assistant named MIKKA. You must always be very respectful and kind 
 to the user asking the questions. You must always respond in spanish. Given the following list of questions in 
 spanish: <<!ENTER!>><<!ENTER!>>
 {concat_preguntas}<<!ENTER!>><<!ENTER!>>
 You must return the question that is most similar to the user question, word by word. If there is no similar question, 
 you must politely say that you are not trained to answer that question and ask the user if you can help him with any 
 other question. Remember you must respond in spanish only.
-""".replace(
-    "\n", ""
-).replace(
-    "<<!ENTER!>>", "\n"
-)
+"""
+
+
+@lru_cache(maxsize=None)
+def load_faq(faq_path: str = FAQ_PATH):
+    """Reads the FAQ TSV (columns PREGUNTA, RESPUESTA...) once per path."""
+    import pandas as pd
+
+    return pd.read_csv(faq_path, sep="\t")
+
+
+def load_faq_questions(faq_path: str = FAQ_PATH) -> list:
+    return load_faq(faq_path)["PREGUNTA"].tolist()
+
+
+def build_sys_msg_orchestrator(preguntas: list, language: str = "es") -> str:
+    """Builds the orchestrator system message for a list of FAQ questions ("es" or "en" instructions)."""
+    template = _sys_msg_orchestrator_template if language == "es" else _sys_msg_orchestrator_en_template
+    concat_preguntas = "<<!ENTER!>>".join(preguntas)
+
+    return template.format(concat_preguntas=concat_preguntas).replace(
+        "\n", ""
+    ).replace(
+        "<<!ENTER!>>", "\n"
+    )
+
+
+def __getattr__(name):
+    # lazy module attributes, so importing this module does not read the FAQ
+    if name == "df":
+        return load_faq()
+    if name == "lista_preguntas":
+        return load_faq_questions()
+    if name == "concat_preguntas":
+        return "<<!ENTER!>>".join(load_faq_questions())
+    if name == "sys_msg_orchestrator":
+        return build_sys_msg_orchestrator(load_faq_questions(), language="es")
+    if name == "sys_msg_orchestrator_en":
+        return build_sys_msg_orchestrator(load_faq_questions(), language="en")
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # print(sys_msg_orchestrator)
\ No newline at end of file
@@ -0,0 +1,71 @@
+import sys
+sys.path.append('/workspace/')
+from src.llms.openai_models import OpenAiEmbeddings
+from src.messages.base_messages import FAQ_PATH, build_sys_msg_orchestrator, load_faq_questions
+from src.messages.messages import Message, MessageHistory
+from src.retrieval.indexer import Indexer
+
+
+class FaqOrchestrator:
+    """Builds the orchestrator system message from the FAQ questions most similar to the user message, instead
+    of listing the whole FAQ in every call.
+
+    The questions are embedded once, the first time they are needed; give `embeddings` an EmbeddingCache so that
+    later processes read them from disk instead of calling the API. Each user message costs one embedding call
+    (also cached) and a search over the questions.
+
+    Args:
+        embeddings (OpenAiEmbeddings): Embedding model, ideally with a cache.
+        faq_path (str, optional): FAQ TSV with a PREGUNTA column. Defaults to FAQ_PATH.
+        k (int, optional): Questions included in the system message. Defaults to 10.
+        language (str, optional): Language of the instructions, "es" or "en". Defaults to "es".
+    """
+
+    def __init__(self, embeddings: OpenAiEmbeddings, faq_path: str = FAQ_PATH, k: int = 10, language: str = "es"):
+        self.embeddings = embeddings
+        self.faq_path = faq_path
+        self.k = k
+        self.language = language
+        self._index = None
+
+    @property
+    def index(self) -> Indexer:
+        if self._index is None:
+            questions = load_faq_questions(self.faq_path)
+            index = Indexer()
+            index.create_index(self.embeddings.embed_bulk(questions), payloads=questions)
+            self._index = index
+        return self._index
+
+    def similar_questions(self, user_message: str, k: int or None = None) -> list:
+        """Returns the `k` FAQ questions most similar to the user message, the most similar first."""
+        query = self.embeddings.embed_numpy(user_message)[0]
+        results = self.index.search(query, k=k or self.k)
+        return [result["payload"] for result in results]
+
+    def system_message(self, user_message: str, k: int or None = None) -> Message:
+        """Builds the orchestrator system message with only the questions related to the user message."""
+        questions = self.similar_questions(user_message, k=k)
+        return Message("system", build_sys_msg_orchestrator(questions, language=self.language))
+
+    def build_history(self, history: MessageHistory, user_message: str, k: int or None = None) -> MessageHistory:
+        """Returns a copy of `history` whose system message is the compact orchestrator message for
+        `user_message`, followed by the user message.
+
+        :param history: The conversation so far. Its system messages are dropped.
+        :type history: MessageHistory
+        :param user_message: The new message of the user.
+        :type user_message: str
+        :param k: Number of FAQ questions, defaults to None, meaning the instance `k`
+        :type k: int or None, optional
+        :return: The history to send to the orchestrator model.
+        :rtype: MessageHistory
+        """
+        orchestrator_history = MessageHistory()
+        orchestrator_history.add_message(self.system_message(user_message, k=k))
+        for message in history.messages:
+            if message.role != "system":
+                orchestrator_history.add_message(message)
+        orchestrator_history.add_message(Message("user", user_message))
+
+        return orchestrator_history
@@ -8,9 +8,8 @@ class MessageWithContext(Message):
 
     def __init__(self, prompt: str, context: str):
         self.prompt = prompt
-        self.role = "user"
         self.context = context
-        self.message = self._build_full_message(context)
+        super().__init__("user", self._build_full_message(context))
 
     def _build_full_message(self, context: str):
         user_start = "Answer the question based on the context below.\n\n" + "Context:\n"
@@ -25,9 +24,8 @@ class MensajeConContexto(Message):
 
     def __init__(self, prompt: str, context: str):
         self.prompt = prompt
-        self.role = "user"
         self.context = context
-        self.message = self._build_full_message(context)
+        super().__init__("user", self._build_full_message(context))
 
     def _build_full_message(self, context: str):
         user_start = "Responde la pregunta basándote en el contexto que se muestra a continuación.\n\n" + "Contexto:\n"
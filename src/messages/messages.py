@@ -1,33 +1,191 @@
+import itertools
 import json
+import os
 import random
 import string
 from datetime import datetime
 
 
+FUNCTION_CALLING_FIELDS = ("name", "function_call", "tool_calls", "tool_call_id")
+
+ROLES = ("system", "user", "assistant", "function", "tool")
+# one shared string per role, so the messages of a history read from a file do not each hold a copy of it
+_ROLES = {role: role for role in ROLES}
+
+
+def _function_calling_field(key: str) -> property:
+    return property(lambda self: self._fields.get(key) if self._fields is not None else None)
+
+
 class Message:
-    """Create a message object for an LLM."""
+    """Create a message object for an LLM.
 
-    def __init__(self, role: str, message: str):
-        if role not in ["system", "user", "assistant"]:
-            raise ValueError("Message role must be either 'system', 'user' or 'assistant'.")
+    Messages of the function calling loop carry extra fields: an "assistant" message asking for calls has a
+    `function_call` (or `tool_calls`, several at once) and may have no text, and the result of a call is a
+    "function" message with the `name` of the function (or a "tool" message with the `tool_call_id` it answers).
+
+    Messages have slots instead of a __dict__ (subclasses that do not declare slots still get one) and are not
+    meant to change once added to a MessageHistory, which keeps their serialized form.
+    """
+
+    __slots__ = ("role", "message", "_fields", "_token_cache")
+
+    name = _function_calling_field("name")
+    function_call = _function_calling_field("function_call")
+    tool_calls = _function_calling_field("tool_calls")
+    tool_call_id = _function_calling_field("tool_call_id")
+
+    def __init__(
+            self,
+            role: str,
+            message: str or None,
+            name: str or None = None,
+            function_call: dict or None = None,
+            tool_calls: list or None = None,
+            tool_call_id: str or None = None
+        ):
+        if role not in _ROLES:
+            raise ValueError("Message role must be either 'system', 'user', 'assistant', 'function' or 'tool'.")
+        self.role = _ROLES[role]
         self.message = message
-        self.role = role
+        # the function calling fields that are set, or None for the usual messages
+        fields = {
+            key: value
+            for key, value in zip(FUNCTION_CALLING_FIELDS, (name, function_call, tool_calls, tool_call_id))
+            if value is not None
+        }
+        self._fields = fields or None
+        # (encoding name, text, tokens) cached by TokenCounter.count_message
+        self._token_cache = None
+
+    @classmethod
+    def from_dict(cls, message_dict: dict):
+        """Creates a Message from a dictionary like the ones of MessageHistory.to_list."""
+        fields = {key: message_dict[key] for key in FUNCTION_CALLING_FIELDS if message_dict.get(key) is not None}
+        return cls(message_dict["role"], message_dict["content"], **fields)
 
     def __repr__(self):
-        message_text = self.message if len(self.message) < 20 else self.message[:18] + "..."
+        message_text = self.message or ""
+        message_text = message_text if len(message_text) < 20 else message_text[:18] + "..."
         return f"""Message(role={self.role}, message="{message_text}")"""
 
 
+def _message_to_dict(message: Message) -> dict:
+    message_dict = {"role": message.role, "content": message.message}
+    if message._fields is not None:
+        message_dict.update(message._fields)
+    return message_dict
+
+
+def _display_text(message: Message) -> str:
+    """The text shown for a message: its content, or the calls it asks for if it has none."""
+    if message.message is not None:
+        return message.message
+
+    if message.tool_calls is not None:
+        functions = [call["function"] for call in message.tool_calls]
+    else:
+        functions = [message.function_call] if message.function_call is not None else []
+    return "\n".join(f"{function['name']}({function['arguments']})" for function in functions)
+
+
+def _text_lines(messages, include_system: bool = False):
+    """Yields one "role: text" line per message."""
+    for message in messages:
+        role = message.role
+        if role == "system" and not include_system:
+            continue
+        text = message.message
+        yield f"{role}: {text if text is not None else _display_text(message)}\n"
+
+
+def _markdown_blocks(messages, include_system: bool = False):
+    """Yields one markdown block per message: the role in bold, then the text. Function calls and results are
+    shown as code."""
+    for message in messages:
+        if not include_system and message.role == "system":
+            continue
+
+        title = message.role.capitalize()
+        text = _display_text(message)
+        if message.role in ("function", "tool") or message.message is None:
+            if message.name is not None:
+                title += f" `{message.name}`"
+            text = f"```\n{text}\n```"
+        yield f"**{title}:**\n\n{text}\n\n"
+
+
+def _newest_within_budget(messages: list, num_head: int, max_tokens: int, model: str) -> int:
+    """Returns the index of the first of the newest messages that fit in `max_tokens` together with the first
+    `num_head` messages of `messages`, which are always kept."""
+    from src.llms.tokens import TOKENS_PER_REPLY, TokenCounter
+
+    counter = TokenCounter(model)
+    head_tokens = sum(counter.count_message(message) for message in messages[:num_head])
+    remaining = max_tokens - TOKENS_PER_REPLY - head_tokens
+
+    # indexes instead of slices, so a long history is not copied to select a few messages
+    start = len(messages)
+    while start > num_head:
+        num_tokens = counter.count_message(messages[start - 1])
+        if num_tokens > remaining:
+            break
+        remaining -= num_tokens
+        start -= 1
+
+    if start == len(messages) and len(messages) > num_head:
+        raise ValueError(f"The system message and the last message do not fit in {max_tokens} tokens.")
+
+    # do not open the window with an answer whose question was dropped, nor with the results of calls whose
+    # assistant message was dropped, which the API rejects: the calls and their results go together
+    while start > num_head and start < len(messages):
+        message = messages[start]
+        asks_for_calls = message.tool_calls is not None or message.function_call is not None
+        if message.role == "assistant" and (asks_for_calls or start == len(messages) - 1):
+            break
+        if message.role not in ("assistant", "function", "tool"):
+            break
+        start += 1
+
+    if start == len(messages) and len(messages) > num_head:
+        raise ValueError(f"The system message and the last function calls do not fit in {max_tokens} tokens.")
+
+    return start
+
+
+def _atomic_write(full_file_path: str, text: str, fsync: bool = True):
+    """Writes `text` to a temporary file and moves it over `full_file_path`, so readers only ever see the old or
+    the new content."""
+    tmp_path = full_file_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, full_file_path)
+
+
 class MessageHistory:
     """Manages the history of a conversation between a bot and a user.
 
     Attributes:
         messages (list): A list of Message objects representing the conversation history.
+        compaction (RollingCompaction or None): When set (see src/llms/compaction.py), the prompts sent by the chat
+            classes replace the oldest turns with a summary of them; `messages` still holds every message.
     """
 
     def __init__(self, has_sys_msg: bool = True):
         self.messages = []
         self.has_sys_msg = has_sys_msg
+        # the dictionary of every message, kept in step with `messages` so to_list does not rebuild them
+        self._serialized = []
+        # number of messages already written to each append-only log, and appends since its last compaction
+        self._persisted_counts = {}
+        self._appends_since_compaction = {}
+        # running prompt token total kept by TokenCounter.count_history
+        self._token_count_cache = None
+        # opt-in rolling summary of the oldest turns, used by to_prompt_list
+        self.compaction = None
 
     def add_message(self, message: Message):
         """Adds a new message to the conversation history.
@@ -43,23 +201,90 @@ class MessageHistory:
                 raise ValueError(f"First message must be from system. Your message's role was: {message.role}")
 
         self.messages.append(message)
-
-    def to_list(self):
+        self._serialized.append(_message_to_dict(message))
+
+    def _serialized_messages(self) -> list:
+        """The dictionaries of the messages, rebuilt only if `messages` was changed without going through the
+        history's methods."""
+        if len(self._serialized) != len(self.messages) or (
+            self.messages and self._serialized[-1]["content"] is not self.messages[-1].message
+        ):
+            self._serialized = [_message_to_dict(message) for message in self.messages]
+        return self._serialized
+
+    def to_list(self, max_tokens: int = None, model: str = "gpt-3.5-turbo"):
         """Converts the conversation history to a list of dictionaries.
 
+        Args:
+            max_tokens (int, optional): Prompt token budget. When given, the list keeps the system message and the
+                newest messages that fit in the budget, dropping the oldest ones. Defaults to None, meaning all 
+                messages.
+            model (str, optional): Model whose tokenizer is used to count tokens. Defaults to "gpt-3.5-turbo".
+
+        Returns:
+            list: A list of dictionaries, each containing 'role' and 'content' keys. The dictionaries are shared
+                with the history, so they must not be modified.
+        """
+        serialized = self._serialized_messages()
+        if max_tokens is None:
+            return serialized.copy()
+
+        num_head, start = self._window_within_budget(max_tokens, model)
+        return serialized[:num_head] + serialized[start:]
+
+    def to_prompt_list(self, max_tokens: int = None, model: str = "gpt-3.5-turbo") -> list:
+        """Converts the conversation to the list of messages sent to the model.
+
+        Same as to_list, unless `compaction` is set: then the turns it already summarized are replaced by a single
+        message with their summary, placed after the system message. Crossing the compaction threshold starts the
+        summary of more turns (in the background, by default).
+
+        Args:
+            max_tokens (int, optional): Prompt token budget, as in to_list. Defaults to None.
+            model (str, optional): Model whose tokenizer is used to count tokens. Defaults to "gpt-3.5-turbo".
+
         Returns:
             list: A list of dictionaries, each containing 'role' and 'content' keys.
         """
-        return [{"role": message.role, "content": message.message} for message in self.messages]
+        if self.compaction is None:
+            return self.to_list(max_tokens, model)
+        return self.compaction.prompt_list(self, max_tokens, model)
+
+    def messages_within_budget(self, max_tokens: int, model: str = "gpt-3.5-turbo") -> list:
+        """Selects the messages sent to the model under a prompt token budget: the system message (if any) and the
+        newest messages that fit. Token counts are cached on each message, so only messages that were never 
+        counted are encoded.
+
+        Args:
+            max_tokens (int): Prompt token budget, including the tokens that prime the reply.
+            model (str, optional): Model whose tokenizer is used to count tokens. Defaults to "gpt-3.5-turbo".
+
+        Raises:
+            ValueError: If the system message and the newest message (or the newest function calls and their
+                results, which are only sent together) do not fit in the budget.
+
+        Returns:
+            list: The selected Message objects, in conversation order.
+        """
+        num_head, start = self._window_within_budget(max_tokens, model)
+        return self.messages[:num_head] + self.messages[start:]
+
+    def _window_within_budget(self, max_tokens: int, model: str) -> tuple:
+        """Returns the number of leading messages kept (1 if there is a system message, else 0) and the index
+        of the first of the newest messages kept; see messages_within_budget."""
+        messages = self.messages
+        num_head = 1 if len(messages) > 0 and messages[0].role == "system" else 0
+        return num_head, _newest_within_budget(messages, num_head, max_tokens, model)
 
     def populate_from_list(self, message_list: list):
-        """Populates the conversation history from a list of dictionaries.
+        """Populates the conversation history from a list of messages.
 
         Args:
-            message_list (list): A list of dictionaries, each containing 'role' and 'content' keys.
+            message_list (list): A list of Message objects. The history gets copies of them (function calling
+                fields included), so it does not share messages, or their cached token counts, with the caller.
         """
         for message in message_list:
-            self.add_message(Message(message.role, message.message))
+            self.add_message(Message(message.role, message.message, **(message._fields or {})))
 
     def to_text_form(self, N: int = None) -> str:
         """Converts the conversation history to text form, omitting system messages.
@@ -70,33 +295,43 @@ class MessageHistory:
         Returns:
             str: The conversation history in text form.
         """
-        if N is not None:
-            N = min(N, len(self.messages))
-        else:
-            N = len(self.messages)
+        # like self.messages[-N:], where N=0 also means all messages
+        start = len(self.messages) - min(N, len(self.messages)) if N else 0
+        return self.view(start).to_text_form()
+
+    def write_text(self, file, include_system: bool = False):
+        """Writes the conversation in text form (see to_text_form) to an open file object, message by message."""
+        self.view().write_text(file, include_system)
+
+    def to_markdown(self, include_system: bool = False) -> str:
+        """Renders the conversation as markdown, one bold role and its text per message."""
+        return self.view().to_markdown(include_system)
 
-        conversation_text = ""
-        for message in self.messages[-N:]:
-            if message.role != "system":
-                conversation_text += f"{message.role}: {message.message}\n"
+    def write_markdown(self, file, include_system: bool = False):
+        """Writes the conversation as markdown (see to_markdown) to an open file object, message by message."""
+        self.view().write_markdown(file, include_system)
 
-        return conversation_text
+    def view(self, start: int = 0, stop: int or None = None, roles: list or None = None):
+        """Returns a read-only MessageView of the messages in positions [start, stop), optionally only the ones
+        with the given roles. Nothing is copied."""
+        return MessageView(self, start, stop, roles)
+
+    def last(self, N: int, roles: list or None = None):
+        """Returns a read-only MessageView of the last N messages (of the given roles, if any)."""
+        return MessageView(self, roles=roles).last(N)
+
+    def without_system_messages(self):
+        """Returns a read-only MessageView of the messages that are not system messages."""
+        return MessageView(self).without_system_messages()
 
     def copy_without_system_messages(self):
-        """Creates and returns a copy of the MessageHistory without system messages.
+        """Creates and returns a copy of the MessageHistory without system messages. Use without_system_messages
+        instead when the copy is only read.
 
         Returns:
             MessageHistory: A copy of the current MessageHistory instance without system messages.
         """
-        # Create a new instance of MessageHistory
-        copied_history = MessageHistory(has_sys_msg=False)
-
-        # Iterate through the messages in the current instance and add non-system messages to the copied instance
-        for message in self.messages:
-            if message.role != "system":
-                copied_history.add_message(message)
-
-        return copied_history
+        return self.without_system_messages().to_history()
 
     def add_system_message(self, content: str or Message):
         """Adds a system message to the beginning of the MessageHistory.
@@ -109,12 +344,79 @@ class MessageHistory:
         else:
             system_message = content if isinstance(content, (Message)) else Message("system", content)
             self.messages.insert(0, system_message)
+            self._serialized.insert(0, _message_to_dict(system_message))
+            # the logs on disk no longer are a prefix of the history, so the next save has to rewrite them
+            self._persisted_counts.clear()
+
+    def save_to_file(
+            self, 
+            full_file_path: str, 
+            append_only: bool or None = None, 
+            fsync: bool = True, 
+            compact_every: int or None = None
+        ):
+        """Saves the conversation history to a file.
+
+        Files ending in ".jsonl" (or any file when `append_only` is True) are append-only logs with one message
+        per line: only the messages added since the last save are written, with a single fsync for the whole
+        batch. Any other file is rewritten as a JSON list through a temporary file, so a crash mid-write never
+        leaves a truncated history behind.
+
+        Args:
+            full_file_path (str): Path of the file to write.
+            append_only (bool, optional): Force (True) or disable (False) the append-only log. Defaults to None,
+                meaning it is inferred from the file extension.
+            fsync (bool, optional): Whether to fsync the log after appending. Defaults to True.
+            compact_every (int, optional): Compact the log after this many appends. Defaults to None (never).
+        """
+        if append_only is None:
+            append_only = full_file_path.endswith(".jsonl")
+
+        if not append_only:
+            _atomic_write(full_file_path, json.dumps(self._serialized_messages()), fsync=fsync)
+            return
+
+        persisted = self._persisted_counts.get(full_file_path)
+        if persisted is None or persisted > len(self.messages) or not os.path.exists(full_file_path):
+            # the file was not written by this history (or it changed behind our back): start a fresh log
+            self.compact_file(full_file_path, fsync=fsync)
+            return
+
+        new_messages = self._serialized_messages()[persisted:]
+        if len(new_messages) == 0:
+            return
+
+        lines = "".join(json.dumps(message) + "\n" for message in new_messages)
+        with open(full_file_path, "a") as f:
+            f.write(lines)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+
+        self._persisted_counts[full_file_path] = len(self.messages)
+        self._appends_since_compaction[full_file_path] = self._appends_since_compaction.get(full_file_path, 0) + 1
+
+        if compact_every is not None and self._appends_since_compaction[full_file_path] >= compact_every:
+            self.compact_file(full_file_path, fsync=fsync)
+
+    def compact_file(self, full_file_path: str, fsync: bool = True):
+        """Atomically rewrites an append-only log with the current history, dropping anything else in it (e.g. a
+        partial line left by a crash).
+
+        Args:
+            full_file_path (str): Path of the log to rewrite.
+            fsync (bool, optional): Whether to fsync the new file before replacing the old one. Defaults to True.
+        """
+        lines = "".join(json.dumps(message) + "\n" for message in self._serialized_messages())
+        _atomic_write(full_file_path, lines, fsync=fsync)
 
-    def save_to_file(self, full_file_path: str):
-        """Saves the conversation history to a JSON file."""
-        with open(full_file_path, 'w') as f:
-            json.dump(self.to_list(), f)
+        self._persisted_counts[full_file_path] = len(self.messages)
+        self._appends_since_compaction[full_file_path] = 0
 
+    def mark_as_persisted(self, full_file_path: str):
+        """Records that every message of the history is already stored in the append-only log `full_file_path`,
+        so the next save only appends what is added from now on."""
+        self._persisted_counts[full_file_path] = len(self.messages)
 
     def add_messages_from_twilio(self, twilio_message_list, twilio_client_name: str) -> None:
         """Populates the history from a Twilio Message History. Note: The process assumes that there are only 
@@ -141,4 +443,113 @@ class MessageHistory:
 
             message_obj = Message(role=role, message=message.body)
             self.add_message(message_obj)
-        
+
+
+class MessageView:
+    """A read-only window over the messages of a MessageHistory: a range of positions, optionally filtered by
+    role. Views do not copy messages, so they are cheap to create over long conversations.
+
+    The range is fixed when the view is created: messages added to the history later are not part of it.
+
+    Example:
+        history.last(20).without_system_messages().write_markdown(f)
+        history.view(roles=["user"]).to_list()
+    """
+
+    def __init__(self, history: MessageHistory, start: int = 0, stop: int or None = None, roles: list or None = None):
+        self.history = history
+        self.start, self.stop, _ = slice(start, stop).indices(len(history.messages))
+        self.stop = max(self.start, self.stop)
+        self.roles = frozenset(roles) if roles is not None else None
+
+    def _positions(self):
+        if self.roles is None:
+            return range(self.start, self.stop)
+
+        messages = self.history.messages
+        return (position for position in range(self.start, self.stop) if messages[position].role in self.roles)
+
+    def __iter__(self):
+        # islice steps through every message before `start`, so it is only used for the windows that start at 0
+        if self.start == 0:
+            messages = itertools.islice(self.history.messages, self.stop)
+        else:
+            messages = map(self.history.messages.__getitem__, range(self.start, self.stop))
+        if self.roles is None:
+            return messages
+
+        roles = self.roles
+        return (message for message in messages if message.role in roles)
+
+    def __len__(self):
+        if self.roles is None:
+            return self.stop - self.start
+        return sum(1 for _ in self._positions())
+
+    def __getitem__(self, index: int) -> Message:
+        if self.roles is None:
+            position = range(self.start, self.stop)[index]
+            return self.history.messages[position]
+
+        messages = list(self)
+        return messages[index]
+
+    def __repr__(self):
+        roles = sorted(self.roles) if self.roles is not None else "all"
+        return f"MessageView(start={self.start}, stop={self.stop}, roles={roles})"
+
+    def last(self, N: int):
+        """Returns a view of the last N messages of this one."""
+        if self.roles is None:
+            return MessageView(self.history, max(self.start, self.stop - N), self.stop)
+
+        messages = self.history.messages
+        start, found = self.stop, 0
+        while start > self.start and found < N:
+            start -= 1
+            if messages[start].role in self.roles:
+                found += 1
+        return MessageView(self.history, start, self.stop, self.roles)
+
+    def with_roles(self, *roles: str):
+        """Returns a view of the messages of this one with the given roles."""
+        roles = frozenset(roles) if self.roles is None else self.roles & frozenset(roles)
+        return MessageView(self.history, self.start, self.stop, roles)
+
+    def without_system_messages(self):
+        """Returns a view of the messages of this one that are not system messages."""
+        return self.with_roles(*(role for role in ROLES if role != "system"))
+
+    def to_list(self) -> list:
+        """The dictionaries of the messages, as in MessageHistory.to_list (shared with the history, so they must not
+        be modified)."""
+        serialized = self.history._serialized_messages()
+        if self.roles is None:
+            return serialized[self.start:self.stop]
+        return [serialized[position] for position in self._positions()]
+
+    def to_history(self) -> MessageHistory:
+        """Copies the messages of the view into a new MessageHistory (without the system message check)."""
+        serialized = self.history._serialized_messages()
+        positions = list(self._positions())
+
+        history = MessageHistory(has_sys_msg=False)
+        history.messages = [self.history.messages[position] for position in positions]
+        history._serialized = [serialized[position] for position in positions]
+        return history
+
+    def to_text_form(self, include_system: bool = False) -> str:
+        """Renders the messages as "role: text" lines, omitting system messages unless `include_system`."""
+        return "".join(_text_lines(self, include_system))
+
+    def write_text(self, file, include_system: bool = False):
+        """Writes the text form to an open file object, without building the whole text in memory."""
+        file.writelines(_text_lines(self, include_system))
+
+    def to_markdown(self, include_system: bool = False) -> str:
+        """Renders the messages as markdown, omitting system messages unless `include_system`."""
+        return "".join(_markdown_blocks(self, include_system))
+
+    def write_markdown(self, file, include_system: bool = False):
+        """Writes the markdown to an open file object, without building the whole text in memory."""
+        file.writelines(_markdown_blocks(self, include_system))
@@ -0,0 +1,286 @@
+import json
+import os
+import threading
+from typing import List
+
+import numpy as np
+
+from src.utils.errors import IndexNotDefinedError
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Return the rows of `vectors` scaled to unit length, as float32. Zero rows are left as they are."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the `k` largest scores of each row, sorted from the largest, in O(n + k log k) per row."""
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def save_array(path: str, array: np.ndarray):
+    """np.save to a file written next to `path` and moved over it, so an array memory-mapped from `path` (a loaded
+    index) can be saved back to it."""
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+class PayloadFile:
+    """Read-only list of the payloads of a saved index, parsed one by one when they are accessed.
+
+    The payloads are stored one JSON line each in payloads.jsonl, and payload_offsets.npy holds the byte offset of
+    every line (plus the end of the file), so opening an index reads neither the file nor the payloads, and a
+    search only reads the ones it returns. Payloads added after loading (Indexer.add) are kept in memory.
+    """
+
+    def __init__(self, path: str, offsets: np.ndarray):
+        self.path = path
+        self.offsets = offsets
+        self._num_saved = len(offsets) - 1
+        self._added = []
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._num_saved + len(self._added)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("payload index out of range")
+        if index >= self._num_saved:
+            return self._added[index - self._num_saved]
+
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "rb")
+            self._file.seek(start)
+            line = self._file.read(end - start)
+        return json.loads(line)
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            for _ in range(self._num_saved):
+                yield json.loads(f.readline())
+        yield from self._added
+
+    def __repr__(self):
+        return f"PayloadFile(path={self.path!r}, payloads={len(self)})"
+
+    def append(self, payload):
+        self._added.append(payload)
+
+    def extend(self, payloads: list):
+        self._added.extend(payloads)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def save_payloads(directory: str, payloads):
+    """Writes payloads.jsonl and payload_offsets.npy (see PayloadFile). The file is written next to the old one
+    and moved over it, so payloads read from the same directory can be saved back to it."""
+    path = os.path.join(directory, "payloads.jsonl")
+    offsets = [0]
+    with open(path + ".tmp", "wb") as f:
+        for payload in payloads:
+            line = json.dumps(payload).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    os.replace(path + ".tmp", path)
+    save_array(os.path.join(directory, "payload_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+    # an index saved before the payloads were stored as JSONL
+    if os.path.exists(os.path.join(directory, "payloads.json")):
+        os.remove(os.path.join(directory, "payloads.json"))
+
+
+def load_payloads(directory: str):
+    """Opens the payloads saved with save_payloads as a PayloadFile, or reads the payloads.json of an older index."""
+    offsets_path = os.path.join(directory, "payload_offsets.npy")
+    if not os.path.exists(offsets_path):
+        with open(os.path.join(directory, "payloads.json")) as f:
+            return json.load(f)
+
+    return PayloadFile(os.path.join(directory, "payloads.jsonl"), np.load(offsets_path, mmap_mode="r"))
+
+
+class Indexer:
+    """Exact cosine-similarity index over embeddings (e.g. the output of OpenAiEmbeddings.get_numpy_embeddings).
+
+    Vectors are normalized and kept in one contiguous float32 matrix, so a search is a matrix product followed by
+    an argpartition. Every vector can carry a JSON-serializable payload (the chunk text, its page...).
+
+    Example:
+        indexer = Indexer()
+        indexer.create_index(OpenAiEmbeddings.get_numpy_embeddings(response), payloads=chunks)
+        results = indexer.search(query_embedding, k=5)
+    """
+
+    def __init__(self):
+        self._vectors = None
+        self._size = 0
+        self.payloads = []
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dim(self) -> int:
+        self._check_index()
+        return self._vectors.shape[1]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """The normalized vectors of the index, one row per item."""
+        self._check_index()
+        return self._vectors[:self._size]
+
+    def _check_index(self):
+        if self._vectors is None:
+            raise IndexNotDefinedError()
+
+    def create_index(self, embeddings: np.ndarray, payloads: list or None = None):
+        """Builds the index from scratch.
+
+        :param embeddings: Matrix with one embedding per row.
+        :type embeddings: np.ndarray
+        :param payloads: Metadata of each embedding, defaults to None
+        :type payloads: list or None, optional
+        """
+        vectors = normalize_rows(embeddings)
+        self._vectors = np.ascontiguousarray(vectors)
+        self._size = len(vectors)
+        self.payloads = self._check_payloads(vectors, payloads)
+
+    def add(self, embeddings: np.ndarray, payloads: list or None = None):
+        """Adds embeddings to the index. The matrix grows geometrically, so adding in small batches stays cheap.
+
+        :param embeddings: Matrix with one embedding per row.
+        :type embeddings: np.ndarray
+        :param payloads: Metadata of each embedding, defaults to None
+        :type payloads: list or None, optional
+        """
+        if self._vectors is None:
+            self.create_index(embeddings, payloads)
+            return
+
+        vectors = normalize_rows(embeddings)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of dimension {self.dim}, got {vectors.shape[1]}")
+        payloads = self._check_payloads(vectors, payloads)
+
+        new_size = self._size + len(vectors)
+        if new_size > len(self._vectors) or not self._vectors.flags.writeable:
+            capacity = max(new_size, 2 * len(self._vectors))
+            grown = np.empty((capacity, self.dim), dtype=np.float32)
+            grown[:self._size] = self._vectors[:self._size]
+            self._vectors = grown
+
+        self._vectors[self._size:new_size] = vectors
+        self._size = new_size
+        self.payloads.extend(payloads)
+
+    @staticmethod
+    def _check_payloads(vectors: np.ndarray, payloads: list or None) -> list:
+        if payloads is None:
+            return [None] * len(vectors)
+        if len(payloads) != len(vectors):
+            raise ValueError(f"Got {len(vectors)} embeddings but {len(payloads)} payloads.")
+        return list(payloads)
+
+    def search(self, queries: np.ndarray, k: int = 5, query_batch_size: int = 64) -> List[dict] or List[List[dict]]:
+        """Finds the `k` items most similar to each query.
+
+        :param queries: A single embedding or a matrix with one query per row.
+        :type queries: np.ndarray
+        :param k: Number of results per query, defaults to 5
+        :type k: int, optional
+        :param query_batch_size: Queries scored at once, which bounds the memory of the score matrix to 
+        query_batch_size x len(index) floats, defaults to 64
+        :type query_batch_size: int, optional
+        :return: For each query, a list of dictionaries with the keys "index", "score" and "payload", from the
+        most to the least similar. A single query returns a single list.
+        :rtype: List[dict] or List[List[dict]]
+        """
+        self._check_index()
+        single_query = np.ndim(queries) == 1
+        indices, scores = self.search_arrays(queries, k=k, query_batch_size=query_batch_size)
+
+        results = [
+            [
+                {"index": int(index), "score": float(score), "payload": self.payloads[index]}
+                for index, score in zip(row_indices, row_scores)
+            ]
+            for row_indices, row_scores in zip(indices, scores)
+        ]
+
+        return results[0] if single_query else results
+
+    def search_arrays(self, queries: np.ndarray, k: int = 5, query_batch_size: int = 64) -> tuple:
+        """Same as search, but returns two (num_queries, k) arrays: the indices and the cosine similarities."""
+        self._check_index()
+        queries = normalize_rows(queries)
+        k = min(k, self._size)
+        vectors = self.vectors
+
+        all_indices = np.empty((len(queries), k), dtype=np.int64)
+        all_scores = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), query_batch_size):
+            scores = queries[start:start + query_batch_size] @ vectors.T
+            top_k = top_k_indices(scores, k)
+            all_indices[start:start + query_batch_size] = top_k
+            all_scores[start:start + query_batch_size] = np.take_along_axis(scores, top_k, axis=1)
+
+        return all_indices, all_scores
+
+    def save(self, directory: str):
+        """Saves the index to a directory: vectors.npy, payloads.jsonl and payload_offsets.npy."""
+        self._check_index()
+        os.makedirs(directory, exist_ok=True)
+        save_array(os.path.join(directory, "vectors.npy"), self.vectors)
+        save_payloads(directory, self.payloads)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "Indexer":
+        """Loads an index saved with `save`.
+
+        :param directory: Directory of the index.
+        :type directory: str
+        :param mmap: Memory-map the vectors instead of reading them, so the index opens instantly whatever its size
+        and pages are only read when searched. The first `add` copies the vectors to memory. Payloads are always
+        read lazily (see PayloadFile). Defaults to True
+        :type mmap: bool, optional
+        :return: The loaded index.
+        :rtype: Indexer
+        """
+        indexer = cls()
+        indexer._vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r" if mmap else None)
+        indexer._size = len(indexer._vectors)
+        indexer.payloads = load_payloads(directory)
+
+        return indexer
+
@@ -0,0 +1,324 @@
+import json
+import os
+import time
+from typing import List
+
+import numpy as np
+
+from src.retrieval.indexer import Indexer, load_payloads, normalize_rows, save_payloads, top_k_indices
+from src.utils.errors import IndexNotDefinedError
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 10, seed: int = 0, block_size: int = 65536):
+    """Cluster unit vectors by cosine similarity.
+
+    :param vectors: Normalized float32 vectors, one per row.
+    :type vectors: np.ndarray
+    :param n_clusters: Number of clusters.
+    :type n_clusters: int
+    :param n_iter: Number of Lloyd iterations, defaults to 10
+    :type n_iter: int, optional
+    :param seed: Seed of the initialization, defaults to 0
+    :type seed: int, optional
+    :param block_size: Vectors assigned at once, defaults to 65536
+    :type block_size: int, optional
+    :return: The normalized centroids, shape (n_clusters, dim).
+    :rtype: np.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = assign_to_centroids(vectors, centroids, block_size)
+        counts = np.bincount(assignments, minlength=n_clusters)
+
+        # sum the members of each cluster: sort by cluster and reduce the contiguous runs
+        order = np.argsort(assignments, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        non_empty = counts > 0
+        sums[non_empty] = np.add.reduceat(vectors[order], starts[non_empty], axis=0)
+
+        empty = counts == 0
+        if empty.any():
+            # restart empty clusters from random points
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+def assign_to_centroids(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    """Index of the most similar centroid of each vector."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        assignments[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+    return assignments
+
+
+class IvfIndexer:
+    """Approximate cosine-similarity index (inverted file): vectors are clustered with spherical k-means and a
+    query only scores the vectors of the `nprobe` clusters closest to it.
+
+    Vectors are stored grouped by cluster in one contiguous float32 matrix, so probing a cluster is a matrix-vector
+    product over a slice, without copies. Vectors added after `create_index` go to a tail that is scanned by
+    every query, until it grows past `max_tail_fraction` of the index and is merged into the clusters.
+
+    The knobs are `n_lists` (more lists: smaller clusters, faster queries, lower recall for a given nprobe) and
+    `nprobe` (more probes: higher recall, slower queries). `evaluate_recall` measures both against exact search.
+
+    Args:
+        nprobe (int, optional): Clusters scored per query. Defaults to 8.
+        max_tail_fraction (float, optional): Size of the tail, relative to the index, that triggers a merge.
+            Defaults to 0.05.
+    """
+
+    def __init__(self, nprobe: int = 8, max_tail_fraction: float = 0.05):
+        self.nprobe = nprobe
+        self.max_tail_fraction = max_tail_fraction
+        self.centroids = None
+        self.payloads = []
+
+        self._vectors = None  # rows grouped by cluster, then the tail
+        self._ids = None  # original index of each row
+        self._assignments = None  # cluster of each row
+        self._offsets = None  # rows of cluster i are _vectors[_offsets[i]:_offsets[i + 1]]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def n_lists(self) -> int:
+        self._check_index()
+        return len(self.centroids)
+
+    def _check_index(self):
+        if self.centroids is None:
+            raise IndexNotDefinedError()
+
+    def create_index(
+            self,
+            embeddings: np.ndarray,
+            payloads: list or None = None,
+            n_lists: int or None = None,
+            train_size: int or None = None,
+            n_iter: int = 10,
+            seed: int = 0
+        ):
+        """Trains the clusters and builds the index from scratch.
+
+        :param embeddings: Matrix with one embedding per row.
+        :type embeddings: np.ndarray
+        :param payloads: Metadata of each embedding, defaults to None
+        :type payloads: list or None, optional
+        :param n_lists: Number of clusters, defaults to None, meaning 4 * sqrt(number of embeddings)
+        :type n_lists: int or None, optional
+        :param train_size: Number of embeddings sampled to train the clusters, at least one per cluster, defaults
+        to None, meaning 64 per cluster
+        :type train_size: int or None, optional
+        :param n_iter: k-means iterations, defaults to 10
+        :type n_iter: int, optional
+        :param seed: Seed of the sampling and initialization, defaults to 0
+        :type seed: int, optional
+        """
+        vectors = normalize_rows(embeddings)
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        # k-means starts from `n_lists` distinct training vectors
+        train_size = min(len(vectors), max(train_size or 64 * n_lists, n_lists))
+        rng = np.random.default_rng(seed)
+        train_vectors = vectors[rng.choice(len(vectors), size=train_size, replace=False)]
+        self.centroids = spherical_kmeans(train_vectors, n_lists, n_iter=n_iter, seed=seed)
+
+        self._vectors = vectors
+        self._ids = np.arange(len(vectors), dtype=np.int64)
+        self._assignments = assign_to_centroids(vectors, self.centroids)
+        self._size = len(vectors)
+        self.payloads = Indexer._check_payloads(vectors, payloads)
+        self._merge_tail()
+
+    def add(self, embeddings: np.ndarray, payloads: list or None = None):
+        """Adds embeddings to the index, assigning them to the existing clusters.
+
+        :param embeddings: Matrix with one embedding per row.
+        :type embeddings: np.ndarray
+        :param payloads: Metadata of each embedding, defaults to None
+        :type payloads: list or None, optional
+        """
+        self._check_index()
+        vectors = normalize_rows(embeddings)
+        payloads = Indexer._check_payloads(vectors, payloads)
+
+        new_size = self._size + len(vectors)
+        if new_size > len(self._vectors) or not self._vectors.flags.writeable:
+            capacity = max(new_size, 2 * len(self._vectors))
+            self._vectors = self._grow(self._vectors, capacity)
+            self._ids = self._grow(self._ids, capacity)
+            self._assignments = self._grow(self._assignments, capacity)
+
+        self._vectors[self._size:new_size] = vectors
+        self._ids[self._size:new_size] = np.arange(self._size, new_size)
+        self._assignments[self._size:new_size] = assign_to_centroids(vectors, self.centroids)
+        self._size = new_size
+        self.payloads.extend(payloads)
+
+        if new_size - self._offsets[-1] > self.max_tail_fraction * new_size:
+            self._merge_tail()
+
+    def _grow(self, array: np.ndarray, capacity: int) -> np.ndarray:
+        grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[:self._size] = array[:self._size]
+        return grown
+
+    def _merge_tail(self):
+        """Regroups every row by cluster."""
+        order = np.argsort(self._assignments[:self._size], kind="stable")
+        self._vectors = np.ascontiguousarray(self._vectors[:self._size][order])
+        self._ids = self._ids[:self._size][order]
+        self._assignments = self._assignments[:self._size][order]
+        counts = np.bincount(self._assignments, minlength=len(self.centroids))
+        self._offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def search_arrays(
+            self,
+            queries: np.ndarray,
+            k: int = 5,
+            nprobe: int or None = None,
+            exact: bool = False
+        ) -> tuple:
+        """Finds the `k` items most similar to each query.
+
+        :param queries: A single embedding or a matrix with one query per row.
+        :type queries: np.ndarray
+        :param k: Number of results per query, defaults to 5
+        :type k: int, optional
+        :param nprobe: Clusters scored per query, defaults to None, meaning the instance `nprobe`
+        :type nprobe: int or None, optional
+        :param exact: Score every vector instead of probing clusters, defaults to False
+        :type exact: bool, optional
+        :return: Two (num_queries, k) arrays: the indices of the items and their cosine similarities. When fewer
+        than k items are found, the missing slots have index -1 and score -inf.
+        :rtype: tuple
+        """
+        self._check_index()
+        queries = normalize_rows(queries)
+        k = min(k, self._size)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+
+        all_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        if exact:
+            for start in range(0, len(queries), 64):
+                scores = queries[start:start + 64] @ self._vectors[:self._size].T
+                top_k = top_k_indices(scores, k)
+                all_indices[start:start + 64] = self._ids[top_k]
+                all_scores[start:start + 64] = np.take_along_axis(scores, top_k, axis=1)
+            return all_indices, all_scores
+
+        probes = top_k_indices(queries @ self.centroids.T, nprobe)
+        tail_start = self._offsets[-1]
+        for row, (query, lists) in enumerate(zip(queries, probes)):
+            ranges = [(self._offsets[i], self._offsets[i + 1]) for i in lists] + [(tail_start, self._size)]
+            scores = np.concatenate([self._vectors[start:end] @ query for start, end in ranges])
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+            found = min(k, len(scores))
+            if found == 0:
+                continue
+            top_k = top_k_indices(scores[None, :], found)[0]
+            all_indices[row, :found] = self._ids[rows[top_k]]
+            all_scores[row, :found] = scores[top_k]
+
+        return all_indices, all_scores
+
+    def search(self, queries: np.ndarray, k: int = 5, nprobe: int or None = None, exact: bool = False) -> List[dict] or List[List[dict]]:
+        """Same as search_arrays, but returns for each query a list of dictionaries with the keys "index", "score"
+        and "payload", like Indexer.search. A single query returns a single list."""
+        single_query = np.ndim(queries) == 1
+        indices, scores = self.search_arrays(queries, k=k, nprobe=nprobe, exact=exact)
+
+        results = [
+            [
+                {"index": int(index), "score": float(score), "payload": self.payloads[index]}
+                for index, score in zip(row_indices, row_scores)
+                if index >= 0
+            ]
+            for row_indices, row_scores in zip(indices, scores)
+        ]
+
+        return results[0] if single_query else results
+
+    def save(self, directory: str):
+        """Saves the index to a directory: centroids.npy, vectors.npy, ids.npy, offsets.npy, payloads.jsonl,
+        payload_offsets.npy and meta.json."""
+        self._check_index()
+        self._merge_tail()
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "centroids.npy"), self.centroids)
+        np.save(os.path.join(directory, "vectors.npy"), self._vectors)
+        np.save(os.path.join(directory, "ids.npy"), self._ids)
+        np.save(os.path.join(directory, "offsets.npy"), self._offsets)
+        save_payloads(directory, self.payloads)
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"nprobe": self.nprobe, "max_tail_fraction": self.max_tail_fraction}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "IvfIndexer":
+        """Loads an index saved with `save`. With `mmap`, vectors are memory-mapped and only the probed clusters
+        are read from disk. Payloads are always read lazily (see PayloadFile)."""
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+
+        indexer = cls(**meta)
+        mmap_mode = "r" if mmap else None
+        indexer.centroids = np.load(os.path.join(directory, "centroids.npy"))
+        indexer._vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode=mmap_mode)
+        indexer._ids = np.load(os.path.join(directory, "ids.npy"))
+        indexer._offsets = np.load(os.path.join(directory, "offsets.npy"))
+        indexer._assignments = np.repeat(np.arange(len(indexer.centroids)), np.diff(indexer._offsets))
+        indexer._size = len(indexer._vectors)
+        indexer.payloads = load_payloads(directory)
+
+        return indexer
+
+
+def evaluate_recall(indexer: IvfIndexer, queries: np.ndarray, k: int = 10, nprobe_values: List[int] or None = None) -> list:
+    """Measures recall@k and latency of the approximate search against the exact one.
+
+    :param indexer: The index to evaluate.
+    :type indexer: IvfIndexer
+    :param queries: Matrix with one query per row (e.g. a sample of held-out embeddings).
+    :type queries: np.ndarray
+    :param k: Number of results per query, defaults to 10
+    :type k: int, optional
+    :param nprobe_values: Values of nprobe to try, defaults to None, meaning the instance nprobe
+    :type nprobe_values: List[int] or None, optional
+    :return: A list of dictionaries with the keys "nprobe", "recall_at_k", "ms_per_query" and
+    "exact_ms_per_query", one per nprobe value.
+    :rtype: list
+    """
+    queries = normalize_rows(queries)
+
+    start = time.perf_counter()
+    exact_indices, _ = indexer.search_arrays(queries, k=k, exact=True)
+    exact_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+    report = []
+    for nprobe in nprobe_values or [indexer.nprobe]:
+        start = time.perf_counter()
+        indices, _ = indexer.search_arrays(queries, k=k, nprobe=nprobe)
+        ms_per_query = 1000 * (time.perf_counter() - start) / len(queries)
+
+        hits = sum(len(np.intersect1d(found, expected)) for found, expected in zip(indices, exact_indices))
+        report.append({
+            "nprobe": nprobe,
+            "recall_at_k": hits / exact_indices.size,
+            "ms_per_query": ms_per_query,
+            "exact_ms_per_query": exact_ms,
+        })
+
+    return report
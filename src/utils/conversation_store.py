@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from src.messages.messages import MessageHistory, Message
+from src.utils.random_ids import conversation_path_from_id, load_conversation_ids, read_history_from_id
+
+
+_SORTABLE_COLUMNS = ("created_at", "updated_at", "title", "message_count", "token_count")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    message_count INTEGER NOT NULL DEFAULT 0,
+    token_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_created_at ON conversations (created_at);
+CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    fields TEXT,
+    PRIMARY KEY (conversation_id, position)
+) WITHOUT ROWID;
+"""
+
+# databases created before function calling stored only the text of each message, which could not be NULL
+_MIGRATE_MESSAGES = """
+BEGIN;
+CREATE TABLE messages_new (
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    fields TEXT,
+    PRIMARY KEY (conversation_id, position)
+) WITHOUT ROWID;
+INSERT INTO messages_new (conversation_id, position, role, content)
+    SELECT conversation_id, position, role, content FROM messages;
+DROP TABLE messages;
+ALTER TABLE messages_new RENAME TO messages;
+COMMIT;
+"""
+
+
+def _created_at_from_id(conversation_id: str, fallback: float) -> str:
+    """Ids made by generate_date_key_combination start with the creation date: "%Y%m%d_%H%M%S_XXXXX"."""
+    try:
+        return datetime.strptime(conversation_id[:15], "%Y%m%d_%H%M%S").isoformat()
+    except ValueError:
+        return datetime.fromtimestamp(fallback).isoformat()
+
+
+def _title_from_messages(messages: list, max_length: int = 60) -> str:
+    for message in messages:
+        if message.role == "user":
+            title = " ".join(message.message.split())
+            return title if len(title) <= max_length else title[:max_length - 3] + "..."
+    return ""
+
+
+class ConversationStore:
+    """Stores conversations in a SQLite database, with a metadata table that can be listed without reading any
+    message, and messages that are only loaded when a conversation is opened.
+
+    A single connection is shared by all threads (Streamlit reruns the script in different threads), so every
+    access goes through a lock.
+    """
+
+    def __init__(self, db_path: str = "data/conversations.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA foreign_keys=ON")
+            self._connection.executescript(_SCHEMA)
+            columns = [row["name"] for row in self._connection.execute("PRAGMA table_info(messages)")]
+            if "fields" not in columns:
+                self._connection.executescript(_MIGRATE_MESSAGES)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def __contains__(self, conversation_id: str):
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return row is not None
+
+    def list_conversations(
+            self,
+            limit: int = 50,
+            offset: int = 0,
+            order_by: str = "updated_at",
+            descending: bool = True
+        ) -> list:
+        """Lists the metadata of one page of conversations.
+
+        :param limit: Maximum number of conversations to return, defaults to 50
+        :type limit: int, optional
+        :param offset: Number of conversations to skip, defaults to 0
+        :type offset: int, optional
+        :param order_by: Column to sort by, one of "created_at", "updated_at", "title", "message_count" or
+        "token_count", defaults to "updated_at"
+        :type order_by: str, optional
+        :param descending: Sort from the largest (most recent) to the smallest, defaults to True
+        :type descending: bool, optional
+        :return: A list of dictionaries with the keys "id", "created_at", "updated_at", "title", "message_count"
+        and "token_count".
+        :rtype: list
+        """
+        if order_by not in _SORTABLE_COLUMNS:
+            raise ValueError(f"order_by must be one of {_SORTABLE_COLUMNS}. You passed: {order_by}")
+
+        direction = "DESC" if descending else "ASC"
+        query = f"SELECT * FROM conversations ORDER BY {order_by} {direction}, id {direction} LIMIT ? OFFSET ?"
+        with self._lock:
+            rows = self._connection.execute(query, (limit, offset)).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def get_metadata(self, conversation_id: str) -> dict or None:
+        """Returns the metadata of a conversation, or None if it is not stored."""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def load_history(self, conversation_id: str) -> MessageHistory:
+        """Loads the messages of a conversation into a MessageHistory.
+
+        :param conversation_id: Id of the conversation.
+        :type conversation_id: str
+        :raises KeyError: If the conversation is not stored.
+        :return: A MessageHistory object containing the stored history.
+        :rtype: MessageHistory
+        """
+        with self._lock:
+            if self._connection.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone() is None:
+                raise KeyError(f"Conversation {conversation_id} is not stored in {self.db_path}")
+            rows = self._connection.execute(
+                "SELECT role, content, fields FROM messages WHERE conversation_id = ? ORDER BY position",
+                (conversation_id,),
+            ).fetchall()
+
+        history = MessageHistory()
+        for row in rows:
+            fields = json.loads(row["fields"]) if row["fields"] is not None else {}
+            history.add_message(Message.from_dict({"role": row["role"], "content": row["content"], **fields}))
+
+        return history
+
+    def save_history(self, conversation_id: str, history: MessageHistory, tokens_used: int = 0):
+        """Stores a conversation. Only the messages beyond those already stored are inserted, so saving after every
+        turn costs as much as the new messages.
+
+        :param conversation_id: Id of the conversation.
+        :type conversation_id: str
+        :param history: The full history of the conversation.
+        :type history: MessageHistory
+        :param tokens_used: Tokens spent since the last save, added to the conversation token count, defaults to 0
+        :type tokens_used: int, optional
+        """
+        now = datetime.now().isoformat()
+        messages = history.messages
+
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT message_count FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+
+            if row is None:
+                self._connection.execute(
+                    "INSERT INTO conversations (id, created_at, updated_at) VALUES (?, ?, ?)",
+                    (conversation_id, _created_at_from_id(conversation_id, fallback=datetime.now().timestamp()), now),
+                )
+                stored_count = 0
+            else:
+                stored_count = row["message_count"]
+
+            if stored_count > len(messages):
+                # the history was rewritten (e.g. compacted): replace what is stored
+                self._connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                stored_count = 0
+
+            self._connection.executemany(
+                """INSERT OR REPLACE INTO messages (conversation_id, position, role, content, fields)
+                VALUES (?, ?, ?, ?, ?)""",
+                [
+                    (
+                        conversation_id,
+                        position,
+                        message.role,
+                        message.message,
+                        json.dumps(message._fields) if message._fields is not None else None,
+                    )
+                    for position, message in enumerate(messages[stored_count:], start=stored_count)
+                ],
+            )
+            self._connection.execute(
+                """UPDATE conversations
+                SET updated_at = ?, title = ?, message_count = ?, token_count = token_count + ?
+                WHERE id = ?""",
+                (now, _title_from_messages(messages), len(messages), tokens_used, conversation_id),
+            )
+
+    def delete(self, conversation_id: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    def import_json_files(self, dir_path: str = "data/conversations") -> int:
+        """One-shot importer for the conversations saved as files by MessageHistory.save_to_file (.json lists or
+        .jsonl logs). Conversations already in the store are skipped, so it is safe to run it more than once, and
+        unreadable files are logged and skipped.
+
+        :param dir_path: Base path where all files are located, defaults to "data/conversations"
+        :type dir_path: str, optional
+        :return: The number of imported conversations.
+        :rtype: int
+        """
+        if not os.path.isdir(dir_path):
+            return 0
+
+        imported = 0
+        for conversation_id in sorted(set(load_conversation_ids(dir_path))):
+            if conversation_id in self:
+                continue
+
+            path = conversation_path_from_id(conversation_id, dir_path)
+            try:
+                history = read_history_from_id(path)
+            except (ValueError, KeyError, json.JSONDecodeError) as e:
+                logging.error(f"Skipping {path}, it could not be read: {e}")
+                continue
+
+            self.save_history(conversation_id, history)
+            with self._lock, self._connection:
+                # keep the original dates instead of the import time
+                created_at = _created_at_from_id(conversation_id, fallback=os.path.getmtime(path))
+                updated_at = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+                self._connection.execute(
+                    "UPDATE conversations SET created_at = ?, updated_at = ? WHERE id = ?",
+                    (created_at, updated_at, conversation_id),
+                )
+            imported += 1
+
+        return imported
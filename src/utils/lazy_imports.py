@@ -0,0 +1,41 @@
+import importlib
+import importlib.util
+import sys
+
+
+class _MissingModule:
+    """Stands in for an optional module that is not installed; fails when it is actually used."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        raise ModuleNotFoundError(f"No module named '{self._name}'. Install it to use this feature.")
+
+
+def lazy_import(name: str):
+    """Returns module `name` without executing it: the import happens on the first attribute access.
+
+    Heavy backends (numpy, torch, tiktoken) are imported this way by the modules that the chat path loads, so a
+    process that never uses them never pays for them. If the module is not installed, the returned object raises
+    ModuleNotFoundError when used instead of when imported.
+
+    :param name: Absolute name of the module, e.g. "numpy".
+    :type name: str
+    :return: The module (loaded lazily), or a placeholder if it is not installed.
+    :rtype: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return _MissingModule(name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
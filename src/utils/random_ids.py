@@ -1,4 +1,5 @@
 import json
+import logging
 import os
 import random
 import string
@@ -7,16 +8,28 @@ from datetime import datetime
 from src.messages.messages import MessageHistory, Message
 
 
-def generate_date_key_combination(dir_path="data/conversations") -> str:
-    """Generated a random file name with todays date and 5 extra characters.
+def generate_conversation_id() -> str:
+    """Generates a random conversation id with todays date and 5 extra characters.
 
-    :return: A file path with a unique id that can be used as a file name.
+    :return: An id in the format "%Y%m%d_%H%M%S_XXXXX".
     :rtype: str
     """
     rand_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
 
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{rand_str}"
+
+
+def generate_date_key_combination(dir_path="data/conversations", extension=".json") -> str:
+    """Generated a random file name with todays date and 5 extra characters.
+
+    :param extension: Extension of the file, ".json" for a JSON list or ".jsonl" for an append-only log, defaults 
+    to ".json"
+    :type extension: str, optional
+    :return: A file path with a unique id that can be used as a file name.
+    :rtype: str
+    """
     # Create a filename using the current date and random string
-    filename = f"{dir_path}/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{rand_str}.json"
+    filename = f"{dir_path}/{generate_conversation_id()}{extension}"
 
     return filename
 
@@ -26,29 +39,90 @@ def load_conversation_ids(dir_path="data/conversations") -> list:
 
     :param dir_path: Base path where all files are located, defaults to "data/conversations"
     :type dir_path: str, optional
-    :return: A list of json paths
+    :return: A list of conversation ids (file names of the .json and .jsonl files without extension)
     :rtype: list
     """
-    return [file.split('.json')[0] for file in os.listdir(dir_path) if file.endswith('.json')]
+    return [os.path.splitext(file)[0] for file in os.listdir(dir_path) if file.endswith(('.json', '.jsonl'))]
+
+
+def conversation_path_from_id(conversation_id: str, dir_path="data/conversations") -> str:
+    """Returns the path of the file that stores a conversation, preferring the append-only log if both exist.
+
+    :param conversation_id: Id of the conversation, as returned by load_conversation_ids.
+    :type conversation_id: str
+    :param dir_path: Base path where all files are located, defaults to "data/conversations"
+    :type dir_path: str, optional
+    :return: The full path to the conversation file.
+    :rtype: str
+    """
+    jsonl_path = f"{dir_path}/{conversation_id}.jsonl"
+    if os.path.exists(jsonl_path):
+        return jsonl_path
+
+    return f"{dir_path}/{conversation_id}.json"
+
+
+def _read_jsonl_messages(jsonl_path: str) -> tuple:
+    """Reads the message dictionaries of an append-only log. A partial last line (left by a crash mid-append) is
+    ignored; a corrupt line anywhere else raises. Returns the messages and whether the file ended cleanly."""
+    with open(jsonl_path) as f:
+        content = f.read()
+
+    lines = content.splitlines()
+    is_clean = content == "" or content.endswith("\n")
+
+    dict_messages = []
+    for line_number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            dict_messages.append(json.loads(line))
+        except json.JSONDecodeError:
+            if line_number == len(lines) - 1:
+                logging.warning(f"Ignoring a partial last line in {jsonl_path}")
+                is_clean = False
+                break
+            raise
+
+    return dict_messages, is_clean
 
 
 def read_history_from_id(json_path: str) -> MessageHistory:
     """Creates a message history from a path that is used to read the saved history file.
 
-    :param json_path: Path to the file in the format: "base_dir" + "id" + ".json". YOU NEED TO PASS THE FULL PATH.
+    :param json_path: Path to the file in the format: "base_dir" + "id" + ".json" (or ".jsonl" for append-only 
+    logs). YOU NEED TO PASS THE FULL PATH.
     :type json_path: str
     :return: A MessageHistory object containing the read history.
     :rtype: MessageHistory
     """
-    with open(json_path) as f:
-        hist_dict = json.load(f)
+    is_clean_log = False
+    if json_path.endswith(".jsonl"):
+        hist_dict, is_clean_log = _read_jsonl_messages(json_path)
+    else:
+        with open(json_path) as f:
+            hist_dict = json.load(f)
 
-    messages_list_final = []
-
-    for dict_message in hist_dict:
-        messages_list_final.append(Message(dict_message["role"], dict_message["content"]))
-        
     history = MessageHistory()
-    history.populate_from_list(messages_list_final)
+    for dict_message in hist_dict:
+        history.add_message(Message.from_dict(dict_message))
+
+    if is_clean_log:
+        # a log with a partial last line is not marked, so the next save rewrites it instead of appending
+        history.mark_as_persisted(json_path)
+
+    return history
+
+
+def compact_history_file(jsonl_path: str) -> MessageHistory:
+    """Rewrites an append-only log in place, dropping partial lines left by crashes.
+
+    :param jsonl_path: Full path to the ".jsonl" file.
+    :type jsonl_path: str
+    :return: The history stored in the file.
+    :rtype: MessageHistory
+    """
+    history = read_history_from_id(jsonl_path)
+    history.compact_file(jsonl_path)
 
-    return history
\ No newline at end of file
+    return history